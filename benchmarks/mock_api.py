@@ -0,0 +1,225 @@
+"""
+Local stand-in for the parts of the P&P REST API that the loader talks to.
+
+It serves /books/<id>/, /character_classes/ (paginated, with creation), /runs/characters/, the
+bulk create and update endpoints of a book and the per-record DELETE endpoints. Every request
+can be delayed by a fixed latency plus jitter, a share of the bulk requests can be failed with a
+503, and bulk bodies above a size limit are refused with a 413, like the production proxy does.
+gzip and zstd request bodies are decoded unless compression is switched off, in which case they
+get a 415. The server counts what it received, so a benchmark can check that nothing was lost.
+"""
+
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_MAX_BODY_BYTES = 32 * 1024 * 1024
+BULK_PATH = re.compile(r"^/api/books/[^/]+/bulk_(pages|lines|characters)(_update)?/$")
+DELETE_PATH = re.compile(r"^/api/(pages|lines|characters)/[^/]+/$")
+
+
+class MockSettings:
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+                 accept_compression=True, seed=0):
+        self.latency = latency  # seconds added to every request
+        self.jitter = jitter  # up to this many more seconds, uniformly
+        self.failure_rate = failure_rate  # share of bulk requests answered with a 503
+        self.max_body_bytes = max_body_bytes  # decoded bulk bodies above this get a 413
+        self.accept_compression = accept_compression
+        self.random = random.Random(seed)
+
+
+class MockState:
+    def __init__(self, classnames=()):
+        self.lock = threading.Lock()
+        self.classnames = set(classnames)
+        self.runs = set()  # ids of the character runs created
+        self.records = {}  # e.g. "characters" or "characters_update" -> records received
+        self.requests = {}  # path kind -> count
+        self.failures = 0
+        self.rejected = 0
+        self.deleted = 0
+        self.body_bytes = 0
+
+    def count(self, kind, records=0, body_bytes=0):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            if records:
+                self.records[kind] = self.records.get(kind, 0) + records
+            self.body_bytes += body_bytes
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "records": dict(self.records),
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "deleted": self.deleted,
+                "body_bytes": self.body_bytes,
+            }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the production server
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _delay(self):
+        delay = self.settings.latency + self.settings.random.uniform(0, self.settings.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _send(self, code, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        """
+        The decoded request body, or None if its encoding is refused
+        """
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding is None:
+            return raw, len(raw)
+        if not self.settings.accept_compression or (encoding == "zstd" and zstandard is None):
+            return None, len(raw)
+        if encoding == "gzip":
+            return gzip.decompress(raw), len(raw)
+        if encoding == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj().decompress(raw), len(raw)
+        return None, len(raw)
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        if url.path == "/api/character_classes/":
+            query = parse_qs(url.query)
+            limit = int(query.get("limit", ["100"])[0])
+            offset = int(query.get("offset", ["0"])[0])
+            with self.state.lock:
+                classnames = sorted(self.state.classnames)
+            next_url = None
+            if offset + limit < len(classnames):
+                host, port = self.server.server_address[:2]
+                next_url = f"http://{host}:{port}/api/character_classes/?limit={limit}&offset={offset + limit}"
+            self.state.count("character_classes")
+            return self._send(200, {
+                "count": len(classnames),
+                "next": next_url,
+                "results": [{"classname": c, "label": c} for c in classnames[offset:offset + limit]],
+            })
+        match = re.match(r"^/api/books/([^/]+)/$", url.path)
+        if match:
+            self.state.count("books")
+            return self._send(200, {"id": match.group(1), "all_runs": {"pages": [], "lines": [], "characters": []}})
+        match = re.match(r"^/api/runs/characters/([^/]+)/$", url.path)
+        if match:
+            with self.state.lock:
+                known = match.group(1) in self.state.runs
+            if known:
+                return self._send(200, {"id": match.group(1)})
+        return self._send(404, {"detail": "Not found."})
+
+    def do_POST(self):
+        self._delay()
+        url = urlparse(self.path)
+        body, body_bytes = self._read_body()
+        if body is None:
+            with self.state.lock:
+                self.state.rejected += 1
+            return self._send(415, {"detail": "Unsupported media type"})
+        if url.path == "/api/character_classes/":
+            payload = json.loads(body)
+            with self.state.lock:
+                self.state.classnames.add(payload["classname"])
+            self.state.count("character_classes")
+            return self._send(201, payload)
+        if url.path == "/api/runs/characters/":
+            self.state.count("runs")
+            run_id = str(uuid.uuid4())
+            with self.state.lock:
+                self.state.runs.add(run_id)
+            return self._send(201, {"id": run_id})
+        match = BULK_PATH.match(url.path)
+        if match:
+            kind = match.group(1) + (match.group(2) or "")
+            if self.settings.failure_rate and self.settings.random.random() < self.settings.failure_rate:
+                with self.state.lock:
+                    self.state.failures += 1
+                return self._send(503, {"detail": "Injected failure"})
+            if len(body) > self.settings.max_body_bytes:
+                return self._send(413, {"detail": "Request body too large"})
+            payload = json.loads(body)
+            self.state.count(kind, len(payload[match.group(1)]), body_bytes)
+            return self._send(201, {"created": len(payload[match.group(1)])})
+        return self._send(404, {"detail": "Not found."})
+
+    def do_DELETE(self):
+        self._delay()
+        if DELETE_PATH.match(urlparse(self.path).path):
+            with self.state.lock:
+                self.state.deleted += 1
+            return self._send(204)
+        return self._send(404, {"detail": "Not found."})
+
+
+class MockAPI:
+    """
+    The stand-in API served from a background thread. Use as a context manager.
+    """
+
+    def __init__(self, settings=None, host="127.0.0.1", port=0, classnames=()):
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.settings = settings or MockSettings()
+        self.server.state = MockState(classnames)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,149 @@
+"""
+Benchmark BookLoader against the local stand-in API.
+
+A synthetic book is generated once (or reused), then every scenario runs the loader in a fresh
+child process so that its timing and peak memory are its own. The stand-in API runs in this
+process. Results are printed as a table and can be written as JSON to compare runs:
+
+    python -m benchmarks.run --characters 1000000 --latency 0.02 --output before.json
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import click
+
+from .mock_api import MockAPI, MockSettings
+from .synthetic_book import generate_book, modify_characters
+
+DEFAULT_WORK_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "ingest-book", "benchmarks")
+# name -> (BookLoader keyword arguments, preparation run before the timed load)
+SCENARIOS = {
+    "create": ({}, None),
+    "update": ({"update": True}, None),
+    "create-gzip": ({"compress": "gzip"}, None),
+    "create-columnar": ({"columnar_cache": True}, "compile_columnar"),
+    "update-differential": ({"update": True, "differential": True}, "previous_load"),
+}
+DEFAULT_SCENARIOS = ("create", "update")
+BULK_KINDS = ("pages", "lines", "characters")
+
+
+def _child_environment(api_url, work_directory):
+    environment = dict(os.environ)
+    environment.update({
+        "PP_API_URL": api_url,
+        "PP_API_TOKEN": "benchmark",
+        "PP_CHARACTER_CLASS_CACHE": os.path.join(work_directory, "character_classes.json"),
+    })
+    return environment
+
+
+def _run_child(scenario, json_directory, workers, chunk_bytes, environment):
+    command = [sys.executable, "-m", "benchmarks.run_scenario", scenario, json_directory,
+               "--workers", str(workers), "--chunk_bytes", str(chunk_bytes)]
+    completed = subprocess.run(command, env=environment, stdout=subprocess.PIPE, universal_newlines=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if completed.returncode != 0:
+        raise click.ClickException(f"Scenario {scenario} failed with exit code {completed.returncode}")
+    # the child prints its result as the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _book_directory(work_directory, characters, seed):
+    directory = os.path.join(work_directory, f"book_{characters}_{seed}")
+    if not os.path.exists(os.path.join(directory, "chars.json")):
+        click.echo(f"Generating a synthetic book with {characters} characters in {directory}")
+        start = time.monotonic()
+        generate_book(directory, characters, seed)
+        click.echo(f"Generated in {time.monotonic() - start:.1f}s")
+    return directory
+
+
+def _print_table(results):
+    header = ("scenario", "seconds", "chars sent/s", "MB sent", "bulk requests", "retries", "peak RSS MB")
+    rows = []
+    for result in results:
+        metrics = result["metrics"]
+        characters = metrics["records"].get("characters", {}).get("records", 0)
+        requests = sum(count for kind, count in result["api"]["requests"].items() if kind.startswith(BULK_KINDS))
+        rows.append((
+            result["scenario"],
+            f"{result['seconds']:.2f}",
+            f"{characters / result['seconds']:.0f}" if result["seconds"] else "-",
+            f"{metrics['bytes_sent'] / 1e6:.1f}",
+            str(requests),
+            str(metrics["retries"]),
+            f"{result['peak_rss_bytes'] / 1e6:.0f}" if result["peak_rss_bytes"] else "-",
+        ))
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        click.echo("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+@click.command()
+@click.option("--characters", help="Characters in the synthetic book", default=100000, show_default=True)
+@click.option("--seed", help="Seed of the synthetic book", default=0, show_default=True)
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(sorted(SCENARIOS)),
+              help="Scenario to run, can be repeated [default: create and update]")
+@click.option("--latency", help="Seconds added to every API request", default=0.0, show_default=True)
+@click.option("--jitter", help="Up to this many more seconds per request", default=0.0, show_default=True)
+@click.option("--failure_rate", default=0.0, show_default=True,
+              help="Share of bulk requests failed with a 503, a create load stops at the first one")
+@click.option("--max_body_bytes", help="Bulk bodies above this size get a 413",
+              default=32 * 1024 * 1024, show_default=True)
+@click.option("--no_compression", is_flag=True, help="Refuse compressed request bodies with a 415")
+@click.option("--workers", help="Maximum character requests in flight", default=4, show_default=True)
+@click.option("--chunk_bytes", help="Target bytes per character request", default=4 * 1024 * 1024, show_default=True)
+@click.option("--work_dir", help="Where synthetic books and scenario copies are kept",
+              default=DEFAULT_WORK_DIRECTORY, show_default=True)
+@click.option("--output", help="Write the results as JSON to this file", default=None)
+def main(characters, seed, scenarios, latency, jitter, failure_rate, max_body_bytes, no_compression, workers,
+         chunk_bytes, work_dir, output):
+    """Benchmark the bulk loader against a local stand-in API."""
+    os.makedirs(work_dir, exist_ok=True)
+    book_directory = _book_directory(work_dir, characters, seed)
+    settings = MockSettings(latency=latency, jitter=jitter, failure_rate=failure_rate,
+                            max_body_bytes=max_body_bytes, accept_compression=not no_compression, seed=seed)
+    results = []
+    with MockAPI(settings) as api:
+        environment = _child_environment(api.url, work_dir)
+        for scenario in scenarios or DEFAULT_SCENARIOS:
+            # every scenario loads its own copy, so sidecar caches and journals do not leak between them
+            json_directory = os.path.join(work_dir, "runs", scenario, "book_color")
+            shutil.rmtree(os.path.dirname(json_directory), ignore_errors=True)
+            shutil.copytree(book_directory, json_directory)
+            _, preparation = SCENARIOS[scenario]
+            if preparation is not None:
+                _run_child(f"prepare:{preparation}", json_directory, workers, chunk_bytes, environment)
+                if preparation == "previous_load":
+                    changed, removed = modify_characters(json_directory)
+                    click.echo(f"{scenario}: changed {changed} and removed {removed} characters")
+            before = api.state.snapshot()
+            result = _run_child(scenario, json_directory, workers, chunk_bytes, environment)
+            after = api.state.snapshot()
+            result["api"] = {
+                "requests": {kind: count - before["requests"].get(kind, 0)
+                             for kind, count in after["requests"].items()},
+                "failures": after["failures"] - before["failures"],
+                "deleted": after["deleted"] - before["deleted"],
+            }
+            results.append(result)
+            click.echo(f"{scenario}: {result['seconds']:.2f}s")
+    click.echo("")
+    _print_table(results)
+    if output is not None:
+        settings_summary = {"characters": characters, "seed": seed, "latency": latency, "jitter": jitter,
+                            "failure_rate": failure_rate, "max_body_bytes": max_body_bytes,
+                            "compression": not no_compression, "workers": workers, "chunk_bytes": chunk_bytes}
+        with open(output, "w") as f:
+            json.dump({"settings": settings_summary, "results": results}, f, indent=2)
+        click.echo(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
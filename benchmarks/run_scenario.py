@@ -0,0 +1,59 @@
+"""
+Run one benchmark scenario in this process and print its result as a JSON line.
+Started by benchmarks.run with the environment pointing the loader at the stand-in API.
+"""
+
+import json
+import logging
+import os
+import time
+
+import click
+
+from ingest.bulk_load_json import BookLoader
+from ingest.columnar import open_columnar, cache_directory_for
+from ingest.metrics import peak_rss_bytes
+from .run import SCENARIOS
+
+BENCHMARK_BOOK_ID = "00000000-0000-4000-8000-000000000000"
+
+
+def _prepare(preparation, json_directory, workers, chunk_bytes):
+    if preparation == "compile_columnar":
+        for key in ("pages", "lines", "chars"):
+            open_columnar(os.path.join(json_directory, f"{key}.json"), key, cache_directory_for(json_directory)).close()
+    elif preparation == "previous_load":
+        BookLoader(BENCHMARK_BOOK_ID, json_directory, update=True, chunk_bytes=chunk_bytes,
+                   max_workers=workers).load_db()
+    else:
+        raise click.UsageError(f"Unknown preparation {preparation}")
+
+
+@click.command()
+@click.argument("scenario")
+@click.argument("json_directory")
+@click.option("--workers", default=4)
+@click.option("--chunk_bytes", default=4 * 1024 * 1024)
+def main(scenario, json_directory, workers, chunk_bytes):
+    logging.basicConfig(filename=os.path.join(os.path.dirname(json_directory), f"{scenario.replace(':', '_')}.log"),
+                        format="%(asctime)s %(message)s", level=logging.INFO)
+    if scenario.startswith("prepare:"):
+        _prepare(scenario.split(":", 1)[1], json_directory, workers, chunk_bytes)
+        print(json.dumps({"scenario": scenario}))
+        return
+    loader_options, _ = SCENARIOS[scenario]
+    start = time.monotonic()
+    loader = BookLoader(BENCHMARK_BOOK_ID, json_directory, chunk_bytes=chunk_bytes, max_workers=workers,
+                        **loader_options)
+    loader.load_db()
+    seconds = time.monotonic() - start
+    print(json.dumps({
+        "scenario": scenario,
+        "seconds": seconds,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "metrics": loader.metrics.summary(),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Generate synthetic Ocular output (pages.json, lines.json and chars.json) of a given size.
+
+The records carry the fields the loader reads (ids, the line/page they belong to and the Ocular
+character class) plus the kind of numeric fields Ocular writes, so that payload sizes are close
+to those of a real book. Files are written one record at a time, so a 5M character book does not
+need to fit in memory. The same seed always gives the same book.
+"""
+
+import json
+import os
+import random
+import uuid
+
+from ingest.json_stream import iter_json_array
+
+CHARACTERS_PER_LINE = 45
+LINES_PER_PAGE = 35
+# Ocular codes with rough frequencies, including the ones stored under a special name
+CHARACTER_CODES = "etaoinshrdlcumwfgypbvkjxqz" + "ETAOINSHRDLCUMWFGYPBVKJXQZ" + "ſæœ&,:'-" + ".;/\\"
+SPACE_SHARE = 0.16
+
+
+def _write_array(path, key, records):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"%s": [' % key)
+        for record in records:
+            if count:
+                f.write(",\n")
+            f.write(json.dumps(record))
+            count += 1
+        f.write("]}\n")
+    return count
+
+
+def _ids(rng, count):
+    # stable UUIDs derived from the seed
+    return [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(count)]
+
+
+def generate_book(directory, characters=100000, seed=0):
+    """
+    Write a synthetic book with about `characters` characters into directory.
+    Returns the number of pages, lines and characters written.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    line_count = max(1, -(-characters // CHARACTERS_PER_LINE))
+    page_count = max(1, -(-line_count // LINES_PER_PAGE))
+    page_ids = _ids(rng, page_count)
+    line_ids = _ids(rng, line_count)
+    weights = [1.0 / (rank + 2) for rank in range(len(CHARACTER_CODES))]
+
+    def pages():
+        for index, page_id in enumerate(page_ids):
+            yield {
+                "id": page_id,
+                "index": index,
+                "tif": f"books/synthetic/tif/{index:04d}.tif",
+            }
+
+    def lines():
+        for index, line_id in enumerate(line_ids):
+            page_index, line_on_page = divmod(index, LINES_PER_PAGE)
+            yield {
+                "id": line_id,
+                "page_id": page_ids[page_index],
+                "sequence": line_on_page,
+                "y_min": 60 * line_on_page,
+                "y_max": 60 * line_on_page + 48,
+            }
+
+    def chars():
+        written = 0
+        for line_id in line_ids:
+            x = 0
+            for sequence in range(min(CHARACTERS_PER_LINE, characters - written)):
+                if rng.random() < SPACE_SHARE:
+                    code = ""
+                else:
+                    code = rng.choices(CHARACTER_CODES, weights)[0]
+                width = rng.randint(8, 30)
+                yield {
+                    "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "line_id": line_id,
+                    "sequence": sequence,
+                    "x_min": x,
+                    "x_max": x + width,
+                    "offset": rng.randint(-3, 3),
+                    "exp_wx": rng.randint(0, 4),
+                    "exp_wy": rng.randint(0, 4),
+                    "logprob": round(rng.uniform(-40.0, 0.0), 6),
+                    "character_class": code,
+                }
+                x += width
+                written += 1
+
+    return (
+        _write_array(os.path.join(directory, "pages.json"), "pages", pages()),
+        _write_array(os.path.join(directory, "lines.json"), "lines", lines()),
+        _write_array(os.path.join(directory, "chars.json"), "chars", chars()),
+    )
+
+
+def modify_characters(directory, share=0.01, removed_share=0.001, seed=1):
+    """
+    Change the class of a share of the characters and drop a few, as a re-run of Ocular would.
+    Used to exercise differential updates. Returns the number of characters changed and removed.
+    """
+    rng = random.Random(seed)
+    path = os.path.join(directory, "chars.json")
+    counts = {"changed": 0, "removed": 0}
+
+    def modified():
+        for record in iter_json_array(path, "chars"):
+            draw = rng.random()
+            if draw < removed_share:
+                counts["removed"] += 1
+                continue
+            if draw < removed_share + share:
+                record["character_class"] = rng.choice(CHARACTER_CODES)
+                record["logprob"] = round(rng.uniform(-40.0, 0.0), 6)
+                counts["changed"] += 1
+            yield record
+
+    tmp_path = path + ".tmp"
+    _write_array(tmp_path, "chars", modified())
+    os.replace(tmp_path, path)
+    return counts["changed"], counts["removed"]
@@ -0,0 +1,176 @@
+"""
+Client for the P&P REST API, shared by ingest.py and bulk_load_json.py.
+
+One keep-alive Session per process holds a pool of verified TLS connections and the auth header,
+so the token file is read and the handshake made once rather than on every request. Every request
+gets a (connect, read) timeout for its kind. Lookups and deletes are retried with jittered
+exponential backoff on connection errors, timeouts and 502/503/504 responses. Creates and bulk
+requests are only retried after a connect timeout, when the server never saw them; any other
+failure may come after the server applied them. The loader retries the bulk updates that fail
+that way, which are idempotent, and stops on bulk creates that do (see chunking.send_with_split).
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# the environment can point the client at another API, e.g. the stand-in one used by the benchmarks
+API_URL = os.environ.get("PP_API_URL", "https://printprobdb.psc.edu/api")
+AUTH_TOKEN_PATH = os.environ.get("PP_API_TOKEN_FILE", "/ocean/projects/hum160002p/shared/api/api_token.txt")
+CERT_PATH = os.environ.get("PP_CERT_PATH", "/ocean/projects/hum160002p/shared/api/server.crt")
+POOL_SIZE = 16  # connections kept to the API, more than the uploads in flight
+# request kind -> (connect, read) timeout in seconds
+TIMEOUTS = {
+    "lookup": (10, 60),
+    "create": (10, 120),
+    "bulk": (10, 600),
+    "delete": (10, 60),
+}
+RETRY_STATUS_CODES = {502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+CHARACTER_CLASS_PAGE_SIZE = 500
+
+
+def read_token(path=AUTH_TOKEN_PATH):
+    token = os.environ.get("PP_API_TOKEN")
+    if token:
+        return token
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+class APIClient:
+    def __init__(self, url=API_URL, token=None, cert_path=CERT_PATH, pool_size=POOL_SIZE):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Token {token or read_token()}"
+        self.session.verify = cert_path
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt):
+        # full jitter, so the workers of a load that all failed together do not retry together
+        time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)))
+
+    def request(self, method, path, kind="lookup", **kwargs):
+        """
+        Send a request to the API path (relative to the API root, or an absolute URL such as a
+        next link) and return the response, retrying as described above
+        """
+        url = path if path.startswith(("http://", "https://")) else f"{self.url}/{path.lstrip('/')}"
+        idempotent = method in ("GET", "DELETE")
+        for attempt in range(MAX_RETRIES + 1):
+            last_attempt = attempt == MAX_RETRIES
+            try:
+                response = self.session.request(method, url, timeout=TIMEOUTS[kind], **kwargs)
+            except requests.exceptions.ConnectTimeout as ex:
+                if last_attempt:
+                    raise
+                reason = str(ex)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                if last_attempt or not idempotent:
+                    raise
+                reason = str(ex)
+            else:
+                if last_attempt or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                reason = f"{response.status_code} {response.reason}"
+            logging.info(f"Retrying {method} {url} after attempt {attempt + 1} failed - {reason}")
+            self._backoff(attempt)
+
+    # books
+
+    def find_books(self, **filters):
+        """
+        Books matching the filters (e.g. vid or estc), an empty list if there are none
+        """
+        response = self.request("GET", "books/", params=filters)
+        return response.json().get("results") or []
+
+    def get_book(self, book_id):
+        """
+        The book with the given UUID, or None if it does not exist
+        """
+        response = self.request("GET", f"books/{book_id}/")
+        if response.status_code == 200 and response.headers.get("Content-Type") == "application/json":
+            return response.json()
+        return None
+
+    def create_book(self, book):
+        return self.request("POST", "books/", kind="create", json=book).json()
+
+    # runs
+
+    def create_character_run(self, book_id):
+        return self.request("POST", "runs/characters/", kind="create", json={"book": book_id}).json()
+
+    def get_character_run(self, run_id):
+        return self.request("GET", f"runs/characters/{run_id}/").json()
+
+    def character_run_exists(self, run_id):
+        """
+        Whether the character run exists. Raises if the API could not say, e.g. on a 5xx or a 401.
+        """
+        response = self.request("GET", f"runs/characters/{run_id}/")
+        if response.status_code == 404:
+            return False
+        if response.status_code != 200:
+            raise Exception(f"Could not look up character run {run_id} - {response.status_code} {response.content[:500]}")
+        return True
+
+    # character classes
+
+    def iter_character_classes(self, page_size=CHARACTER_CLASS_PAGE_SIZE):
+        """
+        Every character class, following the pagination links
+        """
+        path = "character_classes/"
+        params = {"limit": page_size}
+        while path:
+            response = self.request("GET", path, params=params)
+            if response.status_code != 200:
+                raise Exception(response.content)
+            body = response.json()
+            yield from body["results"]
+            # the next link already carries limit and offset
+            path = body.get("next")
+            params = None
+
+    def create_character_class(self, classname):
+        return self.request("POST", "character_classes/", kind="create",
+                            json={"classname": classname, "label": classname})
+
+    # bulk operations
+
+    def bulk(self, book_id, endpoint, body, headers=None):
+        """
+        POST an already encoded JSON body to a bulk endpoint of a book
+        """
+        return self.request("POST", f"books/{book_id}/{endpoint}/", kind="bulk", data=body,
+                            headers={"Content-Type": "application/json", **(headers or {})})
+
+    def delete(self, collection, record_id):
+        return self.request("DELETE", f"{collection}/{record_id}/", kind="delete")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The APIClient of this process, created on first use
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = APIClient()
+        return _client
@@ -0,0 +1,150 @@
+"""
+Batch ingest: resolve or create the books for many book strings concurrently, sharing the
+sheet snapshot and ESTC/VID index, then submit their loads. Each load goes into the job-name
+slot of its book, so a backlog drains as many books at a time as there are slots.
+"""
+import concurrent.futures
+import os
+
+from .ingest import _resolve_book, _get_estc_vid_index, _json_directory, _job_name, _submit_load, \
+    _unchanged_load, _describe_unchanged_load, DEFAULT_CONCURRENT_LOADS
+from .sheets.sheet import get_snapshot
+from .sizing import estimate_job
+from .validate import validate_book
+
+DEFAULT_RESOLVE_WORKERS = 4
+
+
+class BatchEntry:
+    def __init__(self, book_string, preexisting_uuid=None):
+        self.book_string = book_string
+        self.preexisting_uuid = preexisting_uuid
+        self.book_uuid = None
+        self.update = False
+        self.error = None
+        self.job_size = None
+        self.job_name = None
+        self.submission = None  # sbatch output
+        self.unchanged_load = None  # the recorded load, when the Ocular output is already loaded
+
+
+def read_manifest(path):
+    """
+    Entries of a manifest file: one book string per line, optionally followed by an existing UUID
+    (separated by whitespace or a comma). Blank lines and '#' comments are ignored.
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].replace(',', ' ').split()
+            if fields:
+                entries.append(BatchEntry(fields[0], fields[1] if len(fields) > 1 else None))
+    return entries
+
+
+def entries_from_sheet():
+    """
+    Entries for the 'Pipeline Progress' rows that have no UUID yet
+    """
+    return [BatchEntry(book_string) for book_string in get_snapshot().book_strings_without_uuid()]
+
+
+def _resolve_entry(entry, printer, update, validate=True, force=False):
+    if not os.path.isdir(_json_directory(entry.book_string)):
+        entry.error = 'no Ocular output at {}'.format(_json_directory(entry.book_string))
+        return entry
+    counts = None
+    if validate:
+        report = validate_book(_json_directory(entry.book_string))
+        if not report.ok:
+            entry.error = report.summary()
+            return entry
+        counts = report.counts
+    try:
+        entry.job_size = estimate_job(_json_directory(entry.book_string), counts)
+        entry.book_uuid, entry.update = _resolve_book(entry.book_string, entry.preexisting_uuid, printer, update)
+        if not force:
+            entry.unchanged_load = _unchanged_load(entry.book_uuid, entry.book_string, counts)
+    except SystemExit:
+        # the single-book path exits on unrecoverable lookups, keep going with the other books
+        entry.error = 'stopped while resolving the book, see the output above'
+    except Exception as ex:
+        entry.error = str(ex)
+    return entry
+
+
+def _estc_number(book_string):
+    # what _resolve_book finds the existing books of a book string by
+    fields = book_string.split('_')
+    return fields[1] if len(fields) > 1 else book_string
+
+
+def _unique_entries(entries):
+    unique = {}
+    for entry in entries:
+        if entry.book_string in unique:
+            print('Skipping the repeated entry for {}'.format(entry.book_string))
+            continue
+        unique[entry.book_string] = entry
+    return list(unique.values())
+
+
+def _resolve_entries(entries, resolve, workers):
+    """
+    Call resolve(entry) for the entries on `workers` threads. Entries with the same ESTC number are
+    resolved one after another, so the book created for the first is found by the next instead of
+    both creating one.
+    """
+    groups = {}
+    for entry in entries:
+        groups.setdefault(_estc_number(entry.book_string), []).append(entry)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda group: [resolve(entry) for entry in group], groups.values()))
+
+
+def _print_summary(entries, concurrent_loads):
+    print()
+    print('Batch summary:')
+    for entry in entries:
+        if entry.error is not None:
+            print('  {}\tFAILED - {}'.format(entry.book_string, entry.error))
+        elif entry.unchanged_load is not None:
+            print('  {}\t{}\t{}'.format(entry.book_string, entry.book_uuid,
+                                        _describe_unchanged_load(entry.unchanged_load)))
+        else:
+            shards = ', {} character shards'.format(entry.job_size.shards) if entry.job_size.shards > 1 else ''
+            print('  {}\t{}\t{}\t{}{} - {}'.format(entry.book_string, entry.book_uuid,
+                                                  'update' if entry.update else 'new run', entry.job_name, shards,
+                                                  entry.submission))
+    loaded = sum(1 for entry in entries if entry.error is None and entry.unchanged_load is None)
+    unchanged = sum(1 for entry in entries if entry.unchanged_load is not None)
+    print('{} of {} books submitted ({} unchanged), up to {} loading at a time.'
+          .format(loaded, len(entries), unchanged, concurrent_loads))
+
+
+def run_batch(entries, printer=None, update=False, workers=DEFAULT_RESOLVE_WORKERS, validate=True,
+              concurrent_loads=DEFAULT_CONCURRENT_LOADS, force=False):
+    entries = _unique_entries(entries)
+    if not entries:
+        print('Nothing to ingest.')
+        return
+    # warm the shared caches once, before the workers need them
+    snapshot = get_snapshot()
+    snapshot.row_for_book_string(entries[0].book_string)
+    _get_estc_vid_index().get_many([entry.book_string.split('_')[1] for entry in entries
+                                    if '_' in entry.book_string])
+
+    _resolve_entries(entries, lambda entry: _resolve_entry(entry, printer, update, validate, force), workers)
+
+    resolved = [entry for entry in entries if entry.error is None]
+    for entry in resolved:
+        snapshot.queue_uuid(entry.book_string, entry.book_uuid)
+    snapshot.flush()
+
+    for entry in resolved:
+        if entry.unchanged_load is not None:
+            continue
+        entry.job_name = _job_name(entry.book_uuid, concurrent_loads)
+        entry.submission = _submit_load(entry.book_uuid, entry.book_string, entry.update, entry.job_size,
+                                        concurrent_loads, force)
+    _print_summary(entries, concurrent_loads)
@@ -2,18 +2,55 @@
 Script to load JSON-formatted outputs from Ocular into the P&P REST API.
 """
 
-import requests
 import json
 import logging
+import os
+import time
 from glob import glob
 import optparse
 import re
 import concurrent.futures
-
-AUTH_TOKEN = open("/ocean/projects/hum160002p/shared/api/api_token.txt", "r").read().strip()
-AUTH_HEADER = {"Authorization": f"Token {AUTH_TOKEN}"}
-PP_URL = "https://printprobdb.psc.edu/api"
-CERT_PATH = "/ocean/projects/hum160002p/shared/api/server.crt"
+import threading
+from itertools import islice
+
+try:
+    from .json_stream import iter_json_array, scan_string_counts
+    from .upload_pool import AdaptiveUploader, DEFAULT_MAX_WORKERS
+    from .chunking import serialize_in_chunks, send_with_split, ServerErrors, DEFAULT_CHUNK_BYTES
+    from .journal import LoadJournal
+    from .columnar import open_columnar, cache_directory_for
+    from .transport import BodyEncoder, ENCODINGS, SERIALIZER, dumps, json_array
+    from .manifest import RecordManifest
+    from .metrics import LoadMetrics, metrics_directory_for
+    from .pipeline import Pipeline
+    from .api_client import get_client, CERT_PATH
+    from .parallel_parse import available_cpus, plan_shards, iter_prepared_chunks
+    from .fingerprint import fingerprint, same_content, completed_load, read_record, record_load, discard_record
+except ImportError:  # run directly as a script from the Slurm job
+    from json_stream import iter_json_array, scan_string_counts
+    from upload_pool import AdaptiveUploader, DEFAULT_MAX_WORKERS
+    from chunking import serialize_in_chunks, send_with_split, ServerErrors, DEFAULT_CHUNK_BYTES
+    from journal import LoadJournal
+    from columnar import open_columnar, cache_directory_for
+    from transport import BodyEncoder, ENCODINGS, SERIALIZER, dumps, json_array
+    from manifest import RecordManifest
+    from metrics import LoadMetrics, metrics_directory_for
+    from pipeline import Pipeline
+    from api_client import get_client, CERT_PATH
+    from parallel_parse import available_cpus, plan_shards, iter_prepared_chunks
+    from fingerprint import fingerprint, same_content, completed_load, read_record, record_load, discard_record
+
+TIF_ROOT = "/ocean/projects/hum160002p/shared"
+# manifest kind -> REST collection, in the order removed records are deleted
+DELETE_ENDPOINTS = (("chars", "characters"), ("lines", "lines"), ("pages", "pages"))
+CHARACTER_CLASS_CACHE = os.environ.get(
+    "PP_CHARACTER_CLASS_CACHE", "/ocean/projects/hum160002p/shared/api/character_classes.json"
+)
+CHARACTER_CLASS_CACHE_TTL = 24 * 60 * 60  # seconds
+READ_BATCH_SIZE = 2000  # characters handed from the reader to the serializer at a time
+READ_QUEUE_DEPTH = 16  # batches the reader may run ahead of the serializer
+# Ocular codes that are stored under a name
+SPECIAL_CLASSNAMES = {"": "space", ".": "period", ";": "semicolon", "/": "slash", "\\": "backslash"}
 
 
 class CharacterClasses:
@@ -21,230 +58,697 @@ class CharacterClasses:
     Utility to create a hashmap of Ocular character codes to database IDs, so that we don't need to check every single time
     """
 
-    data = {}
-
-    def load_character_classes(self):
+    def __init__(self, cache_path=CHARACTER_CLASS_CACHE, client=None):
+        self.client = client or get_client()
+        self.data = {}
+        # Ocular code -> classname, filled by prepare(). Replaced rather than changed in place, so a
+        # load that is reading it is not disturbed by another one adding to it
+        self.table = {}
+        self.cache_path = cache_path
+        self.from_cache = False
+        # shared by the loads of a daemon, which prepare their books at the same time
+        self._lock = threading.RLock()
+
+    def load_character_classes(self, refresh=False):
         """
-        Create a dict of all currently-loaded character classes
+        Create a dict of all currently-loaded character classes, from the shared cache while it
+        is fresh, otherwise by paging through the API
         """
-        cc_res = requests.get(
-            f"{PP_URL}/character_classes/",
-            params={"limit": 500},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        if cc_res.status_code == 200:
-            for cc in cc_res.json()["results"]:
+        with self._lock:
+            if not refresh and self._read_cache():
+                return
+            for cc in self.client.iter_character_classes():
                 self.data[cc["classname"]] = cc["classname"]
-            logging.info(self.data)
-        else:
+            self.from_cache = False
+            logging.info(f"{len(self.data)} character classes loaded")
+            self._write_cache()
+
+    def _read_cache(self):
+        try:
+            if time.time() - os.path.getmtime(self.cache_path) > CHARACTER_CLASS_CACHE_TTL:
+                return False
+            with open(self.cache_path, "r") as f:
+                classnames = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.data.update({classname: classname for classname in classnames})
+        self.from_cache = True
+        logging.info(f"{len(self.data)} character classes loaded from {self.cache_path}")
+        return True
+
+    def _write_cache(self):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(sorted(self.data), f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as ex:
+            logging.info(f"Could not write the character class cache - {str(ex)}")
+
+    def _create(self, classname):
+        cc_res = self.client.create_character_class(classname)
+        if cc_res.status_code == 201:
+            logging.info(f"{classname} created")
+            self.data[classname] = classname
+            return
+        # another job may have created it in the meantime
+        self.load_character_classes(refresh=True)
+        if classname not in self.data:
             raise Exception(cc_res.content)
 
+    def prepare(self, ocular_codes):
+        """
+        Build the normalization table for the distinct Ocular codes of a book, creating any
+        missing character classes before the upload starts
+        """
+        classnames = {code: SPECIAL_CLASSNAMES.get(code, code) for code in ocular_codes}
+        with self._lock:
+            missing = set(classnames.values()) - self.data.keys()
+            if missing and self.from_cache:
+                self.load_character_classes(refresh=True)
+                missing -= self.data.keys()
+            for classname in sorted(missing):
+                self._create(classname)
+            if missing:
+                self._write_cache()
+            self.table = {**self.table, **classnames}
+        logging.info(f"{len(classnames)} distinct character classes in the book, {len(missing)} created")
+
     def get_or_create(self, ocular_code):
-        if ocular_code == "":
-            ocular_code = "space"
-        elif ocular_code == ".":
-            ocular_code = "period"
-        elif ocular_code == ";":
-            ocular_code = "semicolon"
-        elif ocular_code == "/":
-            ocular_code = "slash"
-        elif ocular_code == "\\":
-            ocular_code = "backslash"
         try:
-            return self.data[ocular_code]
-        except:
-            cc_res = requests.post(
-                f"{PP_URL}/character_classes/",
-                json={"classname": ocular_code, "label": ocular_code},
-                headers=AUTH_HEADER,
-                verify=CERT_PATH,
-            )
-            if cc_res.status_code == 201:
-                logging.info(f"{ocular_code} created")
-                self.data[ocular_code] = ocular_code
-                return ocular_code
-            else:
-                raise Exception(cc_res.content)
+            return self.table[ocular_code]
+        except KeyError:
+            pass
+        classname = SPECIAL_CLASSNAMES.get(ocular_code, ocular_code)
+        with self._lock:
+            if classname not in self.data:
+                self._create(classname)
+            self.table = {**self.table, ocular_code: classname}
+        return classname
 
 
 class BookLoader:
-    def __init__(self, book_id, json_directory, update=False):
+    def __init__(self, book_id, json_directory, update=False, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 max_workers=DEFAULT_MAX_WORKERS, resume=False, columnar_cache=False, compress=None,
+                 differential=False, metrics_directory=None, character_shards=1, shard=None, run_id=None,
+                 client=None, parse_processes=None, force=False, character_classes=None):
         self.book_id = book_id
+        self.client = client or get_client()
         self.json_directory = json_directory
         self.update = update
-        self.cc = CharacterClasses()
-        self.cc.load_character_classes()
+        self.chunk_bytes = chunk_bytes
+        self.max_workers = max_workers
+        self.resume = resume
+        self.resuming = False
+        self.columnar_cache = columnar_cache
+        self.tables = {}  # Ocular array name -> ColumnarTable, when the columnar cache is used
+        self.characters_normalized = False
+        self.parse_processes = available_cpus() if parse_processes is None else parse_processes
+        self.parse_shards = None  # byte ranges of chars.json, when the characters are prepared in processes
+        self.encoder = BodyEncoder(compress) if compress else None
+        self.differential = differential
+        # a sharded load is a pages and lines job that leaves the characters to `character_shards`
+        # tasks, each of which loads the chunks whose index modulo the count is its `shard` index
+        self.character_shards = character_shards
+        self.shard = shard
+        self.run_id = run_id
+        # the shards of a book run on different nodes at the same time, so only the pages and lines job
+        # keeps the manifest
+        self.manifest = RecordManifest.for_directory(json_directory) if shard is None else None
+        self.journal = LoadJournal.for_directory(json_directory, shard)
+        if shard is None:
+            self.metrics = LoadMetrics("bulk_load", book=book_id)
+        else:
+            self.metrics = LoadMetrics(f"bulk_load_shard{shard[0]}of{shard[1]}", book=book_id, shard=shard[0])
+        self.metrics_directory = metrics_directory or metrics_directory_for(json_directory)
+        self.character_count = None  # for the upload ETA, when it is known up front
+        self.record_counts = {}  # array -> records read, for the fingerprint record
+        self.force = force
+        self.unchanged = False
+        if character_classes is not None:
+            # kept loaded by a long-running process such as the ingest daemon
+            self.cc = character_classes
+        else:
+            self.cc = CharacterClasses(client=self.client)
+            with self.metrics.phase("character_classes"):
+                self.cc.load_character_classes()
 
     def load_db(self):
-        self.confirm_book()
+        try:
+            self._load_db()
+            self.metrics.status = "unchanged" if self.unchanged else "complete"
+        except BaseException:
+            self.metrics.status = "failed"
+            raise
+        finally:
+            self.metrics.write(self.metrics_directory)
+            self.close()
+
+    def close(self):
+        """
+        Close the manifest database and the columnar files, which a long-running process such as the
+        ingest daemon would otherwise keep open for every book it loaded
+        """
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+    def _load_db(self):
+        with self.metrics.phase("confirm_book"):
+            self.confirm_book()
+        if not self.force and self.shard is None and self.already_loaded():
+            self.unchanged = True
+            return
         self.load_json()
-        if self.update:
-            self.update_pages()
-            self.update_lines()
-            self.update_characters()
-        else:
-            self.create_pages()
-            self.create_lines()
-            self.create_characters()
+        if not self.open_journal():
+            return
+        if self.manifest is not None:
+            self.manifest.begin(self.book_id, resume=self.resuming)
+        loads_pages_and_lines = self.shard is None
+        loads_characters = self.character_shards == 1
+        with Pipeline(self.metrics) as pipeline:
+            # characters are read and serialized while pages and lines upload, and only sent after them
+            characters = self._character_pipeline(pipeline) if loads_characters else None
+            if self.update:
+                if loads_pages_and_lines:
+                    with self.metrics.phase("pages"):
+                        self.update_pages()
+                    with self.metrics.phase("lines"):
+                        self.update_lines()
+                if loads_characters:
+                    with self.metrics.phase("characters"):
+                        self.update_characters(characters)
+                if self.differential:
+                    with self.metrics.phase("deletions"):
+                        self.delete_removed()
+            else:
+                if loads_pages_and_lines:
+                    with self.metrics.phase("pages"):
+                        self.create_pages()
+                    with self.metrics.phase("lines"):
+                        self.create_lines()
+                if loads_characters:
+                    with self.metrics.phase("characters"):
+                        self.create_characters(characters)
+                else:
+                    # the character shards load into the run created here
+                    self.character_run_id()
+        self.journal.mark_complete()
+        if self.manifest is not None:
+            if not loads_characters:
+                # the shards do not hash the characters they send, so the stored hashes are stale
+                self.manifest.forget("chars")
+            self.manifest.commit()
+        self.record_fingerprint()
+        if self.encoder is not None:
+            logging.info(self.encoder.summary())
+
+    def open_journal(self):
+        """
+        Start a new load journal, or pick up the previous one when resuming.
+        Returns False if the previous load already completed and there is nothing left to do.
+        """
+        if self.resume and self.journal.read():
+            header = self.journal.header
+            if header["book_id"] != self.book_id or header["update"] != self.update \
+                    or header.get("differential", False) != self.differential \
+                    or header.get("character_shards", 1) != self.character_shards:
+                raise Exception(
+                    f"The journal {self.journal.path} belongs to another load "
+                    f"(book {header['book_id']}, update={header['update']}, "
+                    f"differential={header.get('differential', False)}, "
+                    f"character_shards={header.get('character_shards', 1)}), cannot resume."
+                )
+            # records read from the columnar cache or serialized by another library can come out as other
+            # bytes, which would move the chunk boundaries the journaled ranges refer to
+            if header.get("columnar_cache", False) != self.columnar_cache or header.get("serializer") != SERIALIZER:
+                raise Exception(
+                    f"The load recorded in {self.journal.path} was made with columnar_cache="
+                    f"{header.get('columnar_cache', False)} and the {header.get('serializer')} serializer, this "
+                    f"one with columnar_cache={self.columnar_cache} and {SERIALIZER}, cannot resume."
+                )
+            if self.journal.complete:
+                logging.info(f"The load recorded in {self.journal.path} already completed, nothing to resume")
+                return False
+            # chunk boundaries have to match the interrupted load
+            self.chunk_bytes = header["chunk_bytes"]
+            if not header.get("parallel_parse", False):
+                self.parse_shards = None
+            elif self.parse_shards is None:
+                raise Exception(
+                    f"The load recorded in {self.journal.path} prepared its characters in parse processes, "
+                    f"which is not possible for this load, cannot resume."
+                )
+            self.resuming = True
+            logging.info(f"Resuming the load recorded in {self.journal.path}")
+            return True
+        if self.resume:
+            logging.info(f"No journal found at {self.journal.path}, starting a new load")
+        files = None
+        if self.shard is None:
+            # a new load replaces the recorded one, even if it does not complete
+            previous = read_record(self.json_directory)
+            discard_record(self.json_directory)
+            with self.metrics.phase("fingerprint"):
+                files = fingerprint(self.json_directory, previous and previous["files"])
+        self.journal.start(book_id=self.book_id, update=self.update, differential=self.differential,
+                           chunk_bytes=self.chunk_bytes, character_shards=self.character_shards,
+                           parallel_parse=self.parse_shards is not None, columnar_cache=self.columnar_cache,
+                           serializer=SERIALIZER, fingerprint=files)
+        return True
+
+    def already_loaded(self):
+        """
+        Whether the Ocular output was already loaded into this book, unchanged since and into a run that still exists
+        """
+        record = completed_load(self.json_directory, self.book_id)
+        if record is None:
+            return False
+        run_id = record.get("character_run")
+        if run_id is not None and not self.client.character_run_exists(run_id):
+            logging.info(f"Character run {run_id} of the previous load no longer exists, loading again")
+            return False
+        logging.info(f"The Ocular output in {self.json_directory} is unchanged since it was loaded into book "
+                     f"{self.book_id} (character run {run_id}) at {record['loaded_at']}, nothing to load. "
+                     f"Pass --force to load it again.")
+        return True
+
+    def record_fingerprint(self):
+        """
+        Record the fingerprint the load started with, once all of it has completed: by the job itself, or by the
+        last character shard of a sharded load to complete, counting only the shards that loaded into the run of
+        the current pages and lines job
+        """
+        if self.character_shards > 1:
+            return
+        main_journal = self.journal
+        if self.shard is not None:
+            main_journal = LoadJournal.for_directory(self.json_directory)
+            if not main_journal.read() or main_journal.character_run_id != self.journal.character_run_id:
+                return
+            for index in range(self.shard[1]):
+                if index == self.shard[0]:
+                    continue
+                shard_journal = LoadJournal.for_directory(self.json_directory, (index, self.shard[1]))
+                # the journal of a shard of an earlier load of the book is complete too, but for another run
+                if not (shard_journal.read() and shard_journal.complete
+                        and shard_journal.character_run_id == main_journal.character_run_id):
+                    return
+        files = main_journal.header.get("fingerprint")
+        if files is None:
+            # a resumed load that was started without one
+            return
+        if not same_content(fingerprint(self.json_directory, files), files):
+            logging.info(f"The Ocular output in {self.json_directory} changed during the load, not recording it")
+            return
+        counts = dict(self.record_counts)
+        if self.character_count is not None:
+            counts["chars"] = self.character_count
+        record_load(self.json_directory, self.book_id, self.run_id or main_journal.character_run_id, files, counts)
 
     def confirm_book(self):
         """
         Confirm that the book actually exists on Bridges
         """
-        res = requests.get(
-            f"{PP_URL}/books/{self.book_id}/", headers=AUTH_HEADER, verify=CERT_PATH
-        )
-        if res.status_code != 200:
-            logging.info(res.content)
+        if self.client.get_book(self.book_id) is None:
             raise Exception(
                 f"The book {self.book_id} is not yet registered in the database. Please confirm you have used the correct UUID."
             )
 
     def divide_into_chunks(self, data, chunk_size=20):
-        # looping till length l
-        for i in range(0, len(data), chunk_size):
-            yield data[i:i + chunk_size]
+        # works on any iterable, so chunks can be pulled lazily from a stream
+        iterator = iter(data)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
 
     def load_json(self):
-        self.pages = json.load(open(f"{self.json_directory}/pages.json", "r"))["pages"]
-        # Add a "side" to every page
-        for page in self.pages:
+        """
+        Check that the Ocular output is present. Records are streamed from disk by
+        iter_pages/iter_lines/iter_characters when they are uploaded, not loaded here.
+        """
+        self.pages_path = f"{self.json_directory}/pages.json"
+        self.lines_path = f"{self.json_directory}/lines.json"
+        self.characters_path = f"{self.json_directory}/chars.json"
+        for path in (self.pages_path, self.lines_path, self.characters_path):
+            open(path, "r").close()
+        ocular_codes = None
+        with self.metrics.phase("json_parse"):
+            if self.columnar_cache:
+                cache_directory = cache_directory_for(self.json_directory)
+                for key, path in (("pages", self.pages_path), ("lines", self.lines_path), ("chars", self.characters_path)):
+                    self.tables[key] = open_columnar(path, key, cache_directory)
+                ocular_codes = self.tables["chars"].strings("character_class")
+                self.character_count = self.tables["chars"].count
+            if ocular_codes is None:
+                code_counts = scan_string_counts(self.characters_path, "character_class")
+                ocular_codes = set(code_counts)
+                self.character_count = sum(code_counts.values())
+        with self.metrics.phase("normalization"):
+            # create any new character classes up front, so normalization is a table lookup
+            self.cc.prepare(ocular_codes)
+            if self.tables.get("chars") is not None and self.tables["chars"].strings("character_class") is not None:
+                # normalize each distinct class once in the string table instead of per character
+                self.tables["chars"].map_strings("character_class", self.cc.get_or_create)
+                self.characters_normalized = True
+        # the parse processes stage hashes for the manifest, but cannot check them against it
+        if self.parse_processes > 1 and not self.columnar_cache and not self.differential:
+            shards = plan_shards(self.characters_path, "chars")
+            if shards is not None and len(shards) > 1:
+                self.parse_shards = shards
+
+    def _iter_records(self, key, path):
+        table = self.tables.get(key)
+        if table is not None:
+            return table.iter_records()
+        return iter_json_array(path, key)
+
+    def iter_pages(self):
+        count = 0
+        for page in self._iter_records("pages", self.pages_path):
+            # Add a "side" to every page
             page["side"] = "s"
-        logging.info(f"{len(self.pages)} pages loaded")
-        self.lines = json.load(open(f"{self.json_directory}/lines.json", "r"))["lines"]
-        logging.info(f"{len(self.lines)} lines loaded")
-        self.characters = json.load(open(f"{self.json_directory}/chars.json", "r"))[
-            "chars"
-        ]
-        # Normalize characters
-        for character in self.characters:
-            character["character_class"] = self.cc.get_or_create(
-                character["character_class"]
-            )
-        logging.info(f"{len(self.characters)} characters loaded")
+            count += 1
+            yield page
+        self.record_counts["pages"] = count
+        logging.info(f"{count} pages loaded")
+
+    def iter_lines(self):
+        count = 0
+        for line in self._iter_records("lines", self.lines_path):
+            count += 1
+            yield line
+        self.record_counts["lines"] = count
+        logging.info(f"{count} lines loaded")
+
+    def iter_characters(self):
+        count = 0
+        table = self.cc.table
+        for character in self._iter_records("chars", self.characters_path):
+            if not self.characters_normalized:
+                # Normalize characters as they are read
+                ocular_code = character["character_class"]
+                character["character_class"] = table.get(ocular_code) or self.cc.get_or_create(ocular_code)
+            count += 1
+            yield character
+        logging.info(f"{count} characters loaded")
 
     def create_character_run(self):
-        character_run_create_response = requests.post(
-            f"{PP_URL}/runs/characters/",
-            json={"book": self.book_id},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        json_response = character_run_create_response.json()
+        json_response = self.client.create_character_run(self.book_id)
         logging.info("Character run created with id: " + json_response['id'])
         return json_response
 
+    def character_run_id(self):
+        """
+        The character run to create characters in: the one given, the one in the journal, the one
+        the pages and lines job created for a shard, or a new one
+        """
+        run_id = self.run_id or self.journal.character_run_id
+        if run_id is None and self.shard is not None:
+            main_journal = LoadJournal.for_directory(self.json_directory)
+            if not main_journal.read() or not main_journal.complete or main_journal.character_run_id is None:
+                raise Exception(
+                    f"The pages and lines job has not completed according to {main_journal.path}, "
+                    f"run it first or give the character run id"
+                )
+            run_id = main_journal.character_run_id
+        if run_id is None:
+            run_id = self.create_character_run()["id"]
+        else:
+            logging.info(f"Using character run {run_id}")
+        if self.journal.character_run_id != run_id:
+            self.journal.record_character_run(run_id)
+        return run_id
+
     def get_character_run(self, id):
-        character_run_get_response = requests.get(
-            f"{PP_URL}/runs/characters/${id}",
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        json_response = character_run_get_response.json()
+        json_response = self.client.get_character_run(id)
         logging.info("Got character run ith id: " + json_response['id'])
         return json_response
 
+    def _post_bulk(self, endpoint, payload):
+        start = time.monotonic()
+        try:
+            response = self._send_bulk(endpoint, payload)
+        finally:
+            self.metrics.observe("request_seconds", time.monotonic() - start, endpoint=endpoint)
+        self.metrics.count("requests", endpoint=endpoint, status=response.status_code)
+        self.metrics.count("bytes_sent", len(response.request.body or b""), endpoint=endpoint)
+        return response
+
+    def _send_bulk(self, endpoint, payload):
+        if self.encoder is None:
+            return self.client.bulk(self.book_id, endpoint, dumps(payload))
+        while True:
+            body, headers = self.encoder.encode(payload)
+            response = self.client.bulk(self.book_id, endpoint, body, headers)
+            # resend once uncompressed if the server cannot decode the body
+            if not self.encoder.rejected(response):
+                return response
+            self.metrics.count("retries", endpoint=endpoint)
+
+    def _tracked(self, kind, records):
+        """
+        Hash every record into the manifest for the next differential update and, in differential
+        mode, pass on only the records that changed since the previous load
+        """
+        if self.manifest is None:
+            return records
+        if self.differential:
+            return self.manifest.changed(kind, records)
+        return self.manifest.track(kind, records)
+
+    def _send_in_chunks(self, endpoint, key, records, extra=None):
+        """
+        Send records to a bulk endpoint in byte-budgeted chunks, serialized as they are read and a
+        few requests at a time, journaling every acknowledged slice so that a resumed load only sends
+        the rest. A chunk the server rejects as too large is split and sent again. Raises once every
+        chunk was tried if any records failed, or right away if the server keeps failing.
+        """
+        if self.journal.is_done(key):
+            logging.info(f"Skipping {key}, already sent according to the journal")
+            return
+        records = self._tracked(key, self.metrics.timed(f"parse_{key}", records))
+
+        def pending_chunks():
+            for index, (chunk, texts) in enumerate(serialize_in_chunks(records, self.chunk_bytes)):
+                for start, end in self.journal.pending_ranges(key, index, len(chunk)):
+                    yield index, start, chunk[start:end], json_array(texts[start:end])
+
+        def send(piece):
+            index, offset, part_records, serialized = piece
+            return send_with_split(
+                # smaller pieces after a split are serialized again
+                lambda part: self._post_bulk(endpoint, {key: serialized if part is part_records else part,
+                                                        **(extra or {})}),
+                part_records,
+                on_sent=lambda start, end: self.journal.commit_range(key, index, offset + start, offset + end),
+                # updates set the same values again, creates would add the records twice
+                idempotent=self.update,
+            )
+
+        sent = requests = failed = 0
+        reason = None
+        uploader = AdaptiveUploader(self.max_workers)
+        for (index, _, part_records, _), outcome, ex in uploader.map(send, pending_chunks()):
+            if isinstance(ex, ServerErrors):
+                # the server keeps failing, the journal lets a later load resume from here
+                logging.error(f"Stopping, the server kept failing on {key} chunk {index} - {str(ex)}")
+                raise ex
+            if ex is not None:
+                failed += len(part_records)
+                reason = reason or str(ex)
+                logging.error(f"Error in sending {key} chunk {index} to {endpoint} - {str(ex)}")
+                continue
+            sent += outcome.sent
+            requests += outcome.requests
+            failed += outcome.failed_count
+            if outcome.failed:
+                reason = reason or outcome.failed[0][1]
+            self.metrics.count("retries", outcome.retries, endpoint=endpoint)
+        self.metrics.count("records_sent", sent, kind=key)
+        logging.info({f"{key} sent to {endpoint}": sent, "Requests": requests})
+        if failed:
+            raise Exception(f"{failed} {key} could not be sent to {endpoint} - {reason}")
+        self.journal.mark_done(key)
+
+    def _read_characters(self):
+        """
+        Normalized characters, tracked in the manifest, in batches of READ_BATCH_SIZE
+        """
+        characters = self._tracked("chars", self.metrics.timed("parse_characters", self.iter_characters()))
+        return self.divide_into_chunks(characters, READ_BATCH_SIZE)
+
+    def _pending_character_chunks(self, batches):
+        """
+        Byte-budgeted character chunks as (chunk index, offset, characters, serialized characters),
+        leaving out the slices that the journal records as already acknowledged and, for a shard,
+        the chunks of the other shards
+        """
+        characters = (character for batch in batches for character in batch)
+        chunks = serialize_in_chunks(characters, self.chunk_bytes)
+        for index, (characters, texts) in enumerate(chunks):
+            if self.shard is not None and index % self.shard[1] != self.shard[0]:
+                continue
+            for start, end in self.journal.pending_ranges("characters", index, len(characters)):
+                yield index, start, characters[start:end], json_array(texts[start:end])
+
+    def _prepared_character_chunks(self):
+        """
+        Character chunks decoded, normalized and serialized by the parse processes, in the same form
+        as those of _pending_character_chunks
+        """
+        processes = min(self.parse_processes, len(self.parse_shards))
+        logging.info({"Character shards": len(self.parse_shards), "Parse processes": processes})
+        chunks = iter_prepared_chunks(self.characters_path, "chars", self.parse_shards, self.cc.table,
+                                      self.chunk_bytes, processes)
+        count = 0
+        for index, (characters, hashed) in enumerate(self.metrics.timed("parse_characters", chunks)):
+            count += len(characters)
+            if self.manifest is not None:
+                self.manifest.stage("chars", hashed)
+            if self.shard is not None and index % self.shard[1] != self.shard[0]:
+                continue
+            for start, end in self.journal.pending_ranges("characters", index, len(characters)):
+                part = characters[start:end]
+                yield index, start, part, part.serialized
+        logging.info(f"{count} characters loaded")
+
+    def _character_pipeline(self, pipeline):
+        """
+        Read, normalize and serialize the character chunks in background stages, keeping a few
+        chunks ready for every upload slot
+        """
+        if self.parse_shards is not None:
+            return pipeline.stage("prepare_characters", self._prepared_character_chunks(), 2 * self.max_workers)
+        batches = pipeline.stage("read_characters", self._read_characters(), READ_QUEUE_DEPTH)
+        return pipeline.stage("serialize_characters", self._pending_character_chunks(batches), 2 * self.max_workers)
+
+    def _upload_character_chunks(self, post, action, chunks=None):
+        """
+        Upload character chunks with post(characters, serialized) -> response, keeping several
+        requests in flight and journaling every acknowledged slice. Raises once every chunk was
+        tried if any characters failed, or right away if the server keeps failing.
+        """
+        logging.info({"Target bytes per character chunk": self.chunk_bytes})
+        if chunks is None:
+            with Pipeline(self.metrics) as pipeline:
+                return self._upload_character_chunks(post, action, self._character_pipeline(pipeline))
+
+        def send(piece):
+            index, offset, characters, serialized = piece
+            start = time.monotonic()
+            outcome = send_with_split(
+                # the pipeline already serialized the whole slice, smaller pieces after a split are not
+                # unless they were prepared by the parse processes
+                lambda part: post(part, serialized if part is characters else getattr(part, "serialized", None)),
+                characters,
+                on_sent=lambda start, end: self.journal.commit_range("characters", index, offset + start, offset + end),
+                idempotent=self.update,
+            )
+            self.metrics.observe("chunk_seconds", time.monotonic() - start, action=action)
+            return outcome
+
+        failed = 0
+        uploader = AdaptiveUploader(self.max_workers)
+        # in differential mode only the changed characters are sent, so there is no total to go by
+        total = None if self.differential else self.character_count
+        if total is not None and self.shard is not None:
+            total = -(-total // self.shard[1])  # about one share of the chunks
+        progress = self.metrics.progress(f"Characters {action}", total)
+        for (index, offset, characters, _), outcome, ex in uploader.map(send, chunks):
+            if isinstance(ex, ServerErrors):
+                logging.error(f"Stopping, the server kept failing on character chunk {index} - {str(ex)}")
+                raise ex
+            if ex is not None:
+                failed += len(characters)
+                logging.error(f'Error in {action} character chunk {index} - {str(ex)}')
+                continue
+            failed += outcome.failed_count
+            self.metrics.count("records_sent", outcome.sent, kind="characters")
+            self.metrics.count("retries", outcome.retries, action=action)
+            progress.advance(outcome.sent)
+            logging.info({f"Characters chunk {action}": index, "Characters": outcome.sent, "Requests": outcome.requests})
+        progress.log()
+        if failed:
+            raise Exception(f"{failed} characters could not be {action}")
+
     def create_pages(self):
-        bulk_page_response = requests.post(
-            f"{PP_URL}/books/{self.book_id}/bulk_pages/",
-            json={"pages": self.pages, "tif_root": "/ocean/projects/hum160002p/shared"},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        logging.info(bulk_page_response.content)
+        self._send_in_chunks("bulk_pages", "pages", self.iter_pages(), {"tif_root": TIF_ROOT})
 
     def create_lines(self):
-        bulk_line_response = requests.post(
-            f"{PP_URL}/books/{self.book_id}/bulk_lines/",
-            json={"lines": self.lines},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        logging.info(bulk_line_response.content)
-
-    def create_characters(self):
-        character_run = self.create_character_run()
-        character_run_id = character_run['id']
-        book_id = self.book_id
-        character_list = self.characters
-        chunk_divisor = 20
-        chunks = list(self.divide_into_chunks(character_list, int(round(len(character_list) / chunk_divisor))))
-        logging.info({"Total number of characters to be added": len(character_list)})
-        logging.info({"Number of chunks for characters": len(chunks)})
+        self._send_in_chunks("bulk_lines", "lines", self.iter_lines())
+
+    def create_characters(self, chunks=None):
+        character_run_id = self.character_run_id()
         try:
             logging.info("Creating characters in chunks")
 
-            def db_bulk_create(characters_payload, run_id):
+            def db_bulk_create(characters_payload, serialized, run_id):
                 logging.info({"Characters creating": len(characters_payload)})
-                bulk_character_response = requests.post(
-                    f"{PP_URL}/books/{book_id}/bulk_characters/",
-                    json={"characters": characters_payload, "character_run_id": run_id},
-                    headers=AUTH_HEADER,
-                    verify=CERT_PATH,
+                return self._post_bulk(
+                    "bulk_characters",
+                    {"characters": characters_payload if serialized is None else serialized, "character_run_id": run_id},
                 )
-                return bulk_character_response
-
-            for characters in chunks:
-                try:
-                    response = db_bulk_create(characters, character_run_id)
-                    logging.info({"Characters chunk created": str(response)})
-                except Exception as ex:
-                    logging.error(f'Error in creating character chunk - {str(ex)}')
+
+            self._upload_character_chunks(
+                lambda characters, serialized: db_bulk_create(characters, serialized, character_run_id), "created", chunks
+            )
         except Exception as ex:
             logging.error(f'Error in creating characters - {str(ex)}')
             raise
 
     def update_pages(self):
         logging.info("Updating Pages...")
-        bulk_page_response = requests.post(
-            f"{PP_URL}/books/{self.book_id}/bulk_pages_update/",
-            json={"pages": self.pages, "tif_root": "/ocean/projects/hum160002p/shared"},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        logging.info(bulk_page_response.content)
+        self._send_in_chunks("bulk_pages_update", "pages", self.iter_pages(), {"tif_root": TIF_ROOT})
 
     def update_lines(self):
         logging.info("Updating Lines...")
-        bulk_line_response = requests.post(
-            f"{PP_URL}/books/{self.book_id}/bulk_lines_update/",
-            json={"lines": self.lines},
-            headers=AUTH_HEADER,
-            verify=CERT_PATH,
-        )
-        logging.info(bulk_line_response.content)
-
-    def update_characters(self):
+        self._send_in_chunks("bulk_lines_update", "lines", self.iter_lines())
+
+    def update_characters(self, chunks=None):
         logging.info("Updating Characters...")
-        character_list = self.characters
-        chunk_divisor = 20
-        chunks = list(self.divide_into_chunks(character_list, int(round(len(character_list) / chunk_divisor))))
-        logging.info({"Total number of characters to be updated": len(character_list)})
-        logging.info({"Number of chunks for characters": len(chunks)})
         try:
             logging.info("Updating characters in chunks")
 
-            def db_bulk_update(characters_payload):
+            def db_bulk_update(characters_payload, serialized):
                 logging.info({"Characters updating": len(characters_payload)})
-                bulk_character_response = requests.post(
-                    f"{PP_URL}/books/{self.book_id}/bulk_characters_update/",
-                    json={"characters": characters_payload},
-                    headers=AUTH_HEADER,
-                    verify=CERT_PATH,
+                return self._post_bulk(
+                    "bulk_characters_update",
+                    {"characters": characters_payload if serialized is None else serialized},
                 )
-                return bulk_character_response
-
-            for characters in chunks:
-                try:
-                    response = db_bulk_update(characters)
-                    logging.info({"Characters chunk updated": str(response)})
-                except Exception as ex:
-                    logging.error(f'Error in updating character chunk - {str(ex)}')
+
+            self._upload_character_chunks(db_bulk_update, "updated", chunks)
         except Exception as ex:
             logging.error(f'Error in updating characters - {str(ex)}')
             raise
 
+    def delete_removed(self):
+        """
+        Delete the records that were in the previous load but are gone from the Ocular output
+        """
+        if self.journal.is_done("deletions"):
+            return
+        uploader = AdaptiveUploader(self.max_workers)
+        for kind, collection in DELETE_ENDPOINTS:
+            removed = self.manifest.deleted(kind)
+            logging.info({f"Removed {kind} to delete": len(removed)})
+
+            def delete(record_id):
+                return self.client.delete(collection, record_id)
+
+            # characters go before the lines and pages they belong to, so each kind finishes before the next
+            for record_id, res, ex in uploader.map(delete, removed):
+                if ex is not None:
+                    raise ex
+                if res.status_code not in (200, 204, 404):
+                    raise Exception(f"Could not delete {kind} {record_id} - {res.status_code} {res.content}")
+        self.journal.mark_done("deletions")
+
 
 def main():
     logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
@@ -274,18 +778,138 @@ def main():
         help="Whether this is an update or not i.e. create",
         default=False,
     )
+    p.add_option(
+        "--chunk_bytes",
+        dest="chunk_bytes",
+        type="int",
+        help="Target size in bytes of the JSON body of each character chunk request",
+        default=DEFAULT_CHUNK_BYTES,
+    )
+    p.add_option(
+        "-d",
+        "--differential",
+        dest="differential",
+        action="store_true",
+        help="With --update, only send pages, lines and characters that changed since the last load, "
+             "and delete the ones that are gone",
+        default=False,
+    )
+    p.add_option(
+        "-r",
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Resume an interrupted load from its journal, skipping what the API already acknowledged",
+        default=False,
+    )
+    p.add_option(
+        "--columnar_cache",
+        dest="columnar_cache",
+        action="store_true",
+        help="Read the Ocular JSON through a columnar cache next to the JSON directory, compiling it if needed",
+        default=False,
+    )
+    p.add_option(
+        "--compress",
+        dest="compress",
+        choices=ENCODINGS,
+        help="Compress bulk request bodies with gzip or zstd (falls back to plain JSON if the server refuses)",
+        default=None,
+    )
+    p.add_option(
+        "--metrics_dir",
+        dest="metrics_dir",
+        help="Directory for the JSON and Prometheus textfile metrics of the load "
+             "(default: <json dir>.metrics next to the JSON directory)",
+        default=None,
+    )
+    p.add_option(
+        "--character_shards",
+        dest="character_shards",
+        type="int",
+        help="Load only the pages and lines (and create the character run), leaving the characters "
+             "to this many --shard tasks",
+        default=1,
+    )
+    p.add_option(
+        "--shard",
+        dest="shard",
+        help="Load only the characters, the chunks of shard INDEX/COUNT, into the character run of the "
+             "pages and lines job",
+        metavar="INDEX/COUNT",
+        default=None,
+    )
+    p.add_option(
+        "--run_id",
+        dest="run_id",
+        help="Character run to create characters in (default: from the journal)",
+        default=None,
+    )
+    p.add_option(
+        "--parse_processes",
+        dest="parse_processes",
+        type="int",
+        help="Processes that decode, normalize and serialize the characters "
+             "(default: one per core of the job, 1 reads them in this process)",
+        default=None,
+    )
+    p.add_option(
+        "--force",
+        dest="force",
+        action="store_true",
+        help="Load the Ocular output even if it is unchanged since its last completed load into the book",
+        default=False,
+    )
+    p.add_option(
+        "-w",
+        "--workers",
+        dest="workers",
+        type="int",
+        help="Maximum number of character chunk requests in flight (1 uploads sequentially)",
+        default=DEFAULT_MAX_WORKERS,
+    )
 
     (opt, sources) = p.parse_args()
+    if opt.differential and not opt.update:
+        p.error("--differential only applies to updates (-u)")
+    shard = None
+    if opt.shard is not None:
+        match = re.fullmatch(r"(\d+)/(\d+)", opt.shard)
+        if match is None or not int(match.group(1)) < int(match.group(2)):
+            p.error("--shard takes INDEX/COUNT with 0 <= INDEX < COUNT, e.g. 0/4")
+        shard = (int(match.group(1)), int(match.group(2)))
+    if opt.differential and (shard is not None or opt.character_shards > 1):
+        p.error("--differential cannot be combined with a sharded load")
+    if shard is not None and opt.character_shards > 1:
+        p.error("--shard and --character_shards are the two halves of a sharded load, give one")
 
     logging.info(f"Using {CERT_PATH} for SSL verification")
     logging.info(f"Book id {opt.book_id}")
     logging.info(f"JSON dir {opt.json}")
     logging.info(f"Update? - {opt.update}")
+    logging.info(f"Resume? - {opt.resume}")
+    logging.info(f"Differential? - {opt.differential}")
+    if shard is not None:
+        logging.info(f"Character shard - {shard[0]} of {shard[1]}")
+    elif opt.character_shards > 1:
+        logging.info(f"Characters left to {opt.character_shards} shards")
 
     pp_loader = BookLoader(
         book_id=opt.book_id,
         json_directory=opt.json,
-        update=opt.update
+        update=opt.update,
+        chunk_bytes=opt.chunk_bytes,
+        max_workers=opt.workers,
+        resume=opt.resume,
+        columnar_cache=opt.columnar_cache,
+        compress=opt.compress,
+        differential=opt.differential,
+        metrics_directory=opt.metrics_dir,
+        character_shards=opt.character_shards,
+        shard=shard,
+        run_id=opt.run_id,
+        parse_processes=opt.parse_processes,
+        force=opt.force,
     )
     pp_loader.load_db()
 
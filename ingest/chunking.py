@@ -0,0 +1,157 @@
+"""
+Size-aware chunking of bulk API payloads, re-sending of chunks rejected as too large in smaller
+pieces, and retrying of chunks the server failed on.
+"""
+
+import logging
+import random
+import time
+
+import requests
+
+try:
+    from .transport import dumps
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from transport import dumps
+
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024  # serialized JSON per bulk request
+SPLIT_STATUS_CODES = {413}
+MAX_SERVER_RETRIES = 4  # server errors in a row on one piece before the load stops
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+
+
+def record_size(record):
+    # serialized length plus the separator it takes up inside the array
+    return len(dumps(record)) + 2
+
+
+def serialize_in_chunks(records, max_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Serialize an iterable of records and group them into chunks whose serialized size stays under
+    max_bytes, yielding (records, texts) with the serialized JSON of every record. The chunk boundaries
+    are the same as those of chunk_by_bytes.
+    """
+    chunk = []
+    texts = []
+    size = 0
+    for record in records:
+        text = dumps(record)
+        record_bytes = len(text) + 2
+        if chunk and size + record_bytes > max_bytes:
+            yield chunk, texts
+            chunk = []
+            texts = []
+            size = 0
+        chunk.append(record)
+        texts.append(text)
+        size += record_bytes
+    if chunk:
+        yield chunk, texts
+
+
+def chunk_by_bytes(records, max_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Group an iterable of records into lists whose serialized size stays under max_bytes.
+    A single record larger than max_bytes is sent on its own.
+    """
+    for chunk, _ in serialize_in_chunks(records, max_bytes):
+        yield chunk
+
+
+class ServerErrors(Exception):
+    """
+    A piece of a chunk kept failing with server errors or timeouts, so the load should stop
+    rather than keep sending to a server that is down
+    """
+
+
+class ChunkOutcome:
+    """
+    What happened to one chunk after any splitting: records acknowledged by the API,
+    requests made, server errors/timeouts seen, pieces re-sent after a split or a server
+    error and the pieces that could not be sent.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.requests = 0
+        self.server_errors = 0
+        self.retries = 0
+        self.failed = []  # (records, reason)
+
+    @property
+    def failed_count(self):
+        return sum(len(records) for records, _ in self.failed)
+
+
+def _is_server_error(response, error):
+    if error is not None:
+        return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+    return response.status_code >= 500
+
+
+def _backoff(attempt, backoff_seconds):
+    # full jitter, so the chunks that failed together are not sent again together
+    time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, backoff_seconds * 2 ** attempt)))
+
+
+def send_with_split(post, records, on_sent=None, idempotent=True, max_retries=MAX_SERVER_RETRIES,
+                    backoff_seconds=BACKOFF_SECONDS):
+    """
+    Send records with post(records), which returns a requests response. When the server rejects
+    the body as too large, the records are split in half and each half is sent again, down to
+    single records. A 5xx, timeout or connection error is retried with jittered exponential
+    backoff, up to max_retries times in a row, after which ServerErrors is raised. Other failures
+    are not retried.
+
+    A post that is not idempotent, such as a bulk create, may have been applied by a server that
+    failed or timed out before answering, and sending it again could create the records twice.
+    Its server errors raise ServerErrors straight away.
+
+    on_sent(start, end), if given, is called for every acknowledged slice records[start:end].
+    """
+    outcome = ChunkOutcome()
+    remaining = [(0, records)]
+    attempt = 0  # server errors in a row for the piece at the top of remaining
+    while remaining:
+        offset, part = remaining[-1]
+        outcome.requests += 1
+        response = error = None
+        try:
+            response = post(part)
+        except Exception as ex:
+            error = ex
+        if error is None and 200 <= response.status_code < 300:
+            remaining.pop()
+            attempt = 0
+            outcome.sent += len(part)
+            if on_sent is not None:
+                on_sent(offset, offset + len(part))
+            continue
+        reason = str(error) if error is not None else f"{response.status_code} {response.content[:500]}"
+        if _is_server_error(response, error):
+            outcome.server_errors += 1
+            if not idempotent:
+                raise ServerErrors(f"Not sending {len(part)} records again after a server error, the server may "
+                                   f"have created them already - {reason}")
+            if attempt >= max_retries:
+                raise ServerErrors(f"Gave up on {len(part)} records after {attempt + 1} server errors - {reason}")
+            logging.info(f"Retrying chunk of {len(part)} records after failure - {reason}")
+            _backoff(attempt, backoff_seconds)
+            attempt += 1
+            outcome.retries += 1
+            continue
+        remaining.pop()
+        attempt = 0
+        if error is None and response.status_code in SPLIT_STATUS_CODES and len(part) > 1:
+            middle = len(part) // 2
+            logging.info(f"Splitting chunk of {len(part)} records after failure - {reason}")
+            outcome.retries += 2
+            # first half is popped and sent first
+            remaining.append((offset + middle, part[middle:]))
+            remaining.append((offset, part[:middle]))
+            continue
+        logging.error(f"Failed to send {len(part)} records - {reason}")
+        outcome.failed.append((part, reason))
+    return outcome
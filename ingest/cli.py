@@ -1,14 +1,48 @@
 import click
-from .ingest import run_command
+from .ingest import run_command, DEFAULT_CONCURRENT_LOADS
+from .batch import run_batch, read_manifest, entries_from_sheet, DEFAULT_RESOLVE_WORKERS
+from .daemon import enqueue
 
 
 @click.command()
-@click.option("--book_string", help="Book string", required=True)
+@click.option("--book_string", help="Book string", default=None, required=False)
 @click.option("--uuid", help="Existing book UUID", default=None, required=False)
 @click.option("--printer", help="Printer name", default=None, required=False)
 @click.option('--update', '-u', is_flag=True, help="Update/overwrite existing book run")
-def main(book_string, uuid, printer, update):
-    run_command(book_string, uuid, printer, update)
+@click.option("--manifest", help="Batch mode: file with one book string (and optional UUID) per line",
+              default=None, required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option("--pending_from_sheet", is_flag=True,
+              help="Batch mode: ingest every 'Pipeline Progress' row that has no UUID yet")
+@click.option("--workers", help="Books resolved concurrently in batch mode", default=DEFAULT_RESOLVE_WORKERS,
+              show_default=True)
+@click.option("--skip_validation", is_flag=True, help="Do not check the Ocular output before creating the book")
+@click.option("--concurrent_loads", type=click.IntRange(min=1), default=DEFAULT_CONCURRENT_LOADS, show_default=True,
+              help="Book loads Slurm may run at the same time, keep it the same for every ingest")
+@click.option("--force", is_flag=True, help="Queue the load even if the Ocular output is unchanged since its last load")
+@click.option("--spool", help="Hand the books to the ingest daemon serving this spool directory instead",
+              default=None, required=False, type=click.Path(file_okay=False))
+def main(book_string, uuid, printer, update, manifest, pending_from_sheet, workers, skip_validation,
+         concurrent_loads, force, spool):
+    if sum(bool(source) for source in (book_string, manifest, pending_from_sheet)) != 1:
+        raise click.UsageError("Give exactly one of --book_string, --manifest or --pending_from_sheet")
+    if spool is not None:
+        entries = [(book_string, uuid)] if book_string is not None else \
+            [(entry.book_string, entry.preexisting_uuid)
+             for entry in (read_manifest(manifest) if manifest is not None else entries_from_sheet())]
+        for entry_book_string, entry_uuid in entries:
+            request_id = enqueue(spool, entry_book_string, entry_uuid, printer, update,
+                                 validate=not skip_validation, force=force)
+            print("Queued", request_id)
+        return
+    if book_string is not None:
+        run_command(book_string, uuid, printer, update, validate=not skip_validation,
+                    concurrent_loads=concurrent_loads, force=force)
+        return
+    if uuid is not None:
+        raise click.UsageError("--uuid only applies to a single --book_string, put UUIDs in the manifest instead")
+    entries = read_manifest(manifest) if manifest is not None else entries_from_sheet()
+    run_batch(entries, printer, update, workers, validate=not skip_validation, concurrent_loads=concurrent_loads,
+              force=force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,394 @@
+"""
+Compact columnar cache of parsed Ocular JSON.
+
+An Ocular array (pages, lines or chars) is compiled once into a binary file with one column per
+record field: numbers and booleans as typed arrays, repeated strings (character classes, line and
+page ids) as indexes into a per-column string table, and mostly-unique strings as one UTF-8 blob
+with end offsets. Fields with both integers and floats are stored as doubles with a per-row tag of
+the integers, so they come back as the same type; fields whose values otherwise mix types are kept
+as interned JSON text. A mask column marks
+null and absent values where a field has any.
+
+Layout: MAGIC, the column blobs (8-byte aligned), the JSON header describing them, then a footer of
+header offset, header length and MAGIC. The file is memory-mapped for reading and records are only
+built as dicts when they are iterated. The header records the size, mtime and SHA-256 of the source
+file, and the cache is recompiled when the source content changes.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+try:
+    from .json_stream import iter_json_array
+    from .util import file_sha256, sidecar_path
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from json_stream import iter_json_array
+    from util import file_sha256, sidecar_path
+
+MAGIC = b"PPCOL001"
+FOOTER = struct.Struct("<QQ8s")
+FORMAT_VERSION = 2
+CACHE_SUFFIX = ".columnar"
+INTERN_LIMIT = 4096  # a string column with more distinct values than this and
+INTERN_RATIO = 0.5  # ... more than this share of its records is stored as text instead
+
+TYPECODES = {"int": "q", "float": "d", "bool": "b", "str": "I", "json": "I", "text": "Q"}
+PRESENT, NULL, MISSING = 0, 1, 2
+FLOAT_EXACT_LIMIT = 2 ** 53  # integers up to this size are exact as doubles
+_MISSING = object()
+
+
+def _kind_of(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    return "json"
+
+
+class _ColumnBuilder:
+    def __init__(self, name, leading):
+        self.name = name
+        self.kind = None
+        self.values = None
+        self.mask = array("B", [MISSING]) * leading if leading else None
+        self.pending = leading  # placeholders added before the kind was known
+        self.count = leading
+        self.strings = None  # interned value -> index
+        self.text = None  # UTF-8 blob for the text kind
+        self.ints = None  # per-row integer tag of a float column that also holds integers
+
+    def _flag(self, flag):
+        if self.mask is None:
+            self.mask = array("B", bytes(self.count))
+        self.mask.append(flag)
+
+    def _placeholder(self):
+        if self.kind is None:
+            self.pending += 1
+        elif self.kind == "text":
+            self.values.append(len(self.text))
+        else:
+            self.values.append(0)
+            if self.ints is not None:
+                self.ints.append(0)
+
+    def _start(self, kind):
+        self.kind = kind
+        self.values = array(TYPECODES[kind], [0]) * self.pending
+        if kind in ("str", "json"):
+            self.strings = {}
+
+    def _decoded(self):
+        # current values as Python objects, _MISSING for placeholders
+        table = list(self.strings) if self.strings is not None else None
+        for i in range(self.count):
+            if self.mask is not None and self.mask[i] != PRESENT:
+                yield _MISSING
+            elif self.kind == "bool":
+                yield bool(self.values[i])
+            elif self.kind == "str":
+                yield table[self.values[i]]
+            elif self.kind == "json":
+                yield json.loads(table[self.values[i]])
+            elif self.kind == "text":
+                yield self.text[self.values[i - 1] if i else 0:self.values[i]].decode("utf-8")
+            elif self.ints is not None and self.ints[i]:
+                yield int(self.values[i])
+            else:
+                yield self.values[i]
+
+    def _to_json(self):
+        old = list(self._decoded())
+        self.kind = "json"
+        self.strings = {}
+        self.text = None
+        self.ints = None
+        self.values = array("I")
+        for value in old:
+            self.values.append(0 if value is _MISSING else self.strings.setdefault(json.dumps(value), len(self.strings)))
+
+    def _to_float(self, value):
+        # an int column that met a float or a float column that met an int, kept numeric with the
+        # integers tagged unless one would lose precision as a float
+        if self.kind == "float":
+            if abs(value) > FLOAT_EXACT_LIMIT:
+                return False
+            if self.ints is None:
+                self.ints = array("B", bytes(len(self.values)))
+            return True
+        if any(abs(old) > FLOAT_EXACT_LIMIT for old in self.values):
+            return False
+        self.kind = "float"
+        self.ints = array("B", [1]) * len(self.values)
+        self.values = array("d", self.values)
+        return True
+
+    def _to_text(self):
+        old = list(self._decoded())
+        self.kind = "text"
+        self.strings = None
+        self.text = bytearray()
+        self.values = array("Q")
+        for value in old:
+            if value is not _MISSING:
+                self.text.extend(value.encode("utf-8"))
+            self.values.append(len(self.text))
+
+    def _append_value(self, value):
+        if self.kind == "str":
+            self.values.append(self.strings.setdefault(value, len(self.strings)))
+        elif self.kind == "text":
+            self.text.extend(value.encode("utf-8"))
+            self.values.append(len(self.text))
+        elif self.kind == "json":
+            self.values.append(self.strings.setdefault(json.dumps(value), len(self.strings)))
+        else:
+            self.values.append(value)
+            if self.ints is not None:
+                self.ints.append(isinstance(value, int))
+
+    def add(self, value):
+        if value is _MISSING or value is None:
+            self._flag(MISSING if value is _MISSING else NULL)
+            self._placeholder()
+            self.count += 1
+            return
+        kind = _kind_of(value)
+        if self.kind is None:
+            self._start(kind)
+        elif kind != self.kind and not (self.kind == "text" and kind == "str") and self.kind != "json":
+            if not ({kind, self.kind} == {"int", "float"} and self._to_float(value)):
+                self._to_json()
+        try:
+            self._append_value(value)
+        except OverflowError:
+            # an integer too large for int64
+            self._to_json()
+            self._append_value(value)
+        if self.mask is not None:
+            self.mask.append(PRESENT)
+        self.count += 1
+        if self.kind == "str" and len(self.strings) > INTERN_LIMIT and len(self.strings) > INTERN_RATIO * self.count:
+            self._to_text()
+
+
+def _write_blob(f, data):
+    # returns [offset, length] of the blob, written 8-byte aligned
+    padding = -f.tell() % 8
+    f.write(b"\0" * padding)
+    offset = f.tell()
+    f.write(data)
+    return [offset, len(data)]
+
+
+def compile_columnar(source_path, key, dest_path, sha256=None):
+    """
+    Compile the array `key` of the JSON file at source_path into a columnar file at dest_path
+    """
+    stat = os.stat(source_path)
+    builders = {}
+    count = 0
+    for record in iter_json_array(source_path, key):
+        for name, value in record.items():
+            builder = builders.get(name)
+            if builder is None:
+                builder = builders[name] = _ColumnBuilder(name, count)
+            builder.add(value)
+        count += 1
+        for builder in builders.values():
+            if builder.count < count:
+                builder.add(_MISSING)
+
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    columns = []
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for builder in builders.values():
+            kind = builder.kind or "json"  # a column that only ever held null
+            values = builder.values if builder.values is not None else array("I", [0]) * builder.count
+            column = {"name": builder.name, "kind": kind, "values": _write_blob(f, values.tobytes())}
+            if builder.mask is not None:
+                column["mask"] = _write_blob(f, builder.mask.tobytes())
+            if builder.strings is not None:
+                column["strings"] = _write_blob(f, json.dumps(list(builder.strings)).encode("utf-8"))
+            if builder.text is not None:
+                column["text"] = _write_blob(f, bytes(builder.text))
+            if builder.ints is not None:
+                column["ints"] = _write_blob(f, builder.ints.tobytes())
+            columns.append(column)
+        header = {
+            "version": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "key": key,
+            "count": count,
+            "source": {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256 or file_sha256(source_path)},
+            "columns": columns,
+        }
+        _write_header(f, header)
+    os.replace(tmp_path, dest_path)
+    logging.info(f"Compiled {count} {key} from {source_path} into {dest_path}")
+
+
+def _write_header(f, header):
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset, length = _write_blob(f, header_bytes)
+    f.write(FOOTER.pack(offset, length, MAGIC))
+    f.truncate()
+
+
+def _read_header(mm):
+    offset, length, magic = FOOTER.unpack(mm[-FOOTER.size:])
+    if magic != MAGIC or mm[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a columnar cache file")
+    return json.loads(mm[offset:offset + length].decode("utf-8")), offset
+
+
+class ColumnarTable:
+    """
+    Read-only, memory-mapped view of a columnar file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header, self._header_offset = _read_header(self._mm)
+        if self.header["version"] != FORMAT_VERSION or self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written in an incompatible format")
+        self.count = self.header["count"]
+        self.source = self.header["source"]
+        self._view = memoryview(self._mm)
+        self._columns = {}
+        for column in self.header["columns"]:
+            self._columns[column["name"]] = {
+                "kind": column["kind"],
+                "values": self._blob(column["values"]).cast(TYPECODES[column["kind"]]),
+                "mask": self._blob(column["mask"]) if "mask" in column else None,
+                "strings": json.loads(bytes(self._blob(column["strings"]))) if "strings" in column else None,
+                "text": self._blob(column["text"]) if "text" in column else None,
+                "ints": self._blob(column["ints"]) if "ints" in column else None,
+            }
+
+    def _blob(self, location):
+        offset, length = location
+        return self._view[offset:offset + length]
+
+    def close(self):
+        self._columns = {}
+        try:
+            self._view.release()
+            self._mm.close()
+        except BufferError:
+            # records are still being iterated somewhere, the mapping goes when they do
+            pass
+        self._file.close()
+
+    def strings(self, name):
+        """
+        The interned string table of a column, or None if the column is not interned strings
+        """
+        column = self._columns.get(name)
+        if column is None or column["kind"] != "str":
+            return None
+        return column["strings"]
+
+    def map_strings(self, name, func):
+        """
+        Replace every value of an interned string column by func(value), touching each
+        distinct value once instead of every record
+        """
+        column = self._columns[name]
+        column["strings"] = [func(value) for value in column["strings"]]
+
+    def _getter(self, column):
+        kind = column["kind"]
+        values = column["values"]
+        if kind == "str":
+            strings = column["strings"]
+            get = lambda i: strings[values[i]]
+        elif kind == "json":
+            strings = column["strings"]
+            get = lambda i: json.loads(strings[values[i]])
+        elif kind == "text":
+            text = column["text"]
+            get = lambda i: str(text[values[i - 1] if i else 0:values[i]], "utf-8")
+        elif kind == "bool":
+            get = lambda i: bool(values[i])
+        elif column["ints"] is not None:
+            ints = column["ints"]
+            get = lambda i: int(values[i]) if ints[i] else values[i]
+        else:
+            get = values.__getitem__
+        mask = column["mask"]
+        if mask is None:
+            return get
+        return lambda i: get(i) if mask[i] == PRESENT else (None if mask[i] == NULL else _MISSING)
+
+    def iter_records(self, start=0, stop=None):
+        """
+        Build records as dicts, one at a time, for rows [start, stop)
+        """
+        getters = [(name, self._getter(column)) for name, column in self._columns.items()]
+        for i in range(start, self.count if stop is None else min(stop, self.count)):
+            record = {}
+            for name, get in getters:
+                value = get(i)
+                if value is not _MISSING:
+                    record[name] = value
+            yield record
+
+
+def _source_matches(path, source, stat):
+    """
+    Whether the cached file at path still describes the source, refreshing its recorded mtime
+    when the source was touched without changing
+    """
+    if (source["size"], source["mtime"]) == (stat.st_size, stat.st_mtime):
+        return True
+    if source["size"] != stat.st_size:
+        return False
+    return source["sha256"] == file_sha256(path)
+
+
+def open_columnar(source_path, key, cache_directory):
+    """
+    Open the columnar cache of source_path, compiling it first if it is missing or out of date
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    dest_path = os.path.join(cache_directory, f"{key}.col")
+    stat = os.stat(source_path)
+    if os.path.exists(dest_path):
+        try:
+            table = ColumnarTable(dest_path)
+        except (ValueError, OSError, struct.error) as ex:
+            logging.info(f"Ignoring unreadable columnar cache {dest_path} - {str(ex)}")
+        else:
+            if table.header["key"] == key and _source_matches(source_path, table.source, stat):
+                if table.source["mtime"] != stat.st_mtime:
+                    _refresh_source_mtime(table, dest_path, stat)
+                return table
+            table.close()
+    compile_columnar(source_path, key, dest_path)
+    return ColumnarTable(dest_path)
+
+
+def _refresh_source_mtime(table, dest_path, stat):
+    # rewrite only the header so the next open skips hashing the unchanged source
+    header = dict(table.header, source=dict(table.source, mtime=stat.st_mtime))
+    with open(dest_path, "r+b") as f:
+        f.seek(table._header_offset)
+        _write_header(f, header)
+
+
+def cache_directory_for(json_directory):
+    return sidecar_path(json_directory, CACHE_SUFFIX)
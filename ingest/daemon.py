@@ -0,0 +1,277 @@
+"""
+Long-running ingest service that keeps what every ingest needs warm between books.
+
+chewfiles pays for Python start-up, Google authorization, the ESTC/VID index, TLS handshakes to
+the API and, when loading, the character-class registry on every invocation. The daemon does
+that once: the sheet snapshot (refreshed every SHEET_REFRESH_SECONDS), the index, the pooled API
+client and the character classes stay in memory, and each request only does the lookups, sheet
+update and submission or load of its own book.
+
+Requests are JSON files in a spool directory, written by `chewfiles --spool DIR` (see enqueue):
+
+    incoming/    requests waiting, taken in name (i.e. submission) order
+    processing/  requests being worked on, put back into incoming/ when the daemon restarts
+    done/        finished requests, each with a .log of its output
+    failed/      requests that stopped with an error, each with a .log of its output
+
+A bounded pool of workers runs run_command for the requests. A book has at most one request in
+flight: later requests for it wait in incoming/ until the earlier one finished. With --load_here,
+requests whose book strings differ but resolve to the same book also load it one at a time, and the
+cores are divided between the workers' parse processes.
+"""
+import concurrent.futures
+import contextvars
+import datetime
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import click
+
+from .ingest import run_command, _get_estc_vid_index, DEFAULT_CONCURRENT_LOADS
+from .sheets.sheet import get_snapshot
+from .api_client import get_client
+from .bulk_load_json import BookLoader, CharacterClasses
+from .parallel_parse import available_cpus
+
+SPOOL_DIRECTORIES = ('incoming', 'processing', 'done', 'failed')
+DEFAULT_DAEMON_WORKERS = 4
+POLL_SECONDS = 2.0
+SHEET_REFRESH_SECONDS = 10 * 60  # edits made by hand show up after at most this long
+
+
+def _spool_path(spool_directory, state, name=''):
+    return os.path.join(spool_directory, state, name)
+
+
+def enqueue(spool_directory, book_string, uuid=None, printer=None, update=False, validate=True, force=False):
+    """
+    Queue an ingest request for the daemon serving spool_directory. Returns the request id.
+    """
+    incoming = _spool_path(spool_directory, 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    request_id = '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f'),
+                                re.sub(r'[^\w.-]', '_', book_string))
+    request = {'book_string': book_string, 'uuid': uuid, 'printer': printer, 'update': update,
+               'validate': validate, 'force': force}
+    # written under another name and renamed, so the daemon never reads a partial request
+    tmp_path = os.path.join(incoming, '.{}.tmp'.format(request_id))
+    with open(tmp_path, 'w') as f:
+        json.dump(request, f)
+    os.replace(tmp_path, os.path.join(incoming, request_id + '.json'))
+    return request_id
+
+
+# log file of the request being worked on. Lookups, pipeline stages and uploads run in the context
+# of the code that started them, so their output follows the request onto their threads.
+_request_log = contextvars.ContextVar('request_log', default=None)
+
+
+class _RequestOutput:
+    """
+    Stand-in for sys.stdout, and the stream of the log handler, that sends what is printed or
+    logged for a request to the request's log
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return (_request_log.get() or self.stream).write(text)
+
+    def flush(self):
+        (_request_log.get() or self.stream).flush()
+
+
+def _invalid_request(request):
+    """
+    Why a request read from the spool cannot be worked on, or None if it can
+    """
+    if not isinstance(request, dict):
+        return 'not a JSON object'
+    if not isinstance(request.get('book_string'), str) or not request['book_string']:
+        return 'no book_string'
+    return None
+
+
+class IngestDaemon:
+    def __init__(self, spool_directory, workers=DEFAULT_DAEMON_WORKERS, concurrent_loads=DEFAULT_CONCURRENT_LOADS,
+                 load_here=False, poll_seconds=POLL_SECONDS, parse_processes=None):
+        self.spool_directory = spool_directory
+        self.workers = workers
+        self.concurrent_loads = concurrent_loads
+        self.load_here = load_here
+        self.poll_seconds = poll_seconds
+        # parse processes of each load, so that the loads of all workers together fit the cores
+        self.parse_processes = parse_processes or max(1, available_cpus() // workers)
+        self.character_classes = None
+        self._snapshot_time = 0
+        self._active = {}  # book string -> request id
+        self._book_locks = {}  # book UUID -> lock held while the book loads
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._output = _RequestOutput(sys.stdout)
+
+    def log(self, message):
+        self._output.stream.write('{} {}\n'.format(datetime.datetime.now().isoformat(timespec='seconds'), message))
+        self._output.stream.flush()
+
+    def warm_up(self):
+        start = time.monotonic()
+        for state in SPOOL_DIRECTORIES:
+            os.makedirs(_spool_path(self.spool_directory, state), exist_ok=True)
+        self._refresh_snapshot()
+        _get_estc_vid_index().get_many([])
+        get_client()
+        if self.load_here:
+            self.character_classes = CharacterClasses()
+            self.character_classes.load_character_classes()
+        self.log('Caches warm after {:.1f}s'.format(time.monotonic() - start))
+
+    def _refresh_snapshot(self):
+        if time.monotonic() - self._snapshot_time < SHEET_REFRESH_SECONDS:
+            return
+        # the Google authorization is kept, only the worksheets are read again
+        get_snapshot(refresh=True)
+        self._snapshot_time = time.monotonic()
+
+    def recover(self):
+        """
+        Put back the requests a previous daemon was working on when it stopped
+        """
+        for name in os.listdir(_spool_path(self.spool_directory, 'processing')):
+            if name.endswith('.json'):
+                self.log('Requeueing {}'.format(name))
+                os.replace(_spool_path(self.spool_directory, 'processing', name),
+                           _spool_path(self.spool_directory, 'incoming', name))
+
+    def _claim(self):
+        """
+        Move the oldest waiting requests whose book has no request in flight to processing/,
+        as many as there are idle workers
+        """
+        claimed = []
+        incoming = _spool_path(self.spool_directory, 'incoming')
+        for name in sorted(os.listdir(incoming)):
+            with self._lock:
+                if len(self._active) >= self.workers:
+                    break
+            if not name.endswith('.json'):
+                continue
+            request_id = name[:-len('.json')]
+            try:
+                with open(os.path.join(incoming, name)) as f:
+                    request = json.load(f)
+            except (OSError, ValueError) as ex:
+                request, error = None, 'unreadable - {}'.format(ex)
+            else:
+                error = _invalid_request(request)
+            if error is not None:
+                self.log('Invalid request {} - {}'.format(name, error))
+                os.replace(os.path.join(incoming, name), _spool_path(self.spool_directory, 'failed', name))
+                continue
+            with self._lock:
+                if request['book_string'] in self._active:
+                    continue
+                self._active[request['book_string']] = request_id
+            os.replace(os.path.join(incoming, name), _spool_path(self.spool_directory, 'processing', name))
+            claimed.append((request_id, request))
+        return claimed
+
+    def _load(self, book_uuid, json_directory, update, force):
+        # another book string, or a request with an explicit UUID, may resolve to the same book
+        with self._lock:
+            book_lock = self._book_locks.setdefault(book_uuid, threading.Lock())
+        if not book_lock.acquire(blocking=False):
+            print('Waiting for the other load of book {} to finish'.format(book_uuid))
+            book_lock.acquire()
+        try:
+            BookLoader(book_uuid, json_directory, update=update, force=force, parse_processes=self.parse_processes,
+                       character_classes=self.character_classes).load_db()
+        finally:
+            book_lock.release()
+
+    def _process(self, request_id, request):
+        state = 'failed'
+        log_path = _spool_path(self.spool_directory, 'processing', request_id + '.log')
+        start = time.monotonic()
+        try:
+            with open(log_path, 'w') as log_file:
+                token = _request_log.set(log_file)
+                try:
+                    run_command(request['book_string'], request.get('uuid'), request.get('printer'),
+                                request.get('update', False), validate=request.get('validate', True),
+                                concurrent_loads=self.concurrent_loads, force=request.get('force', False),
+                                load=self._load if self.load_here else None)
+                    state = 'done'
+                except SystemExit:
+                    # the single-book path exits on invalid output and unrecoverable lookups
+                    print('Stopped, see the output above')
+                except Exception:
+                    traceback.print_exc(file=log_file)
+                finally:
+                    _request_log.reset(token)
+        finally:
+            for suffix in ('.json', '.log'):
+                source = _spool_path(self.spool_directory, 'processing', request_id + suffix)
+                if os.path.exists(source):
+                    os.replace(source, _spool_path(self.spool_directory, state, request_id + suffix))
+            with self._lock:
+                del self._active[request['book_string']]
+            self.log('{} {} in {:.1f}s'.format(request_id, state, time.monotonic() - start))
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def serve(self):
+        sys.stdout = self._output
+        try:
+            # what the loader logs, with --load_here, also goes to the log of the request
+            logging.basicConfig(stream=self._output, format="%(asctime)s %(message)s", level=logging.INFO)
+            self.warm_up()
+            self.recover()
+            self.log('Serving {} with {} workers'.format(self.spool_directory, self.workers))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                       thread_name_prefix='ingest') as executor:
+                while not self._stop.is_set():
+                    claimed = self._claim()
+                    if claimed:
+                        self._refresh_snapshot()
+                    for request_id, request in claimed:
+                        self.log('{} started - {}'.format(request_id, request['book_string']))
+                        executor.submit(self._process, request_id, request)
+                    self._stop.wait(self.poll_seconds)
+                self.log('Stopping, waiting for the requests in flight')
+        finally:
+            sys.stdout = self._output.stream
+
+
+@click.command()
+@click.option("--spool", "spool_directory", required=True, type=click.Path(file_okay=False),
+              help="Spool directory the requests are queued in, see chewfiles --spool")
+@click.option("--workers", type=click.IntRange(min=1), default=DEFAULT_DAEMON_WORKERS, show_default=True,
+              help="Requests worked on at the same time")
+@click.option("--concurrent_loads", type=click.IntRange(min=1), default=DEFAULT_CONCURRENT_LOADS, show_default=True,
+              help="Book loads Slurm may run at the same time, keep it the same for every ingest")
+@click.option("--load_here", is_flag=True,
+              help="Load the books in the daemon instead of submitting Slurm jobs, e.g. inside a job allocation")
+@click.option("--poll_seconds", type=float, default=POLL_SECONDS, show_default=True,
+              help="Interval at which the spool directory is checked for new requests")
+@click.option("--parse_processes", type=click.IntRange(min=1), default=None,
+              help="Processes preparing the characters of each load with --load_here  [default: cores / workers]")
+def main(spool_directory, workers, concurrent_loads, load_here, poll_seconds, parse_processes):
+    """Serve ingest requests queued in a spool directory until interrupted."""
+    daemon = IngestDaemon(spool_directory, workers, concurrent_loads, load_here, poll_seconds, parse_processes)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.serve()
+
+
+if __name__ == "__main__":
+    main()
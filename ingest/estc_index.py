@@ -0,0 +1,99 @@
+"""
+Persistent SQLite index of the ESTC number -> VID lookup CSV.
+
+The index is rebuilt from the CSV whenever the CSV changes: its size and mtime are checked
+on every open, and when those differ the content hash decides whether a rebuild is needed.
+"""
+import os
+import sqlite3
+import threading
+from csv import DictReader
+
+from .util import file_sha256
+
+INDEX_SUFFIX = '.sqlite'
+FALLBACK_INDEX_DIR = os.path.expanduser('~/.cache/ingest-book')
+SQLITE_MAX_VARIABLES = 500
+
+
+def _default_index_path(csv_path):
+    # keep the index next to the CSV so it is shared, unless that directory is read-only
+    if os.access(os.path.dirname(os.path.abspath(csv_path)), os.W_OK):
+        return csv_path + INDEX_SUFFIX
+    os.makedirs(FALLBACK_INDEX_DIR, exist_ok=True)
+    return os.path.join(FALLBACK_INDEX_DIR, os.path.basename(csv_path) + INDEX_SUFFIX)
+
+
+class EstcVidIndex:
+    def __init__(self, csv_path, index_path=None):
+        self.csv_path = csv_path
+        self.index_path = index_path or _default_index_path(csv_path)
+        self._lock = threading.Lock()
+        self._db = None
+        self._source_stat = None
+
+    def _stored_source(self, db):
+        try:
+            row = db.execute('SELECT mtime, size, sha256 FROM source').fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        return row
+
+    def _build(self, sha256):
+        print('Building ESTC/VID index from', self.csv_path)
+        stat = os.stat(self.csv_path)
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db = sqlite3.connect(tmp_path)
+        db.execute('CREATE TABLE source (mtime REAL, size INTEGER, sha256 TEXT)')
+        db.execute('CREATE TABLE vids (estc TEXT PRIMARY KEY, vid TEXT)')
+        with open(self.csv_path) as csvfile:
+            # the first row for an ESTC number wins, as it did with the linear scan
+            db.executemany('INSERT OR IGNORE INTO vids VALUES (?, ?)',
+                           ((row['estcNO'], row.get('VID')) for row in DictReader(csvfile)))
+        db.execute('INSERT INTO source VALUES (?, ?, ?)', (stat.st_mtime, stat.st_size, sha256))
+        db.commit()
+        db.close()
+        # atomic swap so concurrent readers never see a half-built index
+        os.replace(tmp_path, self.index_path)
+
+    def _open(self):
+        stat = os.stat(self.csv_path)
+        if self._db is not None:
+            if self._source_stat == (stat.st_mtime, stat.st_size):
+                return self._db
+            self._db.close()
+        db = sqlite3.connect(self.index_path, check_same_thread=False) if os.path.exists(self.index_path) else None
+        stored = self._stored_source(db) if db is not None else None
+        if stored is None or (stored[0], stored[1]) != (stat.st_mtime, stat.st_size):
+            sha256 = file_sha256(self.csv_path)
+            if stored is not None and stored[2] == sha256:
+                # touched but unchanged, remember the new mtime
+                db.execute('UPDATE source SET mtime = ?, size = ?', (stat.st_mtime, stat.st_size))
+                db.commit()
+            else:
+                if db is not None:
+                    db.close()
+                self._build(sha256)
+                db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._db = db
+        self._source_stat = (stat.st_mtime, stat.st_size)
+        return db
+
+    def get(self, estc_number):
+        return self.get_many([estc_number]).get(estc_number)
+
+    def get_many(self, estc_numbers):
+        """
+        Look up several ESTC numbers at once. Returns a dict of the ones that were found.
+        """
+        estc_numbers = list(dict.fromkeys(estc_numbers))
+        found = {}
+        with self._lock:
+            db = self._open()
+            for i in range(0, len(estc_numbers), SQLITE_MAX_VARIABLES):
+                batch = estc_numbers[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ','.join('?' * len(batch))
+                found.update(db.execute('SELECT estc, vid FROM vids WHERE estc IN ({})'.format(placeholders), batch))
+        return found
@@ -0,0 +1,49 @@
+"""
+On-disk cache of ESTC catalogue records.
+
+Each record is kept as one JSON file holding the raw HTML of both catalogue pages and the
+fields extracted from them, so records can be re-parsed later without going back to the catalogue.
+"""
+import json
+import os
+import time
+
+ESTC_CACHE_DIR = os.environ.get('ESTC_CACHE_DIR', os.path.expanduser('~/.cache/ingest-book/estc'))
+ESTC_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+
+
+class EstcCache:
+    def __init__(self, directory=ESTC_CACHE_DIR, ttl=ESTC_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, estc_number):
+        return os.path.join(self.directory, '{}.json'.format(estc_number))
+
+    def get(self, estc_number, allow_stale=False):
+        """
+        The cached entry for an ESTC number, or None if there is none or it is older than the TTL
+        """
+        try:
+            with open(self._path(estc_number)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not allow_stale and time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry
+
+    def put(self, estc_number, record_html, entry_html, fields):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {
+            'estc': estc_number,
+            'fetched': time.time(),
+            'record_html': record_html,
+            'entry_html': entry_html,
+            'fields': fields,
+        }
+        path = self._path(estc_number)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,29 @@
+import click
+from .estc import prefetch
+
+
+@click.command()
+@click.argument("estc_numbers", nargs=-1)
+@click.option("--file", "numbers_file", help="File with one ESTC number or book string per line", default=None,
+              required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", help="Parallel fetches", default=4, show_default=True)
+@click.option("--rate", help="Maximum fetches per second", default=2.0, show_default=True)
+@click.option("--refresh", is_flag=True, help="Fetch again even if the cached record is still fresh")
+def main(estc_numbers, numbers_file, workers, rate, refresh):
+    """Warm the ESTC record cache for the given ESTC numbers."""
+    numbers = list(estc_numbers)
+    if numbers_file is not None:
+        with open(numbers_file) as f:
+            for line in f:
+                value = line.strip()
+                if value:
+                    # book strings carry the ESTC number as their second part
+                    numbers.append(value.split('_')[1] if '_' in value else value)
+    failures = prefetch(numbers, workers=workers, rate=rate, refresh=refresh)
+    for estc_number, error in failures.items():
+        print("Failed to fetch", estc_number, "-", error)
+    print("{} ESTC records cached, {} failed".format(len(set(numbers)) - len(failures), len(failures)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,49 @@
-from bs4 import BeautifulSoup
-from functools import partial
-import urllib.request
+from bs4 import BeautifulSoup, SoupStrainer
+import concurrent.futures
+import threading
+import time
 from urllib.parse import parse_qs, urlencode, urlsplit
 
+import requests
+
+from .cache import EstcCache
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+ESTC_REQUEST_TIMEOUT = 30  # seconds
+
 columns = ["ESTC No.", "Title", "Author", "Publisher Info", "Description", "Locations", "General Notes", "Citation/Ref. Notes", "Electronic Location"]
 text_queries = ["ESTC Citation No.", "Main Title", "ME-Personal Name", "Imprint", "Phys.Description", "Location",
                 "General Note", "Citation/Ref. Note", "Electronic Location"]
 
 
-def _query_html(soup: BeautifulSoup, field: str) -> str:
-    # find all values containing query field
-    all_text = soup.find_all('td', string=field)
-    values = []
-    for text in all_text:
-        value = text.find_next_sibling("td").text.strip()
-        if value is not None and value != 'nan':
-            value = value.replace('\xa0', ' ')
-            values.append(value)
-        else:
-            values.append('')
-    return '\t---\t'.join(values)
+_local = threading.local()
+
+
+def _session():
+    # one keep-alive session per thread, so both requests for a record reuse a connection
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
 
 
 def _read_url(url: str):
-    fp = urllib.request.urlopen(url)
-    url_bytes = fp.read()
+    response = _session().get(url, timeout=ESTC_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.content.decode("utf8")
 
-    html_string = url_bytes.decode("utf8")
-    fp.close()
-    return html_string
 
+def _record_url(estc_number: str):
+    return "http://estc.bl.uk/{}".format(estc_number)
 
-def _estc_url(estc_number: str):
-    print("Fetching information for ESTC number:", estc_number)
-    url = "http://estc.bl.uk/{}".format(estc_number)
-    html = _read_url(url)
-    soup = BeautifulSoup(html, 'html.parser')
+
+def _entry_url(record_html: str):
+    # link to the full (format 002) view of the record
+    soup = BeautifulSoup(record_html, HTML_PARSER, parse_only=SoupStrainer('a'))
     el = soup.select_one("a[href*=set_entry]")
     href = el.get('href')
     parsed = urlsplit(href)
@@ -47,15 +55,101 @@ def _estc_url(estc_number: str):
     return url_new
 
 
-def est_info_for_number(estc_number: str) -> dict:
-    url = _estc_url(estc_number)
-    html = _read_url(url)
-    # text_file = open("test.html", "r")
-    # html = text_file.read()
-    soup = BeautifulSoup(html, "html.parser")
-    _do_query = partial(_query_html, soup)
+def fetch_estc_pages(estc_number: str):
+    """
+    Raw HTML of the record page and of its full (format 002) view
+    """
+    print("Fetching information for ESTC number:", estc_number)
+    record_html = _read_url(_record_url(estc_number))
+    entry_html = _read_url(_entry_url(record_html))
+    return record_html, entry_html
+
+
+def _clean_value(td) -> str:
+    value = td.text.strip() if td is not None else ''
+    if value == 'nan':
+        return ''
+    return value.replace('\xa0', ' ')
+
+
+def parse_estc_fields(entry_html: str) -> dict:
+    """
+    Extract all fields in one pass over the table rows of the full record view.
+    A field that appears in several rows has all of its values joined.
+    """
+    # only table rows are built into the tree, the rest of the page is skipped by the parser
+    soup = BeautifulSoup(entry_html, HTML_PARSER, parse_only=SoupStrainer('tr'))
+    wanted = set(text_queries)
+    found = {query: [] for query in text_queries}
+    for td in soup.find_all('td'):
+        label = td.string
+        if label in wanted:
+            found[label].append(_clean_value(td.find_next_sibling('td')))
+    return {column: '\t---\t'.join(found[query]) for column, query in zip(columns, text_queries)}
+
+
+_cache = EstcCache()
+
+
+def est_info_for_number(estc_number: str, refresh: bool = False) -> dict:
+    """
+    Parsed ESTC record, served from the on-disk cache while it is fresh. When the catalogue
+    cannot be reached, a stale cached record is used rather than failing.
+    """
+    if not refresh:
+        entry = _cache.get(estc_number)
+        if entry is not None:
+            return entry['fields']
+    try:
+        record_html, entry_html = fetch_estc_pages(estc_number)
+    except Exception as ex:
+        entry = _cache.get(estc_number, allow_stale=True)
+        if entry is None:
+            raise
+        print("ESTC lookup failed ({}), using cached record from {}".format(ex, time.ctime(entry['fetched'])))
+        return entry['fields']
+    fields = parse_estc_fields(entry_html)
+    _cache.put(estc_number, record_html, entry_html, fields)
+    return fields
+
+
+class _RateLimiter:
+    """
+    Spaces out calls from several threads to at most `rate` per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def prefetch(estc_numbers, workers=4, rate=2.0, refresh=False):
+    """
+    Warm the cache for many ESTC numbers with parallel, rate-limited fetches.
+    Returns a dict of ESTC number to the error for the numbers that could not be fetched.
+    """
+    limiter = _RateLimiter(rate)
+    todo = [number for number in dict.fromkeys(estc_numbers) if refresh or _cache.get(number) is None]
+    print("{} of {} ESTC records need fetching".format(len(todo), len(set(estc_numbers))))
+
+    def fetch(estc_number):
+        limiter.wait()
+        record_html, entry_html = fetch_estc_pages(estc_number)
+        _cache.put(estc_number, record_html, entry_html, parse_estc_fields(entry_html))
 
-    df_values = {}
-    for column, query in zip(columns, text_queries):
-        df_values[column] = _do_query(query)
-    return df_values
+    failures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, number): number for number in todo}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                failures[futures[future]] = future.exception()
+    return failures
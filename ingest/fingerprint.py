@@ -0,0 +1,109 @@
+"""
+Fingerprints of the Ocular output of a book, so that output which is already loaded is not loaded again.
+
+The fingerprint of a JSON directory is the SHA-256, size and modification time of pages.json, lines.json and
+chars.json. A new load takes it when it starts and keeps it in its journal. The job that completes the load records
+it next to the JSON directory (<json dir>.fingerprint), together with the book, the character run and the record
+counts. ingest.py does not queue a load, and the loader stops before reading anything, while the output still has
+the recorded hashes for the same book and the run still exists. A file whose size and modification time did not
+change keeps its recorded hash, so checking an unchanged book is a stat per file.
+"""
+
+import datetime
+import json
+import logging
+import os
+
+try:
+    from .util import file_sha256, sidecar_path
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from util import file_sha256, sidecar_path
+
+FINGERPRINT_SUFFIX = ".fingerprint"
+ARRAYS = ("pages", "lines", "chars")
+
+
+def fingerprint_path(json_directory):
+    return sidecar_path(json_directory, FINGERPRINT_SUFFIX)
+
+
+def read_record(json_directory):
+    """
+    The recorded load of the Ocular output in json_directory, or None
+    """
+    try:
+        with open(fingerprint_path(json_directory), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fingerprint(json_directory, previous=None):
+    """
+    {array: {"size", "mtime_ns", "sha256"}} of the Ocular output, reusing the hashes of a previous fingerprint for
+    the files whose size and modification time are the same
+    """
+    files = {}
+    for array in ARRAYS:
+        path = f"{json_directory}/{array}.json"
+        stat = os.stat(path)
+        known = (previous or {}).get(array)
+        if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            sha256 = known["sha256"]
+        else:
+            sha256 = file_sha256(path)
+        files[array] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+    return files
+
+
+def same_content(files, other):
+    return all(files[array]["sha256"] == other[array]["sha256"] for array in ARRAYS)
+
+
+def completed_load(json_directory, book_id, counts=None):
+    """
+    The record of the last completed load of the Ocular output in json_directory if it loaded into book_id and the
+    output has not changed since, otherwise None. counts, if given, map arrays to their number of records and are
+    compared before any file is hashed.
+    """
+    record = read_record(json_directory)
+    if record is None or record.get("book_id") != book_id:
+        return None
+    recorded_counts = record.get("counts") or {}
+    if any(recorded_counts.get(array, count) != count for array, count in (counts or {}).items()):
+        return None
+    try:
+        if not same_content(fingerprint(json_directory, record["files"]), record["files"]):
+            return None
+    except OSError:
+        return None
+    return record
+
+
+def record_load(json_directory, book_id, character_run_id, files, counts):
+    """
+    Record a completed load of the Ocular output with the fingerprint `files` taken when it started
+    """
+    record = {
+        "book_id": book_id,
+        "character_run": character_run_id,
+        "files": files,
+        "counts": counts,
+        "loaded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    path = fingerprint_path(json_directory)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace(tmp_path, path)
+    logging.info(f"Recorded the fingerprint of the load in {path}")
+
+
+def discard_record(json_directory):
+    """
+    Forget the recorded load, when a new one starts
+    """
+    try:
+        os.remove(fingerprint_path(json_directory))
+    except FileNotFoundError:
+        pass
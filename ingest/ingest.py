@@ -3,22 +3,26 @@ Original Authors: Chris/Nikolai
 Hookup a book to the api by looking up its VID in database using ESTC no.
 Called from the workflow.
 """
-from csv import DictReader
 import re
 import json
 import datetime
+import hashlib
 import requests
 import subprocess
 from .sheets.sheet import get_full_printer_name_for_short_name, \
     update_uuid_in_sheet_for_book_string, get_uuid_for_book_string_from_sheet
 from .estc_search.estc import est_info_for_number
 from .util import confirm
+from .estc_index import EstcVidIndex
+from .metrics import LoadMetrics, metrics_directory_for
+from .validate import validate_book
+from .sizing import estimate_job
+from .api_client import get_client
+from .lookups import LookupGraph
+from .fingerprint import completed_load
 
-API_TOKEN_FILE_PATH = '/ocean/projects/hum160002p/shared/api/api_token.txt'
 JSON_OUTPUT_PATH = '/ocean/projects/hum160002p/shared/ocr_results/json_output'
-BOOKS_API_URL = 'https://printprobdb.psc.edu/api/books/'
 BOOKS_URL = 'https://printprobdb.psc.edu/books'
-CERT_PATH = '/ocean/projects/hum160002p/shared/api/server.crt'
 BULK_LOAD_JSON_SCRIPT = '/ocean/projects/hum160002p/shared/books/code/ingest-book/ingest/bulk_load_json.py'
 ESTC_LOOKUP_CSV = '/ocean/projects/hum160002p/shared/api/estc_vid_lookup.csv'
 INIT_ENV_SCRIPT = '/ocean/projects/hum160002p/shared/books/code/ingest-book/init_env.sh'
@@ -41,30 +45,23 @@ def _year_from_imprint_value(imprint_value):
     return result.group()  # return first match
 
 
-def _load_token(path_to_token):
-    with open(path_to_token) as f:
-        token = f.read()
-        token = token.rstrip()
-    return token
+_estc_vid_index = None
 
 
-def _build_headers(token):
-    return {'Authorization': 'Token {}'.format(token)}
+def _get_estc_vid_index():
+    global _estc_vid_index
+    if _estc_vid_index is None:
+        _estc_vid_index = EstcVidIndex(ESTC_LOOKUP_CSV)
+    return _estc_vid_index
 
 
-def _api_headers():
-    token = _load_token(API_TOKEN_FILE_PATH)
-    headers = _build_headers(token)
-    return headers
+def _get_vid_for_estc_number(estc_number):
+    return _get_estc_vid_index().get(estc_number)
 
 
-def _get_vid_for_estc_number(estc_number):
-    with open(ESTC_LOOKUP_CSV) as csvfile:
-        reader = DictReader(csvfile)
-        for row in reader:
-            # check the arguments against the row
-            if row['estcNO'] == estc_number:
-                return dict(row).get('VID')
+def _get_vids_for_estc_numbers(estc_numbers):
+    # batch lookup, returns a dict of ESTC number to VID for the numbers that were found
+    return _get_estc_vid_index().get_many(estc_numbers)
 
 
 def _get_vid(estc_number_as_string) -> str:
@@ -86,11 +83,8 @@ def _update_dates(book):
 
 
 def _retrieve_metadata(vid):
-    headers = _api_headers()
-    payload = {'vid': vid}
-    r = requests.get(BOOKS_API_URL, headers=headers, params=payload, verify=CERT_PATH)
-    result = r.json().get('results')
-    if result is None or len(result) == 0:
+    result = get_client().find_books(vid=vid)
+    if len(result) == 0:
         print('Error fetching metadata for VID -', vid)
         return None
     book = result[0]  # we assume that the first book that matches is the metadata we want, TODO: this may not be true.
@@ -99,23 +93,16 @@ def _retrieve_metadata(vid):
 
 
 def _existing_book_for_uuid(uuid):
-    headers = _api_headers()
     try:
-        r = requests.get(f'{BOOKS_API_URL}{uuid}/', headers=headers, verify=CERT_PATH)
-        if r.status_code == 200 and r.headers['Content-Type'] == 'application/json':
-            result = r.json()
-            return result
-        return None
+        return get_client().get_book(uuid)
     except requests.exceptions.HTTPError as err:
         print('Error fetching existing book for UUID: ', uuid, err)
         exit(0)
 
 
 def _existing_books_for_estc(estc):
-    payload = {'estc': estc}
-    r = requests.get(BOOKS_API_URL, headers=_api_headers(), params=payload, verify=CERT_PATH)
-    result = r.json().get('results')
-    if result is None or len(result) == 0:
+    result = get_client().find_books(estc=estc)
+    if len(result) == 0:
         return None
     return result
 
@@ -172,12 +159,12 @@ def _create_book(book, printer):
         "pp_notes": ""
     }
     # print(payload)
-    r = requests.post(BOOKS_API_URL, headers=_api_headers(), json=payload, verify=CERT_PATH)
-    return r.json()
+    return get_client().create_book(payload)
 
 
-def _get_book_data_from_estc(estc_number):
-    estc_info = est_info_for_number(estc_number=estc_number)
+def _get_book_data_from_estc(estc_number, estc_info=None):
+    if estc_info is None:
+        estc_info = est_info_for_number(estc_number=estc_number)
 
     # Make sure we get the right data from ESTC, otherwise fail here
     assert estc_info.get("ESTC No.") == estc_number
@@ -216,107 +203,279 @@ def _create_new_book_with_data(book_metadata, printer=None):
     return response['id']  # UUID of the book
 
 
-# Create the batch command to ingest the book
-def _create_bash_command(book_uuid, folder_name, update=False):
-    batch_command_prefix = 'sbatch --dependency=singleton --job-name=IngestBookJob -c 10 --mem-per-cpu=1999mb ' \
-                           '-p "RM-shared" -t 48:00:00'
-    activate_virtual_env = 'source ~/.bashrc; source {init_env_script}'.format(init_env_script=INIT_ENV_SCRIPT)
-    update_option = '-u' if update else ''
-    command_to_run = 'python3 {BULK_LOAD_JSON_SCRIPT} {update_option} -b {book_uuid} ' \
-                     '-j {JSON_OUTPUT_PATH}/{folder_name}_color'.format(BULK_LOAD_JSON_SCRIPT=BULK_LOAD_JSON_SCRIPT,
-                                                                        book_uuid=book_uuid,
-                                                                        JSON_OUTPUT_PATH=JSON_OUTPUT_PATH,
-                                                                        folder_name=folder_name,
-                                                                        update_option=update_option)
-    return '{batch_command_prefix} --wrap="module load anaconda3; {activate_virtual_env}; {command_to_run}"' \
-        .format(batch_command_prefix=batch_command_prefix,
-                activate_virtual_env=activate_virtual_env,
+SBATCH_JOB_NAME = 'IngestBookSlot'
+SBATCH_PARTITION = 'RM-shared'
+# Loads that may run at the same time. Every submission has to use the same value, or two loads of
+# the same book can end up in different slots.
+DEFAULT_CONCURRENT_LOADS = 4
+
+
+# Loads are spread over job-name slots that each run one job at a time (--dependency=singleton).
+# A book always hashes to the same slot, so two loads of it never race.
+def _job_name(book_uuid, concurrent_loads=DEFAULT_CONCURRENT_LOADS):
+    slot = int(hashlib.sha1(book_uuid.encode()).hexdigest(), 16) % concurrent_loads
+    return '{}{}'.format(SBATCH_JOB_NAME, slot)
+
+
+# Cores, memory and wall time of a load sized by sizing.estimate_job
+def _sbatch_options(job_size, job_name, dependency='singleton'):
+    return '--dependency={dependency} --job-name={job_name} -c {cpus} --mem-per-cpu={mem_per_cpu}mb ' \
+           '-p "{partition}" -t {time}'.format(dependency=dependency, job_name=job_name, cpus=job_size.cpus,
+                                              mem_per_cpu=job_size.mem_per_cpu_mb, partition=SBATCH_PARTITION,
+                                              time=job_size.time)
+
+
+def _activate_env_command():
+    return 'module load anaconda3; source ~/.bashrc; source {init_env_script}'.format(init_env_script=INIT_ENV_SCRIPT)
+
+
+def _json_directory(folder_name):
+    return '{}/{}_color'.format(JSON_OUTPUT_PATH, folder_name)
+
+
+# Arguments to bulk_load_json.py for one book
+def _bulk_load_arguments(book_uuid, folder_name, update=False, force=False, parse_processes=None):
+    update_option = '-u ' if update else ''
+    force_option = ' --force' if force else ''
+    # the cores sizing.estimate_job reserved for the parse processes
+    parse_option = ' --parse_processes {}'.format(parse_processes) if parse_processes is not None else ''
+    return '{update_option}-b {book_uuid} -j {JSON_OUTPUT_PATH}/{folder_name}_color{force_option}{parse_option}' \
+        .format(update_option=update_option, book_uuid=book_uuid, JSON_OUTPUT_PATH=JSON_OUTPUT_PATH,
+                folder_name=folder_name, force_option=force_option, parse_option=parse_option)
+
+
+def _sbatch_load_command(sbatch_options, arguments):
+    command_to_run = 'python3 {BULK_LOAD_JSON_SCRIPT} {arguments}'.format(
+        BULK_LOAD_JSON_SCRIPT=BULK_LOAD_JSON_SCRIPT, arguments=arguments)
+    return 'sbatch {sbatch_options} --wrap="{activate_env}; {command_to_run}"' \
+        .format(sbatch_options=sbatch_options,
+                activate_env=_activate_env_command(),
                 command_to_run=command_to_run)
 
 
-# Lookup printer full name from the Google sheet 'Printers' worksheet
+# Create the batch command to ingest the book
+def _create_bash_command(book_uuid, folder_name, update=False, job_size=None,
+                         concurrent_loads=DEFAULT_CONCURRENT_LOADS, force=False):
+    if job_size is None:
+        job_size = estimate_job(_json_directory(folder_name))
+    return _sbatch_load_command(_sbatch_options(job_size, _job_name(book_uuid, concurrent_loads)),
+                                _bulk_load_arguments(book_uuid, folder_name, update, force, job_size.parse_processes))
+
+
+def _submit_sharded_load(book_uuid, folder_name, update, job_size, concurrent_loads=DEFAULT_CONCURRENT_LOADS,
+                         force=False):
+    """
+    Submit a job that loads the pages and lines and creates the character run, then a job array
+    whose tasks each load one shard of the characters into that run once the first job succeeded.
+    Returns the sbatch output.
+    """
+    job_name = _job_name(book_uuid, concurrent_loads)
+    arguments = _bulk_load_arguments(book_uuid, folder_name, update, force, job_size.parse_processes)
+    command = _sbatch_load_command('--parsable ' + _sbatch_options(job_size, job_name),
+                                   '{} --character_shards {}'.format(arguments, job_size.shards))
+    completed = subprocess.run(command, shell=True, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return (completed.stdout + completed.stderr).strip()
+    job_id = completed.stdout.strip().split(';')[0]
+    # the shards wait for the pages and lines job only, not for each other. They keep the slot's
+    # job name, so the next singleton load in the slot waits for them too.
+    command = _sbatch_load_command(
+        '{} --array=0-{}'.format(_sbatch_options(job_size, job_name, dependency='afterok:' + job_id),
+                                 job_size.shards - 1),
+        '{} --shard \\$SLURM_ARRAY_TASK_ID/{}'.format(arguments, job_size.shards))
+    shards = subprocess.run(command, shell=True, capture_output=True, text=True)
+    return 'Submitted pages and lines job {}. {}'.format(job_id, (shards.stdout + shards.stderr).strip())
+
+
+# Lookup printer full name from the Google sheet 'Printers' worksheet, None if it is not there. Runs
+# speculatively on a lookup thread, so it must not exit; the caller that needs the name does.
 def _get_printer_name_from_sheet(printer_short_name):
     return get_full_printer_name_for_short_name(printer_short_name)
 
 
-def run_command(book_string, preexisting_uuid, printer, update):
-    # Folder name is same as the book string
-    folder_name = book_string
+# Lookups that are only needed when the sheet has no UUID for the book
+SPECULATIVE_LOOKUPS = ('books_by_estc', 'vid', 'eebo_metadata', 'estc', 'printer')
 
+
+def _uuid_from_sheet(book_string):
+    uuid = get_uuid_for_book_string_from_sheet(book_string)
+    if uuid is not None and not uuid.strip():
+        return None  # No existing UUID
+    return uuid
+
+
+def _start_lookups(lookups, book_string, preexisting_uuid, printer):
+    """
+    Add the lookups of a book to the graph. The backend lookup of the UUID follows the sheet; the
+    lookups by ESTC number start at the same time in case the sheet has no UUID, and the ESTC
+    catalogue is only scraped if EEBO has no metadata for the book.
+    """
     split_book_string = book_string.split('_')
+    estc_no = split_book_string[1]
+    lookups.add('sheet', lambda: preexisting_uuid if preexisting_uuid is not None else _uuid_from_sheet(book_string))
+    lookups.add('book_by_uuid', lambda uuid: _existing_book_for_uuid(uuid) if uuid is not None else None, 'sheet')
+    if preexisting_uuid is not None:
+        return
+    lookups.add('books_by_estc',
+                lambda: _existing_books_for_estc(estc_no) if estc_no not in ESTC_VALUES_WITH_MULTIPLE_BOOKS else None)
+    # VID lookup in the ESTC CSV, then EEBO metadata for the VID
+    lookups.add('vid', lambda: _get_vid(estc_no))
+    lookups.add('eebo_metadata', lambda vid: _retrieve_metadata(vid) if vid is not None else None, 'vid')
+    lookups.add('estc', lambda metadata: est_info_for_number(estc_number=estc_no) if metadata is None else None,
+                'eebo_metadata')
+    # Use printer passed as argument, default to the fullname from
+    # Google sheet or the short-name as last default
+    lookups.add('printer', lambda: printer if printer is not None else _get_printer_name_from_sheet(split_book_string[0]))
+
+
+def _resolve_book(book_string, preexisting_uuid, printer, update, metrics=None):
+    """
+    Find or create the backend book for a book string.
+    Returns the book UUID and whether the load should update an existing run.
+    """
+    if metrics is None:
+        metrics = LoadMetrics('ingest', book_string=book_string)
 
     # ESTC number is the second element in the split book string
-    estc_no = split_book_string[1]
+    estc_no = book_string.split('_')[1]
     print("ESTC number - ", estc_no)
 
-    if preexisting_uuid is None:
-        # UUID of existing book for the ESTC that we are trying to update or overwrite
-        # Lookup UUID in our sheet
-        preexisting_uuid = get_uuid_for_book_string_from_sheet(book_string)
-        if preexisting_uuid is not None and not preexisting_uuid.strip():
-            preexisting_uuid = None  # No existing UUID
-        else:
-            print("Existing UUID from Google sheet - ", preexisting_uuid)
+    with metrics.phase('resolve'), LookupGraph(metrics) as lookups:
+        _start_lookups(lookups, book_string, preexisting_uuid, printer)
+        if preexisting_uuid is None:
+            # UUID of existing book for the ESTC that we are trying to update or overwrite
+            # Lookup UUID in our sheet
+            preexisting_uuid = lookups.result('sheet')
+            if preexisting_uuid is not None:
+                print("Existing UUID from Google sheet - ", preexisting_uuid)
+                lookups.cancel(*SPECULATIVE_LOOKUPS)
+
+        # Specific UUID from commandline or the sheet
+        if preexisting_uuid is not None:
+            book_uuid = preexisting_uuid
+            existing_book = lookups.result('book_by_uuid')
+            if existing_book is None:
+                print('No book found for given pre-existing UUID: ', preexisting_uuid)
+                exit(0)
+            print('We have an existing book with UUID: ', preexisting_uuid)
+            # check if the book has an existing run or not
+            no_characters_in_book = _existing_book_has_no_characters(existing_book)
+            if no_characters_in_book:
+                update = False  # we have nothing to update, we'll have to create a new run
+                print(f'Existing book for UUID - {preexisting_uuid} has no runs yet.')
+            return book_uuid, update
 
-    # Specific UUID from commandline
-    if preexisting_uuid is not None:
-        book_uuid = preexisting_uuid
-        existing_book = _existing_book_for_uuid(preexisting_uuid)
-        if existing_book is None:
-            print('No book found for given pre-existing UUID: ', preexisting_uuid)
-            exit(0)
-        print('We have an existing book with UUID: ', preexisting_uuid)
-        # check if the book has an existing run or not
-        no_characters_in_book = _existing_book_has_no_characters(existing_book)
-        if no_characters_in_book:
-            update = False  # we have nothing to update, we'll have to create a new run
-            print(f'Existing book for UUID - {preexisting_uuid} has no runs yet.')
-    else:
         target_book = None
-        if estc_no not in ESTC_VALUES_WITH_MULTIPLE_BOOKS:
-            existing_books = _existing_books_for_estc(estc_no)
-            if existing_books is not None:
-                non_eebo_existing_book = _exactly_one_non_eebo_book(existing_books)
-                if non_eebo_existing_book is not None:
-                    target_book = non_eebo_existing_book
+        existing_books = lookups.result('books_by_estc')
+        if existing_books is not None:
+            non_eebo_existing_book = _exactly_one_non_eebo_book(existing_books)
+            if non_eebo_existing_book is not None:
+                target_book = non_eebo_existing_book
 
         if target_book is not None:
+            lookups.cancel('vid', 'eebo_metadata', 'estc', 'printer')
             book_uuid = target_book['id']
             print('Found non-EEBO target book with id : ', book_uuid)
-        else:
-            update = False
-            # VID lookup in the ESTC CSV
-            vid = _get_vid(estc_no)
-
-            # Try to retrieve metadata based on VID
-            book_metadata = _retrieve_metadata(vid) if vid is not None else None
-
-            if book_metadata is None:  # we do not have this book from EEBO
-                print("We do not have this book's metadata from EEBO.")
-                print("Getting book metadata using ESTC info lookup...")
-                book_metadata = _get_book_data_from_estc(estc_number=estc_no)
-                if book_metadata is None:
-                    print("Failed to fetch book data from ESTC, maybe ESTC website is down? Check - http://estc.bl.uk/")
-                    exit(0)
-
-            # Use printer passed as argument, default to the fullname from
-            # Google sheet or the short-name as last default
-            book_printer = printer if printer is not None else _get_printer_name_from_sheet(split_book_string[0])
-            # Create book in our backend
-            book_uuid = _create_new_book_with_data(book_metadata, book_printer)
-            # Update the book UUID in the Google sheet
-            print("Book created with UUID: ", book_uuid)
+            return book_uuid, update
+
+        update = False
+        book_metadata = lookups.result('eebo_metadata')
+        if book_metadata is None:  # we do not have this book from EEBO
+            print("We do not have this book's metadata from EEBO.")
+            print("Getting book metadata using ESTC info lookup...")
+            book_metadata = _get_book_data_from_estc(estc_number=estc_no, estc_info=lookups.result('estc'))
+            if book_metadata is None:
+                print("Failed to fetch book data from ESTC, maybe ESTC website is down? Check - http://estc.bl.uk/")
+                exit(0)
+        book_printer = lookups.result('printer')
+        if book_printer is None:
+            print("Could not find printer full name for short name - ", book_string.split('_')[0])
+            exit(-1)
+
+    # Create book in our backend
+    with metrics.phase('create_book'):
+        book_uuid = _create_new_book_with_data(book_metadata, book_printer)
+    # Update the book UUID in the Google sheet
+    print("Book created with UUID: ", book_uuid)
+    return book_uuid, update
+
+
+# The recorded load of the Ocular output of a book, if the output is unchanged since and its character run
+# still exists (see fingerprint.py). counts are the validated record counts, when known.
+def _unchanged_load(book_uuid, folder_name, counts=None):
+    record = completed_load(_json_directory(folder_name), book_uuid, counts)
+    if record is None:
+        return None
+    run_id = record.get('character_run')
+    if run_id is not None and not get_client().character_run_exists(run_id):
+        return None
+    return record
+
+
+def _describe_unchanged_load(record):
+    return 'unchanged since loaded into character run {} at {}, not queued (--force to load it again)'.format(
+        record.get('character_run'), record['loaded_at'])
+
+
+# Submit the load of a book, as one job or in character shards. Returns the sbatch output.
+def _submit_load(book_uuid, folder_name, update, job_size, concurrent_loads=DEFAULT_CONCURRENT_LOADS, force=False):
+    if job_size.shards > 1:
+        return _submit_sharded_load(book_uuid, folder_name, update, job_size, concurrent_loads, force)
+    command = _create_bash_command(book_uuid, folder_name, update, job_size, concurrent_loads, force)
+    completed = subprocess.run(command, shell=True, capture_output=True, text=True)
+    return (completed.stdout + completed.stderr).strip()
+
+
+def run_command(book_string, preexisting_uuid, printer, update, validate=True,
+                concurrent_loads=DEFAULT_CONCURRENT_LOADS, force=False, load=None):
+    """
+    Resolve or create the book for a book string and submit its load. load, if given, is called as
+    load(book_uuid, json_directory, update, force) to load the book here instead of in a Slurm job.
+    """
+    # Folder name is same as the book string
+    folder_name = book_string
+    metrics = LoadMetrics('ingest', book_string=book_string)
+
+    counts = None
+    if validate:
+        # fail before the book is created or the job is queued
+        with metrics.phase('validate'):
+            report = validate_book(_json_directory(folder_name))
+        print(report.summary())
+        if not report.ok:
+            exit(-1)
+        counts = report.counts
+    job_size = None
+    if load is None:
+        job_size = estimate_job(_json_directory(folder_name), counts)
+        print('Job size - ', job_size.describe())
+
+    book_uuid, update = _resolve_book(book_string, preexisting_uuid, printer, update, metrics)
+    metrics.labels['book'] = book_uuid
 
     print("Updating UUID in Google sheet for book string", book_string, book_uuid)
-    update_uuid_in_sheet_for_book_string(book_string, book_uuid)
+    with metrics.phase('sheet'):
+        update_uuid_in_sheet_for_book_string(book_string, book_uuid)
+    unchanged_load = None if force else _unchanged_load(book_uuid, folder_name, counts)
+    if unchanged_load is not None:
+        print('The Ocular output of this book is', _describe_unchanged_load(unchanged_load))
+        metrics.status = 'unchanged'
+        metrics.write(metrics_directory_for(_json_directory(folder_name)))
+        return
     if update:
         print('Updating/overwriting an existing run for book with UUID: ', book_uuid)
     else:
         print('Creating a new run for the book with UUID: ', book_uuid)
-    command = _create_bash_command(book_uuid, folder_name, update)
     print("ONCE COMPLETED, THIS BOOK WILL BE LOADED AT {BOOKS_URL}/{book_uuid}"
           .format(BOOKS_URL=BOOKS_URL, book_uuid=book_uuid))
 
-    # subprocess.run(input=command)
-    subprocess.run(command, shell=True)
-    print("Job Launched")
+    if load is not None:
+        with metrics.phase('load'):
+            load(book_uuid, _json_directory(folder_name), update, force)
+    else:
+        # subprocess.run(input=command)
+        with metrics.phase('submit'):
+            print(_submit_load(book_uuid, folder_name, update, job_size, concurrent_loads, force))
+        print("Job Launched")
+    metrics.status = 'complete'
+    metrics.write(metrics_directory_for(_json_directory(folder_name)))
@@ -0,0 +1,137 @@
+"""
+Commit journal for bulk loads, so that an interrupted load can be resumed.
+
+The journal is an append-only JSON-lines file kept next to the Ocular JSON directory.
+It records the settings the load was started with, the character run it writes to and
+every piece of the book the API has acknowledged. Each entry is flushed and fsynced
+before the load moves on, so after a crash the journal never claims more than was sent.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+
+try:
+    from .util import sidecar_path
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from util import sidecar_path
+
+JOURNAL_SUFFIX = ".load_journal"
+
+
+class LoadJournal:
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.character_run_id = None
+        self.done = set()
+        self.ranges = {}  # (kind, chunk index) -> [(start, end), ...]
+        self.complete = False
+        self._torn_at = None  # where a torn last line starts, dropped before the next entry is appended
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, json_directory, shard=None):
+        """
+        The journal of a load, or of one character shard (index, count) of a sharded load
+        """
+        suffix = JOURNAL_SUFFIX if shard is None else f"{JOURNAL_SUFFIX}.shard{shard[0]}of{shard[1]}"
+        return cls(sidecar_path(json_directory, suffix))
+
+    def read(self):
+        """
+        Load a previous journal from disk. Returns False if there is none.
+        """
+        if not os.path.exists(self.path):
+            return False
+        complete_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # a line cut short by the crash we are recovering from
+                    break
+                complete_bytes += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._apply(entry)
+        if complete_bytes < os.path.getsize(self.path):
+            self._torn_at = complete_bytes
+        return self.header is not None
+
+    def _apply(self, entry):
+        event = entry.get("event")
+        if event == "start":
+            self.header = entry
+        elif event == "character_run":
+            self.character_run_id = entry["id"]
+        elif event == "done":
+            self.done.add(entry["kind"])
+        elif event == "chunk":
+            self.ranges.setdefault((entry["kind"], entry["chunk"]), []).append((entry["start"], entry["end"]))
+        elif event == "complete":
+            self.complete = True
+
+    def _append(self, entry):
+        with self._lock:
+            if self._torn_at is not None:
+                # the journal of a shard on another node is read while it is written, so only the load
+                # appending to the journal drops the torn line, which would otherwise swallow the entry
+                with open(self.path, "r+b") as f:
+                    f.truncate(self._torn_at)
+                self._torn_at = None
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(entry)
+
+    def start(self, **settings):
+        """
+        Begin a new journal, discarding any previous one
+        """
+        with self._lock:
+            open(self.path, "w").close()
+            self._torn_at = None
+        self.header = None
+        self.character_run_id = None
+        self.done = set()
+        self.ranges = {}
+        self.complete = False
+        self._append({"event": "start", "started": datetime.datetime.now().isoformat(), **settings})
+        logging.info(f"Journaling load progress to {self.path}")
+
+    def record_character_run(self, character_run_id):
+        self._append({"event": "character_run", "id": character_run_id})
+
+    def mark_done(self, kind):
+        self._append({"event": "done", "kind": kind})
+
+    def is_done(self, kind):
+        return kind in self.done
+
+    def commit_range(self, kind, chunk, start, end):
+        """
+        Record that records [start, end) of a chunk were acknowledged by the API
+        """
+        self._append({"event": "chunk", "kind": kind, "chunk": chunk, "start": start, "end": end})
+
+    def pending_ranges(self, kind, chunk, length):
+        """
+        The [start, end) ranges of a chunk of the given length that have not been committed yet
+        """
+        pending = []
+        position = 0
+        for start, end in sorted(self.ranges.get((kind, chunk), [])):
+            if start > position:
+                pending.append((position, start))
+            position = max(position, end)
+        if position < length:
+            pending.append((position, length))
+        return pending
+
+    def mark_complete(self):
+        self._append({"event": "complete"})
@@ -0,0 +1,135 @@
+"""
+Incremental reader for the JSON files produced by Ocular.
+
+Ocular writes each of pages.json, lines.json and chars.json as a single object
+holding one large array (e.g. {"chars": [...]}). The reader below walks that
+object with a small rolling buffer and yields the array elements one at a time,
+so memory use is bounded by the size of a single record rather than the book.
+"""
+
+import json
+import re
+from collections import Counter
+
+READ_SIZE = 1 << 20  # characters read from disk per refill
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _StreamDecoder:
+    """
+    Decode consecutive JSON values from a file object, refilling a buffer as needed
+    """
+
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # drop what has already been consumed before growing the buffer
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.fp.read(self.read_size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def peek(self):
+        """
+        Skip whitespace and return the next significant character, or '' at end of file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def expect(self, allowed):
+        char = self.peek()
+        if not char or char not in allowed:
+            raise ValueError(f"Expected one of {allowed!r} at offset {self.pos}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # a number or literal touching the end of the buffer may be truncated
+            if end == len(self.buf) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_json_array(path, key, read_size=READ_SIZE):
+    """
+    Yield the elements of the array stored under `key` in the top-level JSON object at `path`,
+    one at a time and without loading the whole file.
+    """
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        reader = _StreamDecoder(fp, read_size)
+        reader.expect("{")
+        if reader.peek() != "}":
+            while True:
+                name = reader.value()
+                reader.expect(":")
+                if name == key and reader.peek() == "[":
+                    reader.expect("[")
+                    if reader.peek() == "]":
+                        return
+                    while True:
+                        yield reader.value()
+                        if reader.expect(",]") == "]":
+                            return
+                reader.value()  # skip values of other keys
+                if reader.expect(",}") == "}":
+                    break
+    raise KeyError(f"'{key}' not found in {path}")
+
+
+def scan_string_counts(path, key, read_size=READ_SIZE):
+    """
+    Occurrences of each distinct string value of `key` anywhere in the JSON file at `path`, found
+    with a regular expression over the raw text rather than by decoding every record.
+    """
+    # the lookbehind skips an escaped quote, which can only be inside another string
+    pattern = re.compile(r'(?<!\\)"%s"\s*:\s*("(?:[^"\\]|\\.)*")' % re.escape(key))
+    literals = Counter()
+    carry = ""
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        while True:
+            data = fp.read(read_size)
+            text = carry + data
+            last_end = 0
+            for match in pattern.finditer(text):
+                literals[match.group(1)] += 1
+                last_end = match.end()
+            if not data:
+                break
+            # keep a tail so a value cut by the read boundary is matched with the next read
+            carry = text[max(last_end, len(text) - 4096):]
+    counts = Counter()
+    for literal, count in literals.items():
+        counts[json.loads(literal)] += count
+    return counts
+
+
+def scan_string_values(path, key, read_size=READ_SIZE):
+    """
+    Distinct string values of `key` anywhere in the JSON file at `path`
+    """
+    return set(scan_string_counts(path, key, read_size))
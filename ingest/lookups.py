@@ -0,0 +1,73 @@
+"""
+Run the lookups behind a book ingest as a small dependency graph.
+
+Each lookup is a named function of the results of the lookups it depends on. All of them start on
+a thread pool straight away and wait only for their own dependencies, so independent branches (the
+sheet, the backend, the ESTC catalogue) overlap and the total time is close to that of the slowest
+branch. Lookups can be started speculatively and cancelled once it is clear their result is not
+needed: a cancelled lookup that has not started yet never runs, one that is already running is left
+to finish in the background and its result is dropped.
+"""
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+
+class LookupCancelled(Exception):
+    pass
+
+
+class LookupGraph:
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._futures = {}
+        self._cancelled = set()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='lookup')
+
+    def add(self, name, function, *dependencies):
+        """
+        Start function(*results of dependencies) as soon as the dependencies have completed. A failed
+        or cancelled dependency fails the lookup with the same exception.
+        """
+        # dependencies were submitted first, so the pool has started them by the time this one waits
+        dependencies = [self._futures[dependency] for dependency in dependencies]
+        # in the context of the caller, e.g. the daemon request whose output the lookup belongs to
+        self._futures[name] = self._executor.submit(contextvars.copy_context().run, self._run, name, function,
+                                                    dependencies)
+
+    def _run(self, name, function, dependencies):
+        arguments = [dependency.result() for dependency in dependencies]
+        with self._lock:
+            if name in self._cancelled:
+                raise LookupCancelled(name)
+        start = time.monotonic()
+        try:
+            return function(*arguments)
+        finally:
+            if self.metrics is not None:
+                self.metrics.add_time(name, time.monotonic() - start)
+
+    def result(self, name):
+        """
+        The result of a lookup, waiting for it if needed
+        """
+        return self._futures[name].result()
+
+    def cancel(self, *names):
+        with self._lock:
+            self._cancelled.update(names)
+        for name in names:
+            self._futures[name].cancel()
+
+    def close(self):
+        # running lookups that were cancelled finish in the background
+        self.cancel(*self._futures)
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
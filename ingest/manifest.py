@@ -0,0 +1,163 @@
+"""
+Content-hash manifest of the records sent by a load, used for differential updates.
+
+Every record that passes through a load is hashed and staged in a SQLite file next to the JSON
+directory. Once the load completes, the staged hashes replace those of the previous load. A
+differential update compares each record against the stored hash and only passes on the records
+that were inserted or changed; ids stored but not seen again are the deleted records.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from .util import sidecar_path
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from util import sidecar_path
+
+MANIFEST_SUFFIX = ".manifest"
+RECORD_ID_FIELD = "id"
+BATCH_SIZE = 5000
+
+
+def record_hash(record):
+    if orjson is not None:
+        canonical = orjson.dumps(record, option=orjson.OPT_SORT_KEYS)
+    else:
+        canonical = json.dumps(record, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(canonical).hexdigest()[:16]
+
+
+class RecordManifest:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # staged hashes are written in large batches, a lost batch is staged again by a resumed load
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records "
+                        "(kind TEXT, id TEXT, hash TEXT, PRIMARY KEY (kind, id)) WITHOUT ROWID")
+        # staging only appends, the ids are matched up when the load is committed
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending (kind TEXT, id TEXT, hash TEXT)")
+        self.db.commit()
+
+    @classmethod
+    def for_directory(cls, json_directory):
+        return cls(sidecar_path(json_directory, MANIFEST_SUFFIX))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def book_id(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'book_id'").fetchone()
+        return row[0] if row else None
+
+    def begin(self, book_id, resume=False):
+        """
+        Start staging a load. A resumed load keeps what the interrupted one already staged.
+        """
+        with self._lock:
+            if self.book_id() not in (None, book_id):
+                logging.info(f"Manifest {self.path} belonged to book {self.book_id()}, discarding it")
+                self.db.execute("DELETE FROM records")
+                resume = False
+            if not resume:
+                self.db.execute("DELETE FROM pending")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('book_id', ?)", (book_id,))
+            self.db.commit()
+
+    def stage(self, kind, hashed):
+        """
+        Stage (id, hash, ...) tuples of records hashed elsewhere, e.g. by the parse processes
+        """
+        with self._lock:
+            self.db.executemany("INSERT INTO pending VALUES (?, ?, ?)",
+                                ((kind, item[0], item[1]) for item in hashed))
+            self.db.commit()
+
+    def _stored(self, kind, ids):
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            return dict(self.db.execute(f"SELECT id, hash FROM records WHERE kind = ? AND id IN ({placeholders})",
+                                        [kind, *ids]))
+
+    def _batches(self, records):
+        batch = []
+        for record in records:
+            batch.append((str(record[RECORD_ID_FIELD]), record_hash(record), record))
+            if len(batch) >= BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def track(self, kind, records):
+        """
+        Stage the hash of every record while passing all of them on
+        """
+        for batch in self._batches(records):
+            self.stage(kind, batch)
+            for _, _, record in batch:
+                yield record
+
+    def changed(self, kind, records):
+        """
+        Stage the hash of every record and pass on only those that are new or changed
+        """
+        total = changed = 0
+        for batch in self._batches(records):
+            self.stage(kind, batch)
+            stored = self._stored(kind, [record_id for record_id, _, _ in batch])
+            for record_id, digest, record in batch:
+                if stored.get(record_id) != digest:
+                    changed += 1
+                    yield record
+            total += len(batch)
+        logging.info({f"Changed or new {kind}": changed, f"Unchanged {kind}": total - changed})
+
+    def deleted(self, kind):
+        """
+        Ids from the previous load that this load has not seen. Only meaningful after a full pass.
+        """
+        with self._lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT id FROM records WHERE kind = ? AND id NOT IN (SELECT id FROM pending WHERE kind = ?)",
+                (kind, kind))]
+
+    def forget(self, kind):
+        """
+        Drop the stored hashes of a kind, so the next differential update sends all of its records
+        """
+        with self._lock:
+            self.db.execute("DELETE FROM records WHERE kind = ?", (kind,))
+            self.db.execute("DELETE FROM pending WHERE kind = ?", (kind,))
+            self.db.commit()
+
+    def commit(self):
+        """
+        Make the staged hashes the manifest of the last completed load
+        """
+        with self._lock:
+            kinds = [row[0] for row in self.db.execute("SELECT DISTINCT kind FROM pending")]
+            self.db.executemany("DELETE FROM records WHERE kind = ?", ((kind,) for kind in kinds))
+            # a resumed load stages some records twice, the later hash wins
+            self.db.execute("INSERT OR REPLACE INTO records SELECT kind, id, hash FROM pending ORDER BY rowid")
+            self.db.execute("DELETE FROM pending")
+            self.db.commit()
@@ -0,0 +1,259 @@
+"""
+Timing and throughput metrics for ingest and bulk load jobs.
+
+A LoadMetrics object collects wall time per phase, latency histograms, counters (records, bytes
+sent, retries) and the peak resident memory of the process. At the end of a job, or when it
+fails, it is written to a metrics directory next to the Ocular JSON directory: as a JSON summary
+and as a Prometheus textfile that node_exporter's textfile collector can pick up. Progress
+objects log the rate and an ETA while the characters are uploading.
+"""
+
+import bisect
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    from .util import sidecar_path
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from util import sidecar_path
+
+METRICS_SUFFIX = ".metrics"
+PROMETHEUS_PREFIX = "ingest_book"
+# the label naming the ingest job, "job" being the scrape job Prometheus attaches to every series
+JOB_LABEL = "book_job"
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+PROGRESS_INTERVAL = 30  # seconds between progress lines
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def metrics_directory_for(json_directory):
+    return sidecar_path(json_directory, METRICS_SUFFIX)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "mean": round(self.sum / self.count, 3) if self.count else None,
+            "max": round(self.max, 3),
+            "buckets": {str(bound): count for bound, count in self.cumulative()},
+        }
+
+
+class Progress:
+    """
+    Records acknowledged so far out of an optional total, logged with the rate and an ETA
+    at most every PROGRESS_INTERVAL seconds
+    """
+
+    def __init__(self, name, total=None, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = time.monotonic()
+        self.last_logged = self.started
+        self._lock = threading.Lock()
+
+    def advance(self, records):
+        with self._lock:
+            self.done += records
+            now = time.monotonic()
+            if now - self.last_logged < self.interval:
+                return
+            self.last_logged = now
+        self.log()
+
+    def log(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        line = {self.name: self.done, "Records/s": round(rate, 1)}
+        if self.total:
+            line["Percent"] = round(100.0 * self.done / self.total, 1)
+            if rate:
+                line["ETA"] = str(datetime.timedelta(seconds=int(max(self.total - self.done, 0) / rate)))
+        logging.info(line)
+
+
+class LoadMetrics:
+    def __init__(self, job, **labels):
+        self.job = job
+        self.labels = labels
+        self.started = datetime.datetime.now()
+        self.status = "running"
+        self.phases = {}  # name -> seconds, summed over every time the phase ran
+        self.counters = {}  # (name, label items) -> value
+        self.histograms = {}  # (name, label items) -> Histogram
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def timed(self, name, iterable):
+        """
+        Pass on the items of iterable, adding the time spent producing them to a phase. Used for
+        reading records, which is interleaved with uploading them.
+        """
+        iterator = iter(iterable)
+        clock = time.monotonic
+        spent = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    spent += clock() - start
+                    return
+                spent += clock() - start
+                yield item
+        finally:
+            self.add_time(name, spent)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def progress(self, name, total=None):
+        return Progress(name, total)
+
+    def _counter_total(self, name):
+        return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def summary(self):
+        elapsed = (datetime.datetime.now() - self.started).total_seconds()
+        records = {}
+        for (name, labels), value in self.counters.items():
+            if name == "records_sent":
+                kind = dict(labels).get("kind")
+                seconds = self.phases.get(kind)
+                records[kind] = {"records": value, "per_second": round(value / seconds, 1) if seconds else None}
+        return {
+            "job": self.job,
+            **self.labels,
+            "status": self.status,
+            "started": self.started.isoformat(),
+            "elapsed_seconds": round(elapsed, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "records": records,
+            "bytes_sent": self._counter_total("bytes_sent"),
+            "retries": self._counter_total("retries"),
+            "counters": [{"name": name, **dict(labels), "value": value}
+                         for (name, labels), value in sorted(self.counters.items())],
+            "latency_seconds": [{"name": name, **dict(labels), **histogram.summary()}
+                                for (name, labels), histogram in sorted(self.histograms.items())],
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+    def _prometheus_labels(self, extra=()):
+        items = [(JOB_LABEL, self.job)] + sorted(self.labels.items()) + list(extra)
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for k, v in items) + "}"
+
+    def prometheus(self):
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+
+        metric("phase_seconds", "gauge", "Wall time spent in each phase of the job")
+        for name, seconds in sorted(self.phases.items()):
+            lines.append(f"{PROMETHEUS_PREFIX}_phase_seconds{self._prometheus_labels([('phase', name)])} {seconds:.3f}")
+        for counter in sorted({name for name, _ in self.counters}):
+            metric(f"{counter}_total", "counter", f"Total {counter.replace('_', ' ')}")
+            for (name, labels), value in sorted(self.counters.items()):
+                if name == counter:
+                    lines.append(f"{PROMETHEUS_PREFIX}_{name}_total{self._prometheus_labels(labels)} {value}")
+        for histogram_name in sorted({name for name, _ in self.histograms}):
+            metric(histogram_name, "histogram", f"Latency of {histogram_name.replace('_', ' ')}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != histogram_name:
+                    continue
+                for bound, count in histogram.cumulative():
+                    bucket_labels = self._prometheus_labels(list(labels) + [("le", bound)])
+                    lines.append(f"{PROMETHEUS_PREFIX}_{name}_bucket{bucket_labels} {count}")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_sum{self._prometheus_labels(labels)} {histogram.sum:.3f}")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_count{self._prometheus_labels(labels)} {histogram.count}")
+        rss = peak_rss_bytes()
+        if rss is not None:
+            metric("peak_rss_bytes", "gauge", "Peak resident memory of the job")
+            lines.append(f"{PROMETHEUS_PREFIX}_peak_rss_bytes{self._prometheus_labels()} {rss}")
+        metric("success", "gauge", "1 if the job completed, 0 if it failed or is still running")
+        lines.append(f"{PROMETHEUS_PREFIX}_success{self._prometheus_labels()} {int(self.status == 'complete')}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        """
+        Write <job>.json and <job>.prom into directory. Failing to write metrics never fails the job.
+        """
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for extension, content in (("json", json.dumps(self.summary(), indent=2)), ("prom", self.prometheus())):
+                path = os.path.join(directory, f"{self.job}.{extension}")
+                # write then rename, so a textfile collector never reads a partial file
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            logging.info(f"Wrote {self.job} metrics to {directory}")
+        except OSError as ex:
+            logging.error(f"Could not write metrics to {directory} - {str(ex)}")
@@ -0,0 +1,208 @@
+"""
+Multi-process preparation of the characters of a load.
+
+The array in chars.json is cut into shards of about SHARD_BYTES at record boundaries. A pool of
+processes decodes the shards, normalizes the character classes with the table prepared up front,
+hashes every record for the manifest and serializes the records into byte-budgeted chunk bodies,
+so the loader only hands finished bodies to the uploads. Shards come back in file order, with a
+few submitted ahead of the one being consumed.
+
+A cut is placed after a '},{' near the target offset from which the next records decode as objects
+with an id. Inside a string, any quote is escaped, so text there cannot decode as such an object
+before the string ends. Should a cut still be wrong, the shard before it cannot end exactly at it,
+and its worker fails rather than sending garbled records.
+"""
+
+import array
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+
+try:
+    from .manifest import record_hash, RECORD_ID_FIELD
+    from .transport import SerializedRecords, dumps
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from manifest import record_hash, RECORD_ID_FIELD
+    from transport import SerializedRecords, dumps
+
+SHARD_BYTES = 16 * 1024 * 1024
+RESYNC_WINDOW = 1 << 20  # bytes searched for a record boundary at each cut
+VERIFY_BYTES = 1 << 16
+VERIFY_RECORDS = 2  # records that have to decode after a cut
+HEAD_BYTES = 4096
+SHARDS_AHEAD = 2  # shards submitted per process beyond the one being consumed
+# the array has to be the first value of the file, as Ocular writes it
+_ARRAY_START = re.compile(rb'[ \t\n\r]*\{[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*\[[ \t\n\r]*')
+_RECORD_BOUNDARY = re.compile(rb'\}[ \t\n\r]*,[ \t\n\r]*(?=\{)')
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+
+def available_cpus():
+    """
+    Cores this process may run on, i.e. those Slurm allocated to the job
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _starts_records(data):
+    # whether data starts with VERIFY_RECORDS records, or fewer ending the array
+    text = data.decode("utf-8", "ignore")
+    decoder = json.JSONDecoder()
+    position = 0
+    for _ in range(VERIFY_RECORDS):
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except ValueError:
+            return False
+        separator = _SEPARATOR.match(text, position)
+        # '{}' decodes from inside a string as well, a key cannot
+        if not isinstance(record, dict) or RECORD_ID_FIELD not in record or separator is None:
+            return False
+        if separator.group(1) == "]":
+            break
+        position = separator.end()
+    return True
+
+
+def _record_boundary(window):
+    for boundary in _RECORD_BOUNDARY.finditer(window):
+        if _starts_records(window[boundary.end():boundary.end() + VERIFY_BYTES]):
+            return boundary.end()
+    return None
+
+
+def plan_shards(path, key, shard_bytes=SHARD_BYTES):
+    """
+    Byte ranges (start, end) of the records of the array `key`, each starting at a record. None if
+    the array is not the first value of the file or does not hold objects, so it has to be streamed.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(HEAD_BYTES)
+        match = _ARRAY_START.match(head)
+        if match is None or match.group(1).decode("utf-8") != key or head[match.end():match.end() + 1] != b"{":
+            return None
+        cuts = [match.end()]
+        position = cuts[0] + shard_bytes
+        while position < size:
+            f.seek(position)
+            boundary = _record_boundary(f.read(RESYNC_WINDOW))
+            if boundary is None:
+                position += RESYNC_WINDOW
+                continue
+            cuts.append(position + boundary)
+            position = cuts[-1] + shard_bytes
+    # the last shard runs to the end of the file and stops at the closing bracket
+    cuts.append(size)
+    return list(zip(cuts, cuts[1:]))
+
+
+_table = None
+
+
+def _init_worker(table):
+    global _table
+    _table = table
+
+
+class _ChunkBuilder:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self._reset()
+
+    def _reset(self):
+        self.body = bytearray(b"[")
+        self.starts = array.array("q")
+        self.ends = array.array("q")
+        self.hashed = []
+        self.size = 0
+
+    def add(self, text, hashed):
+        # the same budget as chunking.serialize_in_chunks: the text plus its separator
+        record_bytes = len(text) + 2
+        if self.starts and self.size + record_bytes > self.max_bytes:
+            self.flush()
+        if self.starts:
+            self.body += b","
+        self.starts.append(len(self.body))
+        self.body += text
+        self.ends.append(len(self.body))
+        self.hashed.append(hashed)
+        self.size += record_bytes
+
+    def flush(self):
+        if self.starts:
+            self.body += b"]"
+            self.chunks.append((bytes(self.body), self.starts, self.ends, self.hashed))
+        self._reset()
+
+
+def prepare_shard(path, key, start, end, chunk_bytes):
+    """
+    Decode, normalize, hash and serialize the records in bytes [start, end) of the file. Returns
+    the shard's chunks as (body, record starts, record ends, [(id, hash), ...]).
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    decoder = json.JSONDecoder()
+    builder = _ChunkBuilder(chunk_bytes)
+    position = 0
+    while True:
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except ValueError as ex:
+            raise ValueError(f"Shard {start}-{end} of {path} does not start and end at records of '{key}' "
+                             f"- {str(ex)[:200]}")
+        if not isinstance(record, dict):
+            raise ValueError(f"Shard {start}-{end} of {path} does not start and end at records of '{key}' "
+                             f"- found a {type(record).__name__} rather than an object")
+        if key == "chars":
+            ocular_code = record["character_class"]
+            try:
+                record["character_class"] = _table[ocular_code]
+            except KeyError:
+                raise ValueError(f"Character class {ocular_code!r} is missing from the normalization table")
+        builder.add(dumps(record), (str(record[RECORD_ID_FIELD]), record_hash(record)))
+        separator = _SEPARATOR.match(text, position)
+        if separator is None:
+            raise ValueError(f"Unexpected text after a record at offset {start + position} of {path}")
+        position = separator.end()
+        if separator.group(1) == "]" or position == len(text):
+            break
+    builder.flush()
+    return builder.chunks
+
+
+def iter_prepared_chunks(path, key, shards, table, chunk_bytes, processes, ahead=SHARDS_AHEAD):
+    """
+    Yield the chunks of every shard in file order as (SerializedRecords, [(id, hash), ...]),
+    keeping `ahead` shards per process submitted
+    """
+    # spawned rather than forked, the loader already runs upload and pipeline threads
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                                initializer=_init_worker, initargs=(table,)) as executor:
+        shards = iter(shards)
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < processes * ahead:
+                    shard = next(shards, None)
+                    if shard is None:
+                        break
+                    pending.append(executor.submit(prepare_shard, path, key, shard[0], shard[1], chunk_bytes))
+                if not pending:
+                    return
+                for body, starts, ends, hashed in pending.popleft().result():
+                    yield SerializedRecords(body, starts, ends), hashed
+        finally:
+            for future in pending:
+                future.cancel()
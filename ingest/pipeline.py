@@ -0,0 +1,129 @@
+"""
+Bounded producer/consumer stages for overlapping the work of a load.
+
+A Stage runs a producer iterable in a background thread and hands its items to the consumer
+through a bounded queue. The producer blocks when the queue is full, so a stage never runs more
+than `depth` items ahead of the one after it, and items come out in the order they were produced.
+An exception in the producer is raised in the consumer, and closing a stage stops its producer.
+"""
+
+import contextvars
+import queue
+import threading
+import time
+
+DEFAULT_DEPTH = 8
+_POLL_SECONDS = 0.1
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    def __init__(self, name, iterable, depth=DEFAULT_DEPTH, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        # the producer runs in the context of the consumer, so what it logs goes where the consumer's does
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._produce, iterable),
+                                        name=f"stage-{name}", daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # returns False if the stage was closed while waiting for room
+        start = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            if self.metrics is not None:
+                # time the producer waited for the consumer
+                self.metrics.add_time(f"{self.name}_blocked", time.monotonic() - start)
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except BaseException as ex:
+            self._put(_Failure(ex))
+            return
+        finally:
+            # let a generator that was stopped early run its cleanup in this thread
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        self._put(_DONE)
+
+    def _get(self):
+        while True:
+            try:
+                return self._queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _DONE
+
+    def __iter__(self):
+        while True:
+            start = time.monotonic()
+            item = self._get()
+            if self.metrics is not None:
+                # time the consumer waited for the producer
+                self.metrics.add_time(f"{self.name}_starved", time.monotonic() - start)
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def close(self):
+        """
+        Stop the producer and wait for its thread, dropping anything still queued
+        """
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Pipeline:
+    """
+    The stages of a load, closed together (last stage first) when the pipeline is
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.stages = []
+
+    def stage(self, name, iterable, depth=DEFAULT_DEPTH):
+        stage = Stage(name, iterable, depth, self.metrics)
+        self.stages.append(stage)
+        return stage
+
+    def close(self):
+        for stage in reversed(self.stages):
+            stage.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,3 +1,5 @@
+import threading
+
 import pygsheets
 from google.oauth2 import service_account
 
@@ -6,49 +8,149 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'client_secret.json'
 GOOGLE_SHEET_KEY='1YkFjV5lNwjC5ZPDrxux0ylUKis8q9ux1Vlydehmmzn4'
 
+PIPELINE_PROGRESS_WORKSHEET = 'Pipeline Progress'
+PRINTERS_WORKSHEET = 'Printers'
+BOOK_STRING_COLUMN = 6  # G
+UUID_COLUMN = 18  # S
+UUID_COLUMN_LETTER = 'S'
+PRINTER_FULL_NAME_COLUMN = 0  # A
+PRINTER_SHORT_NAME_COLUMN = 1  # B
+
+_sheet = None
+_snapshot = None
+
 
 def _get_sheet():
+    global _sheet
+    if _sheet is not None:
+        return _sheet
     credentials = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
     gc = pygsheets.authorize(custom_credentials=credentials)
 
     # Open spreadsheet and then worksheet
     # open sheet - https://docs.google.com/spreadsheets/d/1YkFjV5lNwjC5ZPDrxux0ylUKis8q9ux1Vlydehmmzn4/edit?pli=1#gid=0
-    sh = gc.open_by_key(GOOGLE_SHEET_KEY)
-    return sh
+    _sheet = gc.open_by_key(GOOGLE_SHEET_KEY)
+    return _sheet
+
+
+def _cell(row, column):
+    return row[column] if column < len(row) else ''
+
+
+class SheetSnapshot:
+    """
+    The 'Pipeline Progress' and 'Printers' worksheets, each fetched with a single range read the first
+    time it is needed and indexed by book string and printer short name. UUID writes are queued and
+    sent together by flush().
+    """
+
+    def __init__(self, sh=None):
+        self.sh = sh or _get_sheet()
+        self._progress_wks = None
+        self._progress_rows = None
+        self._book_string_index = None
+        self._printer_index = None
+        self._pending_uuids = {}  # sheet row number -> uuid
+        self._lock = threading.RLock()
+
+    def _load_progress(self):
+        with self._lock:
+            if self._progress_rows is None:
+                self._progress_wks = self.sh.worksheet_by_title(PIPELINE_PROGRESS_WORKSHEET)
+                self._progress_rows = self._progress_wks.get_all_values(include_tailing_empty=True,
+                                                                        include_tailing_empty_rows=False)
+                self._book_string_index = {}
+                for index, row in enumerate(self._progress_rows, start=1):
+                    # the first row for a book string wins, as with the old row-by-row scan
+                    self._book_string_index.setdefault(_cell(row, BOOK_STRING_COLUMN), index)
+            return self._progress_rows
+
+    def _load_printers(self):
+        with self._lock:
+            if self._printer_index is None:
+                wks = self.sh.worksheet_by_title(PRINTERS_WORKSHEET)
+                self._printer_index = {}
+                for row in wks.get_all_values(include_tailing_empty=True, include_tailing_empty_rows=False):
+                    self._printer_index.setdefault(_cell(row, PRINTER_SHORT_NAME_COLUMN),
+                                                   _cell(row, PRINTER_FULL_NAME_COLUMN))
+            return self._printer_index
+
+    def row_for_book_string(self, book_string):
+        self._load_progress()
+        return self._book_string_index.get(book_string)
+
+    def uuid_for_book_string(self, book_string):
+        index = self.row_for_book_string(book_string)
+        if index is None:
+            return None
+        print('Found given book_string at index', index)
+        return _cell(self._progress_rows[index - 1], UUID_COLUMN)
+
+    def book_strings_without_uuid(self):
+        """
+        Book strings of the 'Pipeline Progress' rows that have no UUID yet, in sheet order
+        """
+        book_strings = []
+        # the first row holds the column headers
+        for row in self._load_progress()[1:]:
+            book_string = _cell(row, BOOK_STRING_COLUMN).strip()
+            if '_' in book_string and not _cell(row, UUID_COLUMN).strip():
+                book_strings.append(book_string)
+        return book_strings
+
+    def printer_full_name(self, printer_short_name):
+        return self._load_printers().get(printer_short_name)
+
+    def queue_uuid(self, book_string, uuid):
+        index = self.row_for_book_string(book_string)
+        if index is None:
+            print('Could not find book_string in sheet to update UUID -', book_string)
+            return
+        print('Updating UUID for given book_string at index', index)
+        with self._lock:
+            row = self._progress_rows[index - 1]
+            row.extend([''] * (UUID_COLUMN + 1 - len(row)))
+            row[UUID_COLUMN] = uuid
+            self._pending_uuids[index] = uuid
+
+    def flush(self):
+        """
+        Write all queued UUIDs in one batch update
+        """
+        with self._lock:
+            if not self._pending_uuids:
+                return
+            rows = sorted(self._pending_uuids)
+            self._progress_wks.update_values_batch(['{}{}'.format(UUID_COLUMN_LETTER, index) for index in rows],
+                                                   [[[self._pending_uuids[index]]] for index in rows])
+            self._pending_uuids = {}
+
+
+def get_snapshot(refresh=False):
+    """
+    Snapshot shared by the functions below, so one run reads each worksheet at most once
+    """
+    global _snapshot
+    if _snapshot is None or refresh:
+        _snapshot = SheetSnapshot()
+    return _snapshot
 
 
 def get_uuid_for_book_string_from_sheet(book_string) -> str:
-    sh = _get_sheet()
-    wks = sh.worksheet_by_title('Pipeline Progress')
-    index = 0
-    for row in wks:
-        index += 1
-        if row[6] == book_string:
-            print('Found given book_string at index', index)
-            return row[18]
+    return get_snapshot().uuid_for_book_string(book_string)
 
 
 def update_uuid_in_sheet_for_book_string(book_string, uuid):
-    sh = _get_sheet()
-    wks = sh.worksheet_by_title('Pipeline Progress')
-    index = 0
-    for row in wks:
-        index += 1
-        if row[6] == book_string:
-            print('Updating UUID for given book_string at index', index)
-            wks.update_value("S{}".format(index), uuid)
-            break
+    snapshot = get_snapshot()
+    snapshot.queue_uuid(book_string, uuid)
+    snapshot.flush()
 
 
+# The full printer name for a short name, or None if the 'Printers' worksheet does not have it
 def get_full_printer_name_for_short_name(printer_short_name):
-    sh = _get_sheet()
-    wks = sh.worksheet_by_title('Printers')
-    index = 0
-    for row in wks:
-        index += 1
-        if row[1] == printer_short_name:
-            print('Found printer full name for short name', printer_short_name, row[0])
-            return row[0].replace('"', '')
-    print("Could not find printer full name for short name - ", printer_short_name)
-    exit(-1)
+    full_name = get_snapshot().printer_full_name(printer_short_name)
+    if full_name is not None:
+        print('Found printer full name for short name', printer_short_name, full_name)
+        return full_name.replace('"', '')
+    return None
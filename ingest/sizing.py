@@ -0,0 +1,126 @@
+"""
+Size the Slurm jobs of a load from the Ocular output it will read.
+
+The number of pages, lines and characters is taken from the validation pass when it ran, or
+estimated from the file sizes and the average size of the first records otherwise. The loader
+streams pages, lines and characters, so its memory mostly follows the chunks in flight; its run
+time follows the number of characters. Its cores follow what runs in parallel: the loader itself,
+the upload workers a task keeps busy, which a small book with only a few chunks does not, and the
+processes that prepare the characters when chars.json spans several parse shards. Every parse
+process holds a decoded shard and the loader holds the prepared shards submitted ahead. Books whose character upload would take
+longer than SHARD_TARGET_SECONDS are split across a job array of character shards.
+
+The rates below are deliberately conservative. The measured ones are in the metrics each load
+writes (<json dir>.metrics/bulk_load.json) and should be used to tune them.
+"""
+
+import math
+import os
+from itertools import islice
+
+from .chunking import DEFAULT_CHUNK_BYTES
+from .json_stream import iter_json_array
+from .parallel_parse import SHARD_BYTES, SHARDS_AHEAD
+from .upload_pool import DEFAULT_MAX_WORKERS
+
+ARRAYS = ('pages', 'lines', 'chars')
+SAMPLE_RECORDS = 2000
+CHARACTERS_PER_SECOND = 500  # sustained upload rate of one task
+LINES_PER_SECOND = 200
+SETUP_SECONDS = 15 * 60  # character classes, parsing, queueing of the first requests
+TIME_SAFETY_FACTOR = 2.0
+MIN_TIME_SECONDS = 60 * 60
+MAX_TIME_SECONDS = 48 * 60 * 60
+SHARD_TARGET_SECONDS = 8 * 60 * 60  # character upload time per task before the upload is split
+MAX_SHARDS = 8
+BASE_MEMORY_MB = 1000
+DECODED_SIZE_FACTOR = 6  # bytes of Python objects per byte of JSON
+MEM_PER_CPU_MB = 1999  # RM-shared hands out memory per core
+CHUNKS_HELD_PER_WORKER = 3  # in flight, plus the two the pipeline keeps ready for each worker
+LOADER_CPUS = 1  # reading, the pipeline stages and the journal
+UPLOAD_WORKERS_PER_CPU = 2  # upload threads mostly wait on the API
+PARSE_PROCESS_MEMORY_MB = 150  # interpreter and normalization table of a parse process
+MIN_CPUS = 2
+MAX_CPUS = 10
+
+
+class JobSize:
+    def __init__(self, counts, cpus, memory_mb, time_seconds, shards, upload_workers, parse_processes=1):
+        self.counts = counts
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.mem_per_cpu_mb = MEM_PER_CPU_MB
+        self.time_seconds = time_seconds
+        self.shards = shards
+        self.upload_workers = upload_workers
+        self.parse_processes = parse_processes  # 1 reads the characters in the loader process
+
+    @property
+    def time(self):
+        """
+        Wall time in the HH:MM:SS form sbatch takes
+        """
+        minutes, seconds = divmod(int(self.time_seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+    def describe(self):
+        counts = ', '.join('{} {}'.format(count, array) for array, count in self.counts.items())
+        shards = ' in {} character shards'.format(self.shards) if self.shards > 1 else ''
+        parse = ' ({} parse processes)'.format(self.parse_processes) if self.parse_processes > 1 else ''
+        return '{} - {} cores{}, {} MB, {} wall time per task{}'.format(counts, self.cpus, parse,
+                                                                        int(self.memory_mb), self.time, shards)
+
+
+def _estimate_count(path, array):
+    """
+    Records in an Ocular array, from the file size and the average size of its first records
+    """
+    size = os.path.getsize(path)
+    sample = list(islice(iter_json_array(path, array), SAMPLE_RECORDS))
+    if len(sample) < SAMPLE_RECORDS:
+        return len(sample)
+    sample_bytes = sum(len(str(record)) for record in sample)
+    return int(size * len(sample) / sample_bytes)
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def estimate_job(json_directory, counts=None):
+    """
+    The JobSize of loading the Ocular output in json_directory. counts, if given, maps each
+    Ocular array to its exact number of records.
+    """
+    counts = dict(counts or {})
+    for array in ARRAYS:
+        if array not in counts:
+            counts[array] = _estimate_count('{}/{}.json'.format(json_directory, array), array)
+
+    upload_seconds = counts['chars'] / CHARACTERS_PER_SECOND
+    shards = _clamp(math.ceil(upload_seconds / SHARD_TARGET_SECONDS), 1, MAX_SHARDS)
+    task_seconds = SETUP_SECONDS + counts['lines'] / LINES_PER_SECOND + upload_seconds / shards
+    time_seconds = _clamp(task_seconds * TIME_SAFETY_FACTOR, MIN_TIME_SECONDS, MAX_TIME_SECONDS)
+
+    # every kind of record is sent a few chunks at a time, by no more workers than a task has chunks
+    task_character_bytes = os.path.getsize('{}/chars.json'.format(json_directory)) / shards
+    upload_workers = _clamp(math.ceil(task_character_bytes / DEFAULT_CHUNK_BYTES), 1, DEFAULT_MAX_WORKERS)
+    in_flight_bytes = CHUNKS_HELD_PER_WORKER * upload_workers * DEFAULT_CHUNK_BYTES
+    memory_mb = BASE_MEMORY_MB + in_flight_bytes * DECODED_SIZE_FACTOR / (1024 * 1024)
+
+    cpus = LOADER_CPUS + math.ceil(upload_workers / UPLOAD_WORKERS_PER_CPU)
+
+    # every task prepares all of chars.json, a shard keeps only its own chunks
+    parse_shards = math.ceil(os.path.getsize('{}/chars.json'.format(json_directory)) / SHARD_BYTES)
+    parse_processes = 1
+    if parse_shards > 1 and cpus < MAX_CPUS:
+        parse_processes = _clamp(parse_shards, 2, MAX_CPUS - cpus)
+        cpus += parse_processes
+        shard_mb = SHARD_BYTES / (1024 * 1024)
+        memory_mb += parse_processes * (PARSE_PROCESS_MEMORY_MB + shard_mb * DECODED_SIZE_FACTOR)
+        memory_mb += parse_processes * SHARDS_AHEAD * shard_mb
+
+    cpus = _clamp(max(cpus, math.ceil(memory_mb / MEM_PER_CPU_MB)), MIN_CPUS, MAX_CPUS)
+    return JobSize(counts, cpus, memory_mb, time_seconds, shards, upload_workers, parse_processes)
+
@@ -0,0 +1,152 @@
+"""
+Compressed request bodies for the bulk endpoints.
+
+Bulk payloads are large and very repetitive, so they compress well. The encoder serializes them
+with orjson when it is installed and compresses them with gzip or zstd (when zstandard is
+installed), setting Content-Encoding accordingly. If the server cannot decode an encoded body, the
+encoder drops back to plain JSON for the rest of the run.
+"""
+
+import gzip
+import json
+import logging
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ("gzip", "zstd")
+# what dumps serializes with. Its output differs between the two, so it decides chunk boundaries too.
+SERIALIZER = "orjson" if orjson is not None else "json"
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# what a server that cannot decode the body answers with: 415, or a 400 because the body it read
+# was not JSON. Other 400s are about the records and are not a reason to stop compressing.
+REJECTED_STATUS_CODES = {415}
+DECODE_ERROR_MARKERS = (b"JSON parse error",)
+
+
+class Serialized(bytes):
+    """
+    JSON text that was serialized ahead of time, embedded as is when it is a value of a payload
+    """
+
+
+def json_array(texts):
+    # the serialized JSON of the elements, as one serialized array
+    return Serialized(b"[" + b",".join(texts) + b"]")
+
+
+class SerializedRecords:
+    """
+    Records serialized ahead of time into one JSON array body, that can be sliced by record like a
+    list. starts[i] and ends[i] are the byte offsets of record i in the body; the records of a slice
+    are contiguous, so its body is cut out of the shared one instead of serializing them again.
+    """
+
+    def __init__(self, body, starts, ends):
+        self.body = body
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError("SerializedRecords can only be sliced")
+        start, stop, _ = item.indices(len(self))
+        if start == 0 and stop == len(self):
+            return self
+        return SerializedRecords(self.body, self.starts[start:stop], self.ends[start:stop])
+
+    @property
+    def serialized(self):
+        if not self.starts:
+            return Serialized(b"[]")
+        if self.starts[0] == 1 and self.ends[-1] == len(self.body) - 1:
+            return Serialized(self.body)
+        return Serialized(b"[" + memoryview(self.body)[self.starts[0]:self.ends[-1]] + b"]")
+
+
+def dumps(payload):
+    if isinstance(payload, Serialized):
+        return bytes(payload)
+    if isinstance(payload, dict) and any(isinstance(value, Serialized) for value in payload.values()):
+        return b"{" + b",".join(dumps(key) + b":" + dumps(value) for key, value in payload.items()) + b"}"
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _is_decode_error(response):
+    if response.status_code in REJECTED_STATUS_CODES:
+        return True
+    return response.status_code == 400 and any(marker in response.content for marker in DECODE_ERROR_MARKERS)
+
+
+class BodyEncoder:
+    def __init__(self, encoding="gzip"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown content encoding {encoding}, use one of {ENCODINGS}")
+        if encoding == "zstd" and zstandard is None:
+            logging.info("zstandard is not installed, compressing with gzip instead")
+            encoding = "gzip"
+        self.encoding = encoding
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _compress(self, body, encoding):
+        if encoding == "zstd":
+            # compressor objects are not thread safe, keep one per upload thread
+            if not hasattr(self._local, "zstd"):
+                self._local.zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            return self._local.zstd.compress(body)
+        if encoding == "gzip":
+            return gzip.compress(body, compresslevel=GZIP_LEVEL)
+        return body
+
+    def encode(self, payload):
+        """
+        The request body and headers for a payload
+        """
+        # another upload thread may turn compression off meanwhile
+        encoding = self.encoding
+        body = dumps(payload)
+        encoded = self._compress(body, encoding)
+        with self._lock:
+            self.raw_bytes += len(body)
+            self.sent_bytes += len(encoded)
+        headers = {"Content-Type": "application/json"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return encoded, headers
+
+    def rejected(self, response):
+        """
+        Whether the server refused the compressed body of the response's request. If so, later
+        bodies are sent uncompressed and the caller should send the payload again. Decided from the
+        request itself, since other requests in flight may have turned compression off already.
+        """
+        encoding = response.request.headers.get("Content-Encoding")
+        if encoding is None or not _is_decode_error(response):
+            return False
+        with self._lock:
+            if self.encoding is not None:
+                logging.info(f"Server rejected {encoding} request body ({response.status_code}), "
+                             f"sending uncompressed JSON from now on")
+                self.encoding = None
+        return True
+
+    def summary(self):
+        ratio = self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.0
+        return {"JSON bytes": self.raw_bytes, "Bytes sent": self.sent_bytes, "Compression ratio": round(ratio, 2)}
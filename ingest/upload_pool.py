@@ -0,0 +1,91 @@
+"""
+Bounded, self-tuning thread pool used to keep several bulk upload requests in flight.
+"""
+
+import concurrent.futures
+import contextvars
+import logging
+import time
+
+import requests
+
+DEFAULT_MAX_WORKERS = 4
+SLOW_LATENCY_FACTOR = 2.0  # latency this many times the best seen counts as congestion
+LATENCY_SMOOTHING = 0.3
+
+
+class AdaptiveUploader:
+    """
+    Run an upload function over a stream of payloads with a limit on the requests in flight.
+
+    The limit follows additive-increase/multiplicative-decrease: it grows by one after a full
+    round of healthy responses, stops growing while latency is well above the best observed,
+    and halves on a 5xx response, a timeout or a connection error. It never exceeds max_workers.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, initial_workers=None):
+        self.max_workers = max(1, max_workers)
+        self.limit = min(self.max_workers, initial_workers or max(1, self.max_workers // 2))
+        self.latency = None
+        self.best_latency = None
+        self.healthy_in_round = 0
+
+    def _is_failure(self, result, error):
+        if error is not None:
+            return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+        # results may be responses, or chunk outcomes that count server errors hidden by retries
+        return getattr(result, "status_code", 200) >= 500 or getattr(result, "server_errors", 0) > 0
+
+    def _record(self, elapsed, failed):
+        if failed:
+            self.limit = max(1, self.limit // 2)
+            self.healthy_in_round = 0
+            logging.info({"Upload concurrency reduced to": self.limit})
+            return
+        self.latency = elapsed if self.latency is None else \
+            LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * self.latency
+        self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+        if self.latency > SLOW_LATENCY_FACTOR * self.best_latency:
+            self.healthy_in_round = 0
+            return
+        self.healthy_in_round += 1
+        if self.healthy_in_round >= self.limit and self.limit < self.max_workers:
+            self.limit += 1
+            self.healthy_in_round = 0
+            logging.info({"Upload concurrency increased to": self.limit})
+
+    def map(self, upload, payloads):
+        """
+        Call upload(payload) for every payload, pulling payloads lazily so that only the ones
+        in flight are held in memory. Yields (payload, result, error) in completion order;
+        exactly one of result and error is None.
+        """
+        payloads = iter(payloads)
+        exhausted = False
+        pending = {}
+
+        def timed(payload):
+            start = time.monotonic()
+            try:
+                return upload(payload), None, time.monotonic() - start
+            except Exception as ex:
+                return None, ex, time.monotonic() - start
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while not exhausted and len(pending) < self.limit:
+                    try:
+                        payload = next(payloads)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    # in the context of the caller, so what the upload logs goes where the caller's does
+                    pending[executor.submit(contextvars.copy_context().run, timed, payload)] = payload
+                if not pending:
+                    return
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    payload = pending.pop(future)
+                    result, error, elapsed = future.result()
+                    self._record(elapsed, self._is_failure(result, error))
+                    yield payload, result, error
@@ -1,3 +1,7 @@
+import hashlib
+import os
+
+
 def confirm(prompt=None, resp=False):
     """prompts for yes or no response from the user. Returns True for yes and
     False for no.
@@ -36,3 +40,17 @@ def confirm(prompt=None, resp=False):
             return True
         if ans == 'n' or ans == 'N':
             return False
+
+
+def file_sha256(path, block_size=1 << 20):
+    """Hex SHA-256 digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sidecar_path(directory, suffix):
+    """Path of a file kept alongside (not inside) a directory."""
+    return os.path.normpath(directory) + suffix
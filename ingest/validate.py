@@ -0,0 +1,145 @@
+"""
+Pre-flight validation of Ocular output, run before a book is created and its load is queued.
+
+One streaming pass over pages.json, lines.json and chars.json checks that every record has the
+fields the loader needs, that ids are unique and that lines point at existing pages and
+characters at existing lines. Records are checked in batches with set operations rather than
+one at a time. Problems are counted per kind with a few examples each, so a broken book is
+reported in one short summary.
+"""
+
+import json
+from itertools import islice
+
+try:
+    from .json_stream import iter_json_array
+except ImportError:  # imported by bulk_load_json.py run as a script
+    from json_stream import iter_json_array
+
+BATCH_SIZE = 10000
+MAX_EXAMPLES = 3
+# Ocular array -> fields every record needs
+REQUIRED_FIELDS = {
+    "pages": ("id",),
+    "lines": ("id", "page_id"),
+    "chars": ("id", "line_id", "character_class"),
+}
+# Ocular array -> (field, referenced array)
+REFERENCES = {"lines": ("page_id", "pages"), "chars": ("line_id", "lines")}
+
+
+class ValidationReport:
+    def __init__(self, json_directory):
+        self.json_directory = json_directory
+        self.counts = {}  # array -> records checked
+        self.problems = {}  # (array, problem) -> [count, examples]
+
+    def add(self, array, problem, count, examples):
+        entry = self.problems.setdefault((array, problem), [0, []])
+        entry[0] += count
+        entry[1].extend(examples[:MAX_EXAMPLES - len(entry[1])])
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def summary(self):
+        counts = ", ".join(f"{count} {array}" for array, count in self.counts.items())
+        if self.ok:
+            return f"Ocular output in {self.json_directory} is valid ({counts})"
+        lines = [f"Ocular output in {self.json_directory} failed validation ({counts}):"]
+        for (array, problem), (count, examples) in self.problems.items():
+            lines.append(f"  {array}: {count} {problem}" + (f" - e.g. {', '.join(examples)}" if examples else ""))
+        return "\n".join(lines)
+
+
+def _batches(records):
+    while True:
+        batch = list(islice(records, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def _check_fields(report, array, batch):
+    for field in REQUIRED_FIELDS[array]:
+        # fast path: the whole batch has the field
+        if all(record.get(field) is not None for record in batch):
+            continue
+        missing = [record for record in batch if record.get(field) is None]
+        report.add(array, f"records without '{field}'", len(missing),
+                   [str(record.get("id", record))[:80] for record in missing])
+    if array == "chars":
+        not_strings = [record for record in batch
+                       if record.get("character_class") is not None and not isinstance(record["character_class"], str)]
+        if not_strings:
+            report.add(array, "characters whose 'character_class' is not a string", len(not_strings),
+                       [str(record.get("id")) for record in not_strings])
+
+
+def _check_duplicates(report, array, keys, seen, ids):
+    # keys are the ids themselves, or their hashes where only uniqueness matters
+    batch_keys = set(keys)
+    if len(batch_keys) != len(keys) or not seen.isdisjoint(batch_keys):
+        duplicates = []
+        batch_seen = set()
+        for key, record_id in zip(keys, ids):
+            if key in seen or key in batch_seen:
+                duplicates.append(str(record_id))
+            batch_seen.add(key)
+        report.add(array, "duplicate ids", len(duplicates), duplicates)
+    seen |= batch_keys
+
+
+def _check_references(report, array, batch, known_ids):
+    field, target = REFERENCES[array]
+    missing = {record.get(field) for record in batch} - known_ids
+    missing.discard(None)  # reported as a missing field
+    if missing:
+        dangling = [record for record in batch if record.get(field) in missing]
+        report.add(array, f"records referencing missing {target}", len(dangling),
+                   [f"{record.get('id')} -> {record.get(field)}" for record in dangling])
+
+
+def _scan(report, array, path, known_ids=None, keep_ids=True):
+    """
+    Check one Ocular array. Returns the set of its ids when keep_ids, for the next array's references.
+    """
+    ids_seen = set()
+    count = 0
+    try:
+        for batch in _batches(iter_json_array(path, array)):
+            count += len(batch)
+            if not all(isinstance(record, dict) for record in batch):
+                not_objects = [record for record in batch if not isinstance(record, dict)]
+                report.add(array, "records that are not objects", len(not_objects),
+                           [json.dumps(record)[:80] for record in not_objects])
+                batch = [record for record in batch if isinstance(record, dict)]
+            _check_fields(report, array, batch)
+            ids = [record["id"] for record in batch if record.get("id") is not None]
+            # only uniqueness matters for characters, so keep 64-bit hashes rather than every id string
+            keys = ids if keep_ids else [hash(record_id) for record_id in ids]
+            _check_duplicates(report, array, keys, ids_seen, ids)
+            if known_ids is not None:
+                _check_references(report, array, batch, known_ids)
+    except OSError as ex:
+        report.add(array, "file could not be read", 1, [str(ex)])
+    except KeyError:
+        report.add(array, f"file has no '{array}' array", 1, [path])
+    except ValueError as ex:
+        report.add(array, "file is not valid JSON", 1, [f"after {count} records: {str(ex)[:200]}"])
+    report.counts[array] = count
+    if count == 0 and not any(problem_array == array for problem_array, _ in report.problems):
+        report.add(array, "records, the array is empty", 0, [])
+    return ids_seen
+
+
+def validate_book(json_directory):
+    """
+    Validate the Ocular output in json_directory and return a ValidationReport
+    """
+    report = ValidationReport(json_directory)
+    page_ids = _scan(report, "pages", f"{json_directory}/pages.json")
+    line_ids = _scan(report, "lines", f"{json_directory}/lines.json", page_ids)
+    _scan(report, "chars", f"{json_directory}/chars.json", line_ids, keep_ids=False)
+    return report
@@ -0,0 +1,34 @@
+import threading
+import time
+
+from ingest.batch import BatchEntry, _resolve_entries, _unique_entries
+
+
+def test_repeated_book_strings_are_dropped():
+    entries = _unique_entries([BatchEntry('a_1'), BatchEntry('b_2'), BatchEntry('a_1', 'uuid')])
+    assert [(entry.book_string, entry.preexisting_uuid) for entry in entries] == [('a_1', None), ('b_2', None)]
+
+
+def test_entries_of_one_estc_number_are_resolved_one_after_another():
+    entries = [BatchEntry(book_string) for book_string in ('a_100', 'b_100', 'c_200', 'd_100', 'e_300')]
+    lock = threading.Lock()
+    running = {}
+    overlaps = []
+    resolved = []
+
+    def resolve(entry):
+        estc = entry.book_string.split('_')[1]
+        with lock:
+            if running.get(estc):
+                overlaps.append(entry.book_string)
+            running[estc] = True
+        time.sleep(0.05)
+        with lock:
+            running[estc] = False
+            resolved.append(entry.book_string)
+
+    _resolve_entries(entries, resolve, workers=4)
+    assert overlaps == []
+    assert sorted(resolved) == sorted(entry.book_string for entry in entries)
+    # in the order of the entries within an ESTC number
+    assert [book_string for book_string in resolved if book_string.endswith('_100')] == ['a_100', 'b_100', 'd_100']
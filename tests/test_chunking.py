@@ -0,0 +1,72 @@
+import pytest
+import requests
+
+from ingest.chunking import send_with_split, ServerErrors
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = b"{}"
+
+
+class _Server:
+    """
+    Answers the posts with the given statuses in turn, then with 200, recording the pieces sent
+    """
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.posted = []
+
+    def __call__(self, part):
+        self.posted.append(list(part))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if isinstance(status, Exception):
+            raise status
+        return _Response(status)
+
+
+def test_body_too_large_is_split():
+    server = _Server(413)
+    outcome = send_with_split(server, list(range(8)), backoff_seconds=0)
+    assert outcome.sent == 8
+    assert server.posted[1:] == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+
+def test_server_errors_are_retried_without_splitting():
+    server = _Server(503, requests.exceptions.Timeout(), 502)
+    sent = []
+    outcome = send_with_split(server, list(range(8)), on_sent=lambda start, end: sent.append((start, end)),
+                              backoff_seconds=0)
+    assert outcome.sent == 8
+    assert outcome.server_errors == 3
+    assert all(len(part) == 8 for part in server.posted)
+    assert sent == [(0, 8)]
+
+
+def test_repeated_server_errors_stop_the_load():
+    server = _Server(*[503] * 10)
+    with pytest.raises(ServerErrors):
+        send_with_split(server, list(range(8)), max_retries=3, backoff_seconds=0)
+    assert len(server.posted) == 4
+
+
+def test_client_errors_are_not_retried():
+    server = _Server(400)
+    outcome = send_with_split(server, list(range(8)), backoff_seconds=0)
+    assert outcome.sent == 0
+    assert outcome.failed_count == 8
+    assert len(server.posted) == 1
+
+
+def test_creates_are_not_sent_again_after_a_server_error():
+    server = _Server(503)
+    with pytest.raises(ServerErrors):
+        send_with_split(server, list(range(8)), idempotent=False, backoff_seconds=0)
+    assert len(server.posted) == 1
+
+
+def test_creates_are_split_when_too_large():
+    server = _Server(413)
+    assert send_with_split(server, list(range(8)), idempotent=False, backoff_seconds=0).sent == 8
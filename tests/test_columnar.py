@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from benchmarks.mock_api import MockAPI
+from benchmarks.synthetic_book import generate_book
+from ingest.api_client import APIClient
+from ingest.bulk_load_json import BookLoader, CharacterClasses
+from ingest.columnar import compile_columnar, ColumnarTable
+from ingest.transport import dumps
+
+
+def _compile(tmp_path, records):
+    source = tmp_path / "chars.json"
+    source.write_text(json.dumps({"chars": records}))
+    compile_columnar(str(source), "chars", str(tmp_path / "chars.col"))
+    table = ColumnarTable(str(tmp_path / "chars.col"))
+    return table, {column["name"]: column["kind"] for column in table.header["columns"]}
+
+
+def _assert_same_records(table, records):
+    # compared serialized, since 3 == 3.0
+    assert [dumps(record) for record in table.iter_records()] == [dumps(record) for record in records]
+
+
+def test_integers_and_floats_share_a_float_column(tmp_path):
+    records = [{"offset": 3}, {"offset": None}, {}, {"offset": 2.5}, {"offset": 7}, {"offset": 4.0}, {"offset": -1}]
+    table, kinds = _compile(tmp_path, records)
+    assert kinds["offset"] == "float"
+    _assert_same_records(table, records)
+    assert [type(record.get("offset")) for record in table.iter_records()] == \
+        [int, type(None), type(None), float, int, float, int]
+    table.close()
+
+
+def test_floats_then_integers_keep_their_types(tmp_path):
+    records = [{"offset": 0.5}, {"offset": 2}, {}, {"offset": 1.0}]
+    table, kinds = _compile(tmp_path, records)
+    assert kinds["offset"] == "float"
+    _assert_same_records(table, records)
+    table.close()
+
+
+def test_integers_too_large_for_a_float_stay_exact(tmp_path):
+    records = [{"offset": 2 ** 60 + 1}, {"offset": 0.5}, {"offset": 1.5}, {"offset": 2 ** 60 + 3}]
+    table, kinds = _compile(tmp_path, records)
+    assert kinds["offset"] == "json"
+    _assert_same_records(table, records)
+    table.close()
+
+
+def test_mixed_columns_fall_back_to_json_with_their_types(tmp_path):
+    records = [{"offset": 1}, {"offset": 2.5}, {"offset": "x"}, {"offset": 4}]
+    table, kinds = _compile(tmp_path, records)
+    assert kinds["offset"] == "json"
+    _assert_same_records(table, records)
+    table.close()
+
+
+def test_a_load_cannot_resume_with_the_cache_switched(tmp_path):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=100)
+    with MockAPI() as api:
+        client = APIClient(url=api.url, token="test")
+        character_classes = CharacterClasses(str(tmp_path / "character_classes.json"), client=client)
+
+        def loader(**options):
+            return BookLoader("book", json_directory, client=client, character_classes=character_classes, **options)
+
+        assert loader().open_journal()
+        with pytest.raises(Exception, match="cannot resume"):
+            loader(resume=True, columnar_cache=True).open_journal()
+        assert loader(resume=True).open_journal()
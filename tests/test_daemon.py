@@ -0,0 +1,76 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+from ingest import daemon
+from ingest.lookups import LookupGraph
+
+
+def test_requests_without_a_book_go_to_failed(tmp_path):
+    spool = str(tmp_path)
+    for state in daemon.SPOOL_DIRECTORIES:
+        os.makedirs(os.path.join(spool, state))
+    with open(os.path.join(spool, "incoming", "1-nobook.json"), "w") as f:
+        json.dump({"uuid": None}, f)
+    with open(os.path.join(spool, "incoming", "2-list.json"), "w") as f:
+        json.dump(["a_1"], f)
+    request_id = daemon.enqueue(spool, "book_1")
+
+    claimed = daemon.IngestDaemon(spool)._claim()
+    assert [claimed_id for claimed_id, _ in claimed] == [request_id]
+    assert sorted(os.listdir(os.path.join(spool, "failed"))) == ["1-nobook.json", "2-list.json"]
+
+
+def test_output_of_other_threads_goes_to_the_request_log(tmp_path):
+    output = daemon._RequestOutput(io.StringIO())
+    logger = logging.getLogger("test_daemon")
+    handler = logging.StreamHandler(output)
+    logger.addHandler(handler)
+    try:
+        with open(tmp_path / "request.log", "w") as log_file:
+            token = daemon._request_log.set(log_file)
+            try:
+                lookups = LookupGraph()
+                lookups.add("lookup", lambda: logger.warning("from a lookup"))
+                lookups.result("lookup")
+            finally:
+                daemon._request_log.reset(token)
+        logger.warning("from the daemon")
+    finally:
+        logger.removeHandler(handler)
+    assert (tmp_path / "request.log").read_text() == "from a lookup\n"
+    assert output.stream.getvalue() == "from the daemon\n"
+
+
+def test_loads_of_one_book_do_not_overlap(tmp_path, monkeypatch):
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+
+    class _Loader:
+        def __init__(self, book_uuid, json_directory, **options):
+            self.book_uuid = book_uuid
+            self.parse_processes = options['parse_processes']
+
+        def load_db(self):
+            with lock:
+                overlaps.extend(book for book in running if book == self.book_uuid)
+                running.append(self.book_uuid)
+            time.sleep(0.05)
+            with lock:
+                running.remove(self.book_uuid)
+
+    monkeypatch.setattr(daemon, 'BookLoader', _Loader)
+    monkeypatch.setattr(daemon, 'available_cpus', lambda: 8)
+    ingest_daemon = daemon.IngestDaemon(str(tmp_path), workers=4, load_here=True)
+    assert ingest_daemon.parse_processes == 2
+    threads = [threading.Thread(target=ingest_daemon._load, args=(book_uuid, 'json', False, False))
+               for book_uuid in ('a', 'a', 'b', 'a')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == []
@@ -0,0 +1,100 @@
+import pytest
+
+from benchmarks.mock_api import MockAPI
+from benchmarks.synthetic_book import generate_book
+from ingest.api_client import APIClient
+from ingest.bulk_load_json import BookLoader, CharacterClasses
+from ingest.fingerprint import read_record
+
+BOOK_ID = "00000000-0000-4000-8000-000000000000"
+
+
+@pytest.fixture
+def api():
+    with MockAPI() as api:
+        yield api
+
+
+@pytest.fixture
+def client(api):
+    return APIClient(url=api.url, token="test")
+
+
+def _load(tmp_path, client, json_directory, **options):
+    character_classes = CharacterClasses(str(tmp_path / "character_classes.json"), client=client)
+    character_classes.load_character_classes()
+    loader = BookLoader(BOOK_ID, json_directory, client=client, character_classes=character_classes,
+                        parse_processes=1, **options)
+    loader.load_db()
+    return loader
+
+
+def _bulk_requests(api):
+    return sum(count for kind, count in api.state.snapshot()["requests"].items()
+               if kind in ("pages", "lines", "characters"))
+
+
+def test_repeat_load_of_unchanged_output_exits_early(tmp_path, api, client):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=2000)
+    loader = _load(tmp_path, client, json_directory)
+    assert loader.metrics.status == "complete"
+    # closed once the load finished
+    assert loader.manifest is None
+    requests = _bulk_requests(api)
+
+    loader = _load(tmp_path, client, json_directory)
+    assert loader.metrics.status == "unchanged"
+    assert _bulk_requests(api) == requests
+
+    assert _load(tmp_path, client, json_directory, force=True).metrics.status == "complete"
+    assert _bulk_requests(api) > requests
+
+
+def test_output_is_loaded_again_when_its_run_is_gone(tmp_path, api, client):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=2000)
+    _load(tmp_path, client, json_directory)
+    api.state.runs.clear()
+    assert _load(tmp_path, client, json_directory).metrics.status == "complete"
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = b"{}"
+
+
+@pytest.mark.parametrize("status_code, exists", [(200, True), (404, False)])
+def test_character_run_exists(client, monkeypatch, status_code, exists):
+    monkeypatch.setattr(client, "request", lambda *args, **kwargs: _Response(status_code))
+    assert client.character_run_exists("run") is exists
+
+
+@pytest.mark.parametrize("status_code", [401, 503])
+def test_character_run_lookup_failure_is_not_a_deleted_run(client, monkeypatch, status_code):
+    monkeypatch.setattr(client, "request", lambda *args, **kwargs: _Response(status_code))
+    with pytest.raises(Exception, match="Could not look up character run"):
+        client.character_run_exists("run")
+
+
+def test_shards_of_an_earlier_load_do_not_complete_a_new_one(tmp_path, api, client):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=2000)
+    _load(tmp_path, client, json_directory, character_shards=2)
+    for index in range(2):
+        _load(tmp_path, client, json_directory, shard=(index, 2))
+    first_run = read_record(json_directory)["character_run"]
+
+    _load(tmp_path, client, json_directory, character_shards=2, force=True)
+    _load(tmp_path, client, json_directory, shard=(0, 2), force=True)
+    # shard 1 only completed for the first run
+    assert read_record(json_directory) is None
+    assert _load(tmp_path, client, json_directory).metrics.status == "complete"
+
+    _load(tmp_path, client, json_directory, character_shards=2, force=True)
+    for index in range(2):
+        _load(tmp_path, client, json_directory, shard=(index, 2), force=True)
+    record = read_record(json_directory)
+    assert record["character_run"] != first_run
+    assert _load(tmp_path, client, json_directory).metrics.status == "unchanged"
@@ -0,0 +1,36 @@
+import pytest
+
+from ingest import ingest
+from ingest.sheets import sheet
+
+
+class _Snapshot:
+    def printer_full_name(self, printer_short_name):
+        return None
+
+
+@pytest.fixture
+def book_without_sheet_uuid(monkeypatch):
+    monkeypatch.setattr(sheet, 'get_snapshot', lambda: _Snapshot())
+    monkeypatch.setattr(ingest, '_uuid_from_sheet', lambda book_string: None)
+    monkeypatch.setattr(ingest, '_existing_books_for_estc', lambda estc: None)
+    monkeypatch.setattr(ingest, '_get_vid', lambda estc: 'vid')
+    monkeypatch.setattr(ingest, '_retrieve_metadata', lambda vid: {'eebo': 'vid'})
+    created = []
+    monkeypatch.setattr(ingest, '_create_new_book_with_data', lambda metadata, printer: created.append(printer))
+    return created
+
+
+def test_missing_printer_is_not_an_error_for_a_lookup(book_without_sheet_uuid):
+    assert ingest._get_printer_name_from_sheet('nobody') is None
+
+
+def test_missing_printer_stops_the_book_that_needs_it(book_without_sheet_uuid):
+    with pytest.raises(SystemExit):
+        ingest._resolve_book('nobody_123', None, None, False)
+    assert book_without_sheet_uuid == []
+
+
+def test_missing_printer_does_not_matter_for_an_existing_book(book_without_sheet_uuid, monkeypatch):
+    monkeypatch.setattr(ingest, '_existing_books_for_estc', lambda estc: [{'id': 'uuid', 'is_eebo_book': False}])
+    assert ingest._resolve_book('nobody_123', None, None, False) == ('uuid', False)
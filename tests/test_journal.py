@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from benchmarks.mock_api import MockAPI
+from benchmarks.synthetic_book import generate_book
+from ingest.api_client import APIClient
+from ingest.bulk_load_json import BookLoader, CharacterClasses
+from ingest.journal import LoadJournal
+
+
+def _journal(tmp_path):
+    journal = LoadJournal(str(tmp_path / "book.load_journal"))
+    journal.start(book_id="book", update=False, chunk_bytes=1000)
+    journal.record_character_run(7)
+    journal.commit_range("pages", 0, 0, 10)
+    journal.mark_done("pages")
+    journal.commit_range("lines", 0, 0, 4)
+    journal.commit_range("lines", 0, 6, 8)
+    return journal
+
+
+def test_a_journal_reads_back_what_was_appended(tmp_path):
+    journal = _journal(tmp_path)
+    read = LoadJournal(journal.path)
+    assert read.read()
+    assert read.header["chunk_bytes"] == 1000
+    assert read.character_run_id == 7
+    assert read.is_done("pages") and not read.is_done("lines")
+    assert read.pending_ranges("lines", 0, 10) == [(4, 6), (8, 10)]
+    assert read.pending_ranges("lines", 1, 5) == [(0, 5)]
+    assert not read.complete
+
+
+def test_a_torn_last_line_is_ignored_and_later_entries_are_kept(tmp_path):
+    journal = _journal(tmp_path)
+    with open(journal.path, "a") as f:
+        f.write('{"event": "chunk", "kind": "lines", "chunk": 0, "st')
+
+    resumed = LoadJournal(journal.path)
+    assert resumed.read()
+    assert resumed.pending_ranges("lines", 0, 10) == [(4, 6), (8, 10)]
+    # entries appended by the resumed load must not be lost with the torn line
+    resumed.commit_range("lines", 0, 4, 6)
+    resumed.mark_complete()
+
+    read = LoadJournal(journal.path)
+    assert read.read()
+    assert read.pending_ranges("lines", 0, 10) == [(8, 10)]
+    assert read.complete
+
+
+def test_a_torn_header_is_no_journal(tmp_path):
+    path = tmp_path / "book.load_journal"
+    path.write_text('{"event": "start", "book_id": "bo')
+    assert not LoadJournal(str(path)).read()
+    assert not LoadJournal(str(tmp_path / "missing")).read()
+
+
+def test_a_load_cannot_resume_the_journal_of_another_load(tmp_path):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=100)
+    with MockAPI() as api:
+        client = APIClient(url=api.url, token="test")
+        character_classes = CharacterClasses(str(tmp_path / "character_classes.json"), client=client)
+
+        def loader(book_id="book", **options):
+            return BookLoader(book_id, json_directory, client=client, character_classes=character_classes, **options)
+
+        assert loader().open_journal()
+        for book_id, options in [("other", {}), ("book", {"update": True}),
+                                 ("book", {"update": True, "differential": True})]:
+            with pytest.raises(Exception, match="belongs to another load"):
+                loader(book_id, resume=True, **options).open_journal()
+
+        # records serialized by another library can come out as other bytes
+        journal = LoadJournal.for_directory(json_directory)
+        with open(journal.path) as f:
+            entries = [json.loads(line) for line in f]
+        entries[0]["serializer"] = "something-else"
+        with open(journal.path, "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        with pytest.raises(Exception, match="cannot resume"):
+            loader(resume=True).open_journal()
+
+        # without resume the journal is started over
+        assert loader().open_journal()
+        resumed = loader(resume=True)
+        assert resumed.open_journal() and resumed.resuming
@@ -0,0 +1,86 @@
+import json
+from collections import Counter
+
+import pytest
+
+from ingest.json_stream import iter_json_array, scan_string_counts
+
+RECORDS = [
+    {"char": "a", "text": "quote \" and backslash \\ and },{ inside", "x": 12345},
+    {"char": "é", "text": "escaped \\\" pair", "x": -0.25},
+    {"char": "\"", "text": "—😀", "x": 1e-05, "nested": {"chars": [1, 2]}},
+    {"char": "\\", "text": "", "x": None, "flag": True},
+]
+
+
+def _write(tmp_path, text, encoding="utf-8"):
+    path = tmp_path / "chars.json"
+    path.write_bytes(text.encode(encoding))
+    return str(path)
+
+
+def test_records_match_the_decoded_file_at_every_buffer_size(tmp_path):
+    text = json.dumps({"meta": {"chars": ["not", "these"]}, "chars": RECORDS, "after": [1]}, ensure_ascii=False)
+    path = _write(tmp_path, text)
+    # small reads put buffer boundaries inside strings, escapes, numbers and literals
+    for read_size in range(1, 24):
+        assert list(iter_json_array(path, "chars", read_size=read_size)) == RECORDS
+    assert list(iter_json_array(path, "chars")) == RECORDS
+
+
+def test_escapes_split_by_the_buffer_decode_once(tmp_path):
+    text = '{"chars": ["\\\\", "\\"", "\\u00e9", "\\ud83d\\ude00"]}'
+    path = _write(tmp_path, text)
+    for read_size in range(1, 8):
+        assert list(iter_json_array(path, "chars", read_size=read_size)) == ["\\", "\"", "é", "\U0001F600"]
+
+
+def test_whitespace_and_byte_order_mark(tmp_path):
+    text = "\r\n{\t\"chars\" :\r\n [ \n" + ",\n\t".join(json.dumps(record) for record in RECORDS) + " \r\n] ,\n \"pages\": [] }\n"
+    for encoding in ("utf-8", "utf-8-sig"):
+        path = _write(tmp_path, text, encoding)
+        assert list(iter_json_array(path, "chars", read_size=3)) == RECORDS
+        assert list(iter_json_array(path, "pages")) == []
+
+
+def test_empty_object_and_missing_key(tmp_path):
+    path = _write(tmp_path, '{"pages": [1]}')
+    with pytest.raises(KeyError):
+        list(iter_json_array(path, "chars"))
+    path = _write(tmp_path, " { } ")
+    with pytest.raises(KeyError):
+        list(iter_json_array(path, "chars"))
+
+
+@pytest.mark.parametrize("text", [
+    '{"chars": [{"a": 1}, {"a": 2}',
+    '{"chars": [{"a": 1}, {"a": 2},',
+    '{"chars": [{"a": 1}, {"a": 2}, {"a"',
+    '{"chars": [{"a": 1}, {"a": 2}, "unterminated',
+])
+def test_truncated_array_raises_after_the_complete_records(tmp_path, text):
+    path = _write(tmp_path, text)
+    for read_size in (1, 5, 1 << 20):
+        records = iter_json_array(path, "chars", read_size=read_size)
+        assert next(records) == {"a": 1}
+        assert next(records) == {"a": 2}
+        with pytest.raises(ValueError):
+            next(records)
+
+
+def test_string_counts_match_the_decoded_records(tmp_path):
+    records = RECORDS * 3 + [{"char": "a"}, {"char": 5}, {"char": None}]
+    path = _write(tmp_path, json.dumps({"chars": records}, indent=2))
+    expected = Counter(record["char"] for record in records if isinstance(record["char"], str))
+    for read_size in (1, 7, 64, 1 << 20):
+        assert scan_string_counts(path, "char", read_size=read_size) == expected
+
+
+def test_string_counts_ignore_the_key_inside_strings(tmp_path):
+    records = [
+        {"char": "a", "text": "\"char\": \"b\""},
+        {"char": "a", "\"char": "c"},
+        {"text": "char: d", "chars": "e"},
+    ]
+    path = _write(tmp_path, json.dumps({"chars": records}))
+    assert scan_string_counts(path, "char") == Counter({"a": 2})
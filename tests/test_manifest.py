@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from ingest.manifest import RecordManifest, record_hash
+
+
+def _records(*texts):
+    return [{"id": f"c{i}", "text": text} for i, text in enumerate(texts)]
+
+
+def test_a_differential_pass_yields_new_and_changed_records(tmp_path):
+    with RecordManifest(str(tmp_path / "book.manifest")) as manifest:
+        manifest.begin("book")
+        assert len(list(manifest.track("chars", _records("a", "b", "c")))) == 3
+        manifest.commit()
+
+        manifest.begin("book")
+        changed = list(manifest.changed("chars", _records("a", "x")))
+        assert changed == [{"id": "c1", "text": "x"}]
+        assert manifest.deleted("chars") == ["c2"]
+        manifest.commit()
+
+        manifest.begin("book")
+        assert list(manifest.changed("chars", _records("a", "x"))) == []
+        assert manifest.deleted("chars") == []
+
+
+def test_the_manifest_of_another_book_is_discarded(tmp_path):
+    with RecordManifest(str(tmp_path / "book.manifest")) as manifest:
+        manifest.begin("book")
+        list(manifest.track("chars", _records("a")))
+        manifest.commit()
+        manifest.begin("other")
+        assert len(list(manifest.changed("chars", _records("a")))) == 1
+
+
+def test_a_resumed_load_keeps_what_it_staged(tmp_path):
+    path = str(tmp_path / "book.manifest")
+    with RecordManifest(path) as manifest:
+        manifest.begin("book")
+        list(manifest.track("chars", _records("a", "b")))
+    with RecordManifest(path) as manifest:
+        manifest.begin("book", resume=True)
+        list(manifest.track("chars", _records("a")))
+        manifest.commit()
+        manifest.begin("book")
+        list(manifest.changed("chars", _records("a")))
+        assert manifest.deleted("chars") == ["c1"]
+
+
+def test_hashes_do_not_depend_on_key_order():
+    assert record_hash({"id": 1, "text": "a"}) == record_hash({"text": "a", "id": 1})
+    assert record_hash({"id": 1, "text": "a"}) != record_hash({"id": 1, "text": "b"})
+
+
+def test_closed_manifest_releases_its_database(tmp_path):
+    manifest = RecordManifest(str(tmp_path / "book.manifest"))
+    manifest.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        manifest.book_id()
@@ -0,0 +1,19 @@
+from ingest.metrics import LoadMetrics
+
+
+def test_prometheus_series_do_not_use_the_job_label(tmp_path):
+    metrics = LoadMetrics("bulk_load", book="b1", shard=0)
+    metrics.add_time("pages", 1.5)
+    metrics.count("records_sent", 10, kind="pages")
+    metrics.observe("request_seconds", 0.2, kind="pages")
+    metrics.status = "complete"
+    series = [line for line in metrics.prometheus().splitlines() if not line.startswith("#")]
+    assert series
+    # Prometheus sets job to the scrape job, and would rename ours to exported_job
+    assert not any("{job=" in line or ",job=" in line for line in series)
+    assert 'ingest_book_phase_seconds{book_job="bulk_load",book="b1",shard="0",phase="pages"} 1.500' in series
+    assert 'ingest_book_success{book_job="bulk_load",book="b1",shard="0"} 1' in series
+
+    metrics.write(str(tmp_path))
+    assert 'ingest_book_success{book_job="bulk_load",book="b1",shard="0"} 1' in \
+        (tmp_path / "bulk_load.prom").read_text().splitlines()
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from ingest import parallel_parse
+from ingest.parallel_parse import plan_shards, prepare_shard
+
+# text that looks like record boundaries, and records after them, from inside a string
+TRICKY_TEXTS = ["}, {", "x},{}, {}, {}", "\"},{\"", "\\\"}, {\"id\": \"c0\"}, {\"id\": \"c1\"}", "}]}"]
+
+
+@pytest.fixture(autouse=True)
+def table(monkeypatch):
+    monkeypatch.setattr(parallel_parse, "_table", {"a": "A"})
+
+
+def _write(tmp_path, records, indent=None):
+    path = tmp_path / "chars.json"
+    path.write_text(json.dumps({"chars": records}, indent=indent))
+    return str(path)
+
+
+def _records(count):
+    return [{"id": f"c{i}", "character_class": "a", "text": TRICKY_TEXTS[i % len(TRICKY_TEXTS)] * (1 + i % 3)}
+            for i in range(count)]
+
+
+def _prepared(path, shards):
+    ids = []
+    for start, end in shards:
+        for _, _, _, hashed in prepare_shard(path, "chars", start, end, 1000):
+            ids.extend(record_id for record_id, _ in hashed)
+    return ids
+
+
+@pytest.mark.parametrize("indent", [None, 1])
+def test_cuts_inside_strings_are_not_taken_for_record_boundaries(tmp_path, indent):
+    records = _records(400)
+    path = _write(tmp_path, records, indent)
+    with open(path, "rb") as f:
+        data = f.read()
+    for shard_bytes in (64, 100, 257, 1000):
+        shards = plan_shards(path, "chars", shard_bytes)
+        assert len(shards) > 1
+        for start, _ in shards:
+            # every shard starts at the opening brace of a record
+            record, _ = json.JSONDecoder().raw_decode(data[start:].decode("utf-8"))
+            assert record in records
+        assert [end for _, end in shards[:-1]] == [start for start, _ in shards[1:]]
+        assert _prepared(path, shards) == [record["id"] for record in records]
+
+
+def test_a_shard_is_the_records_of_its_byte_range(tmp_path):
+    records = _records(50)
+    path = _write(tmp_path, records)
+    shards = plan_shards(path, "chars", 200)
+    chunks = prepare_shard(path, "chars", *shards[1], 1000)
+    body, starts, ends, hashed = chunks[0]
+    decoded = json.loads(body)
+    assert decoded[0]["id"] == hashed[0][0]
+    # normalized with the table given to the workers
+    assert {record["character_class"] for record in decoded} == {"A"}
+    assert [json.loads(body[start:end]) for start, end in zip(starts, ends)] == decoded
+
+
+def test_a_shard_that_does_not_start_at_a_record_fails(tmp_path):
+    path = _write(tmp_path, _records(20))
+    (start, end), = plan_shards(path, "chars", 1 << 20)
+    with pytest.raises(ValueError, match="does not start and end at records"):
+        prepare_shard(path, "chars", start + 1, end, 1000)
+
+
+@pytest.mark.parametrize("document", [
+    {"pages": [], "chars": [{"id": "c0", "character_class": "a"}]},
+    {"chars": [1, 2, 3]},
+    {"chars": []},
+])
+def test_arrays_that_cannot_be_cut_are_streamed(tmp_path, document):
+    path = tmp_path / "chars.json"
+    path.write_text(json.dumps(document))
+    assert plan_shards(str(path), "chars", 16) is None
@@ -0,0 +1,46 @@
+import json
+
+from ingest.parallel_parse import SHARD_BYTES
+from ingest.sizing import estimate_job, MIN_CPUS, MAX_CPUS
+
+
+def _ocular_output(directory, characters, character_bytes=100):
+    directory.mkdir()
+    (directory / 'pages.json').write_text(json.dumps({'pages': [{'id': 'p0'}]}))
+    (directory / 'lines.json').write_text(json.dumps({'lines': [{'id': 'l0', 'page_id': 'p0'}]}))
+    # only the size of chars.json matters when the counts are given, so it is left sparse
+    with open(directory / 'chars.json', 'wb') as f:
+        f.truncate(characters * character_bytes)
+    return {'pages': 1, 'lines': 1, 'chars': characters}
+
+
+def _job(tmp_path, characters):
+    directory = tmp_path / str(characters)
+    return estimate_job(str(directory), _ocular_output(directory, characters))
+
+
+def test_large_book_gets_more_cores_and_memory(tmp_path):
+    small = _job(tmp_path, 5000)
+    large = _job(tmp_path, 5000000)
+    assert small.cpus == MIN_CPUS
+    assert large.cpus > small.cpus
+    assert large.memory_mb > small.memory_mb
+    assert large.upload_workers > small.upload_workers
+
+
+def test_job_size_stays_within_the_partition(tmp_path):
+    for characters in (5000, 500000, 5000000, 50000000):
+        job = _job(tmp_path, characters)
+        assert MIN_CPUS <= job.cpus <= MAX_CPUS
+        # the memory is requested per core
+        assert job.memory_mb <= job.cpus * job.mem_per_cpu_mb
+
+
+def test_cores_and_memory_are_reserved_for_the_parse_processes(tmp_path):
+    small = _job(tmp_path, 5000)
+    large = _job(tmp_path, 5000000)
+    assert small.parse_processes == 1
+    assert large.parse_processes > 1
+    assert large.cpus >= 1 + large.parse_processes
+    # a decoded shard per process and the prepared shards submitted ahead
+    assert large.memory_mb - small.memory_mb > large.parse_processes * SHARD_BYTES / (1024 * 1024)
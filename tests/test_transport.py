@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from ingest.chunking import serialize_in_chunks
+from ingest import parallel_parse, transport
+from ingest.transport import BodyEncoder, json_array
+
+
+class _Request:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class _Response:
+    def __init__(self, status_code, content=b"{}", encoding="gzip"):
+        self.status_code = status_code
+        self.content = content
+        self.request = _Request({"Content-Encoding": encoding} if encoding else {})
+
+
+@pytest.mark.parametrize("response, rejected", [
+    (_Response(415), True),
+    (_Response(400, b'{"detail":"JSON parse error - \'utf-8\' codec can\'t decode byte 0x8b"}'), True),
+    (_Response(400, b'{"characters":[{"line_id":["This field is required."]}]}'), False),
+    (_Response(503), False),
+])
+def test_only_undecodable_bodies_turn_compression_off(response, rejected):
+    encoder = BodyEncoder("gzip")
+    assert encoder.rejected(response) is rejected
+    assert encoder.encoding == (None if rejected else "gzip")
+
+
+def test_requests_in_flight_are_resent_after_compression_was_turned_off():
+    encoder = BodyEncoder("gzip")
+    in_flight = [encoder.encode({"characters": []})[1] for _ in range(2)]
+    assert all(headers["Content-Encoding"] == "gzip" for headers in in_flight)
+    assert encoder.rejected(_Response(415))
+    assert encoder.rejected(_Response(415))
+    assert "Content-Encoding" not in encoder.encode({"characters": []})[1]
+    # a 415 for an uncompressed body is not about the compression
+    assert not encoder.rejected(_Response(415, encoding=None))
+
+
+def test_serialized_chunks_are_the_records():
+    records = [{"id": i, "text": "ſæ"} for i in range(100)]
+    chunks = list(serialize_in_chunks(records, max_bytes=500))
+    assert len(chunks) > 1
+    assert [record for _, texts in chunks for record in json.loads(json_array(texts))] == records
+
+
+def test_parse_processes_serialize_like_the_loader(tmp_path, monkeypatch):
+    # the stdlib fallback is where they used to differ, and it has to be patched in this process
+    monkeypatch.setattr(transport, "orjson", None)
+    monkeypatch.setattr(parallel_parse, "_table", {"a": "a"})
+    records = [{"id": f"c{i}", "character_class": "a", "offset": i / 2, "text": "ſ"} for i in range(200)]
+    path = tmp_path / "chars.json"
+    path.write_text(json.dumps({"chars": records}, indent=1))
+    texts = []
+    for start, end in parallel_parse.plan_shards(str(path), "chars", 1024):
+        for body, starts, ends, _ in parallel_parse.prepare_shard(str(path), "chars", start, end, 1000):
+            texts.extend(body[record_start:record_end] for record_start, record_end in zip(starts, ends))
+    # the chunks of the processes end with their shards, the records have to be the same bytes
+    assert texts == [text for _, chunk_texts in serialize_in_chunks(records) for text in chunk_texts]
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from benchmarks.synthetic_book import generate_book
+from ingest import validate
+from ingest.validate import validate_book
+
+
+def _book(tmp_path, pages=None, lines=None, chars=None):
+    pages = [{"id": "p1"}, {"id": "p2"}] if pages is None else pages
+    lines = [{"id": "l1", "page_id": "p1"}, {"id": "l2", "page_id": "p2"}] if lines is None else lines
+    chars = [{"id": f"c{i}", "line_id": "l1", "character_class": "a"} for i in range(5)] if chars is None else chars
+    for array, records in (("pages", pages), ("lines", lines), ("chars", chars)):
+        (tmp_path / f"{array}.json").write_text(json.dumps({array: records}))
+    return str(tmp_path)
+
+
+def _problems(report):
+    return {key: count for key, (count, _) in report.problems.items()}
+
+
+def test_generated_book_is_valid(tmp_path):
+    json_directory = str(tmp_path / "book_color")
+    generate_book(json_directory, characters=500)
+    report = validate_book(json_directory)
+    assert report.ok, report.summary()
+    assert report.counts["chars"] == 500
+    assert "is valid" in report.summary()
+
+
+def test_missing_fields_and_classes_that_are_not_strings(tmp_path):
+    chars = [{"id": "c1", "line_id": "l1", "character_class": "a"},
+             {"id": "c2", "line_id": "l1"},
+             {"id": "c3", "line_id": None, "character_class": 7},
+             {"line_id": "l2", "character_class": "b"}]
+    report = validate_book(_book(tmp_path, chars=chars))
+    assert _problems(report) == {
+        ("chars", "records without 'id'"): 1,
+        ("chars", "records without 'line_id'"): 1,
+        ("chars", "records without 'character_class'"): 1,
+        ("chars", "characters whose 'character_class' is not a string"): 1,
+    }
+
+
+def test_duplicates_are_found_across_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(validate, "BATCH_SIZE", 2)
+    pages = [{"id": "p1"}, {"id": "p2"}, {"id": "p3"}, {"id": "p1"}, {"id": "p3"}]
+    chars = [{"id": f"c{i % 4}", "line_id": "l1", "character_class": "a"} for i in range(7)]
+    report = validate_book(_book(tmp_path, pages=pages, chars=chars))
+    assert _problems(report) == {("pages", "duplicate ids"): 2, ("chars", "duplicate ids"): 3}
+    assert report.problems[("pages", "duplicate ids")][1] == ["p1", "p3"]
+
+
+def test_references_to_missing_records(tmp_path):
+    lines = [{"id": "l1", "page_id": "p1"}, {"id": "l2", "page_id": "p9"}]
+    chars = [{"id": f"c{i}", "line_id": "l8", "character_class": "a"} for i in range(5)]
+    report = validate_book(_book(tmp_path, lines=lines, chars=chars))
+    assert _problems(report) == {("lines", "records referencing missing pages"): 1,
+                                 ("chars", "records referencing missing lines"): 5}
+    # examples are capped
+    assert report.problems[("chars", "records referencing missing lines")][1] == \
+        ["c0 -> l8", "c1 -> l8", "c2 -> l8"]
+    assert "c0 -> l8" in report.summary()
+
+
+def test_records_that_are_not_objects(tmp_path):
+    pages = [{"id": "p1"}, "p2", None, {"id": "p2"}]
+    report = validate_book(_book(tmp_path, pages=pages))
+    assert _problems(report) == {("pages", "records that are not objects"): 2}
+    assert report.counts["pages"] == 4
+
+
+@pytest.mark.parametrize("text, problem", [
+    ('{"chars": [{"id": "c1", "line_id": "l1", "character_class": "a"}, {"id": "c2"', "file is not valid JSON"),
+    ('{"characters": []}', "file has no 'chars' array"),
+    ('{"chars": []}', "records, the array is empty"),
+])
+def test_unreadable_or_empty_arrays(tmp_path, text, problem):
+    json_directory = _book(tmp_path)
+    (tmp_path / "chars.json").write_text(text)
+    report = validate_book(json_directory)
+    assert list(report.problems) == [("chars", problem)]
+    assert not report.ok
+
+
+def test_missing_file(tmp_path):
+    json_directory = _book(tmp_path)
+    (tmp_path / "pages.json").unlink()
+    report = validate_book(json_directory)
+    assert ("pages", "file could not be read") in report.problems
+    # every line then references a missing page
+    assert ("lines", "records referencing missing pages") in report.problems